@@ -5,23 +5,38 @@
 """
 from trytond.pool import Pool
 from shipment import Package, ShipmentOut, GenerateShippingLabel, ShippingGLS, \
-    Address
-from carrier import Carrier
+    Address, GenerateGLSLabels, GLSLabelsSummary, ReprintGLSLabels, \
+    ReprintGLSLabelsStart, ReprintGLSLabelsResult, GLSLabel
+from carrier import Carrier, GLSAccount, GLSZone, GLSTariff
 from sale import Sale
+from statistic import GLSShipmentStatistic, GLSShipmentStatisticRefresh
+from printer import GLSPrinter
 
 
 def register():
     Pool.register(
         Carrier,
+        GLSAccount,
+        GLSZone,
+        GLSTariff,
         Sale,
         Package,
+        GLSLabel,
         ShipmentOut,
         ShippingGLS,
         Address,
+        GLSLabelsSummary,
+        ReprintGLSLabelsStart,
+        ReprintGLSLabelsResult,
+        GLSShipmentStatistic,
+        GLSShipmentStatisticRefresh,
+        GLSPrinter,
         module='shipping_gls', type_='model'
     )
 
     Pool.register(
         GenerateShippingLabel,
+        GenerateGLSLabels,
+        ReprintGLSLabels,
         module='shipping_gls', type_='wizard'
     )
@@ -3,18 +3,35 @@
     carrier.py
 
 """
-from gls_unibox_api.api import Client
+import time
+import heapq
+import socket
+import logging
 from decimal import Decimal
+from sql import Literal
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
 
-from shipment import GLS_SERVICES
+from shipment import GLS_SERVICES, GLS_PRINTER_RESOLUTIONS
+from tariff import TariffTable
+from tracking import TrackingClient
+from unibox import UniboxClient
 from trytond.pool import PoolMeta, Pool
-from trytond.model import fields
+from trytond.model import fields, ModelSQL, ModelView
 from trytond.pyson import Eval
 from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.tools import grouped_slice, reduce_ids
 
-__all__ = ['Carrier']
+__all__ = ['Carrier', 'GLSAccount', 'GLSZone', 'GLSTariff']
+
+logger = logging.getLogger(__name__)
 __metaclass__ = PoolMeta
 
+# Number of seconds quotes are memoised for
+QUOTE_TTL = config.getint('shipping_gls', 'quote_ttl', default=300)
+
 STATES = {
     'required': Eval('carrier_cost_method') == 'gls',
     'invisible': Eval('carrier_cost_method') != 'gls'
@@ -76,27 +93,142 @@ class Carrier:
         }, depends=DEPENDS
     )
     gls_printer_resolution = fields.Selection(
-        [
-            ('zebrazpl200', '200dpi'),
-            ('zebrazpl300', '300dpi'),
-        ],
-        'GLS Printer Resolution',
+        GLS_PRINTER_RESOLUTIONS, 'GLS Printer Resolution',
         states={
             'invisible': Eval('carrier_cost_method') != 'gls',
         }, depends=DEPENDS
     )
 
+    gls_tracking_url = fields.Char(
+        'GLS Tracking URL', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS,
+        help="URL of the GLS parcel tracking service"
+    )
+
+    gls_connect_timeout = fields.Float(
+        'GLS Connect Timeout', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS,
+        help="Seconds to wait for the connection to the Unibox, "
+        "without limit if empty"
+    )
+    gls_read_timeout = fields.Float(
+        'GLS Read Timeout', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS,
+        help="Seconds to wait for each part of the answer of the Unibox, "
+        "without limit if empty"
+    )
+    gls_label_deadline = fields.Float(
+        'GLS Labelling Deadline', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS,
+        help="Seconds given to generate all the labels of a labelling run, "
+        "without limit if empty. The remaining packages fail once they "
+        "are spent."
+    )
+
+    gls_multi_parcel = fields.Boolean(
+        'GLS Multi-Parcel Requests', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS,
+        help="Request the labels of all the packages of a shipment at once, "
+        "if the Unibox supports it"
+    )
+    gls_combined_labels = fields.Boolean(
+        'Combined GLS Labels', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS,
+        help="Store the labels of a shipment in a single document instead "
+        "of one attachment per package"
+    )
+    gls_profile = fields.Boolean(
+        'Profile GLS Labelling', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS,
+        help="Run the label generation under the profiler and store the "
+        "profiles in the filestore"
+    )
+
+    gls_accounts = fields.One2Many(
+        'carrier.gls.account', 'carrier', 'GLS Accounts', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS,
+        help="Contracts shared by the shipments, the contract of the carrier "
+        "is used if empty"
+    )
+
+    gls_zones = fields.One2Many(
+        'carrier.gls.zone', 'carrier', 'GLS Zones', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS
+    )
+    gls_tariffs = fields.One2Many(
+        'carrier.gls.tariff', 'carrier', 'GLS Tariffs', states={
+            'invisible': Eval('carrier_cost_method') != 'gls',
+        }, depends=DEPENDS
+    )
+
+    _gls_carriers_cache = Cache('carrier.gls_carriers', context=False)
+    _gls_tariff_table_cache = Cache('carrier.gls_tariff_table', context=False)
+    _gls_quote_cache = Cache(
+        'carrier.gls_quote',
+        size_limit=config.getint(
+            'shipping_gls', 'quote_cache_size', default=10000
+        ),
+        context=False
+    )
+
     @classmethod
     def view_attributes(cls):
         return super(Carrier, cls).view_attributes() + [
             ('//page[@id="gls_unibox_config"]', 'states', {
                 'invisible':  Eval('carrier_cost_method') != 'gls'
+            }),
+            ('//group[@id="gls_accounts"]', 'states', {
+                'invisible':  Eval('carrier_cost_method') != 'gls'
+            }),
+            ('//group[@id="gls_tariffs"]', 'states', {
+                'invisible':  Eval('carrier_cost_method') != 'gls'
             })]
 
     def __init__(self, *args, **kwargs):
         super(Carrier, self).__init__(*args, **kwargs)
         self._gls_unibox_client = None
 
+    @classmethod
+    def create(cls, vlist):
+        carriers = super(Carrier, cls).create(vlist)
+        cls._gls_carriers_cache.clear()
+        return carriers
+
+    @classmethod
+    def write(cls, *args):
+        super(Carrier, cls).write(*args)
+        cls._gls_carriers_cache.clear()
+
+    @classmethod
+    def delete(cls, carriers):
+        super(Carrier, cls).delete(carriers)
+        cls._gls_carriers_cache.clear()
+
+    @classmethod
+    def get_gls_carrier_ids(cls):
+        """
+        Returns the set of the ids of the GLS carriers, which is cached per
+        database until a carrier is changed
+        """
+        ids = cls._gls_carriers_cache.get(None)
+        if ids is None:
+            with Transaction().set_context(active_test=False):
+                ids = frozenset(
+                    carrier.id for carrier in
+                    cls.search([('carrier_cost_method', '=', 'gls')])
+                )
+            cls._gls_carriers_cache.set(None, ids)
+        return ids
+
     @classmethod
     def __setup__(cls):
         super(Carrier, cls).__setup__()
@@ -105,37 +237,213 @@ class Carrier:
         if selection not in cls.carrier_cost_method.selection:
             cls.carrier_cost_method.selection.append(selection)
 
+        cls._error_messages.update({
+            'gls_no_tariff': (
+                'No GLS tariff of carrier "%(carrier)s" for the service '
+                '"%(service_type)s" to "%(country)s %(zip)s" for a weight of '
+                '%(weight)s kg.'
+            ),
+        })
+
     def get_unibox_client(self):
         """
         Returns the configured GLS Unibox client
         """
         if self._gls_unibox_client is None:
-            client = Client(
+            client = UniboxClient(
                 self.gls_server,
-                self.gls_port
+                self.gls_port,
+                connect_timeout=self.gls_connect_timeout,
+                read_timeout=self.gls_read_timeout,
+                label_deadline=self.gls_label_deadline,
             )
             client.test = self.gls_is_test
             self._gls_unibox_client = client
 
         return self._gls_unibox_client
 
+    @classmethod
+    def check_gls_connections(cls):
+        """
+        Verifies that the Unibox of each active GLS carrier resolves and
+        accepts connections. The Unibox closes each connection after a
+        request, so this is only a reachability check.
+
+        :return: A dictionary which maps each carrier to the error raised or
+                 None
+        """
+        errors = {}
+        for carrier in cls.search([('carrier_cost_method', '=', 'gls')]):
+            try:
+                seconds = carrier.get_unibox_client().check()
+            except socket.error as exception:
+                logger.warning(
+                    'GLS Unibox of carrier %s is not reachable: %s',
+                    carrier.id, exception
+                )
+                errors[carrier] = exception
+            else:
+                logger.debug(
+                    'GLS Unibox of carrier %s connected in %.3fs',
+                    carrier.id, seconds
+                )
+                errors[carrier] = None
+        return errors
+
+    def pick_gls_accounts(self, count):
+        """
+        Picks the accounts of the next count shipments, each going to the
+        least loaded account relative to its weight. The load of an account
+        is the number of its shipments of the day.
+
+        :return: A list of count accounts, or of None if the carrier has no
+                 accounts
+        """
+        GLSAccount = Pool().get('carrier.gls.account')
+
+        if not self.gls_accounts:
+            return [None] * count
+        loads = GLSAccount.get_loads(self.gls_accounts)
+        heap = [
+            (float(loads[account.id]) / account.weight, index, account)
+            for index, account in enumerate(self.gls_accounts)
+        ]
+        heapq.heapify(heap)
+
+        accounts = []
+        for _ in range(count):
+            _, index, account = heap[0]
+            accounts.append(account)
+            loads[account.id] += 1
+            heapq.heapreplace(heap, (
+                float(loads[account.id]) / account.weight, index, account
+            ))
+        return accounts
+
+    def get_gls_tracking_client(self):
+        """
+        Returns the client for the GLS tracking service
+        """
+        return TrackingClient(self.gls_tracking_url)
+
+    def get_gls_tariff_table(self):
+        """
+        Returns the tariff table of the carrier, which is built once per
+        process and kept until the zones or tariffs change
+        """
+        table = self._gls_tariff_table_cache.get(self.id)
+        if table is None:
+            table = TariffTable([
+                (zone.country.code, zone.zip_prefix, zone.zone)
+                for zone in self.gls_zones
+            ], [
+                (tariff.service_type, tariff.zone, tariff.weight, tariff.price)
+                for tariff in self.gls_tariffs
+            ])
+            self._gls_tariff_table_cache.set(self.id, table)
+        return table
+
+    def get_gls_quotes(self, quotes):
+        """
+        Quotes many shipments at once from the tariffs of the carrier.
+
+        Prices are memoised by service type, zip prefix and weight bracket
+        for QUOTE_TTL seconds. Everything is free of charge when the carrier
+        has no tariffs.
+
+        :param quotes: List of tuples (country code, zip code, weight in kg,
+                       service type)
+        :return: A list with, for each quote in order, its price or None if
+                 there is no tariff for it
+        """
+        table = self.get_gls_tariff_table()
+        if not table:
+            return [Decimal('0')] * len(quotes)
+
+        now = time.time()
+        prices = []
+        for country, zip_code, weight, service_type in quotes:
+            key = (self.id,) + table.get_quote_key(
+                service_type, country, zip_code, weight
+            )
+            price, expire = self._gls_quote_cache.get(key, (None, None))
+            if expire is None or expire < now:
+                price = table.quote(service_type, country, zip_code, weight)
+                self._gls_quote_cache.set(key, (price, now + QUOTE_TTL))
+            prices.append(price)
+        return prices
+
+    def _get_gls_sale_price(self, sale):
+        """
+        Returns the price to ship the sale according to the tariffs of the
+        carrier. Sales without a shipment address are free of charge.
+        """
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+
+        address = sale.shipment_address
+        if not address:
+            return Decimal('0')
+
+        service_type = sale.gls_shipping_service_type or \
+            self.gls_shipping_service_type
+        country = address.country and address.country.code
+        weight = sale._get_total_weight(
+            Uom(ModelData.get_id('product', 'uom_kilogram'))
+        )
+
+        price, = self.get_gls_quotes(
+            [(country, address.zip, weight, service_type)]
+        )
+        if price is None:
+            self.raise_user_error('gls_no_tariff', {
+                'carrier': self.rec_name,
+                'service_type': service_type,
+                'country': country or '',
+                'zip': address.zip or '',
+                'weight': weight,
+            })
+        return price
+
     def get_sale_price(self):
-        """Estimates the shipment rate for the current shipment
-           TODO: Fix this according to GLS shipping
         """
-        Currency = Pool().get('currency.currency')
-        Company = Pool().get('company.company')
+        Estimates the shipment rate of the sale in the context from the GLS
+        tariffs of the carrier, which are in the currency of the carrier.
+        The rate is given in the currency of the company in the context, or
+        in EUR.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Currency = pool.get('currency.currency')
 
         if self.carrier_cost_method != 'gls':
             return super(Carrier, self).get_sale_price()  # pragma: no cover
 
-        currency, = Currency.search([('code', '=', 'EUR')])
-        company = Transaction().context.get('company')
+        currency = self._get_gls_sale_currency()
+        price = Decimal('0')
+        sale_id = Transaction().context.get('sale')
+        if sale_id:
+            price = self._get_gls_sale_price(Sale(sale_id))
+            if currency != self.currency:
+                price = Currency.compute(self.currency, price, currency)
 
-        if company:
-            currency = Company(company).currency
+        return price, currency.id
+
+    @staticmethod
+    def _get_gls_sale_currency():
+        """
+        Returns the currency of the company in the context, or EUR
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Company = pool.get('company.company')
 
-        return Decimal('0'), currency.id
+        company = Transaction().context.get('company')
+        if company:
+            return Company(company).currency
+        currency, = Currency.search([('code', '=', 'EUR')])
+        return currency
 
     @staticmethod
     def default_gls_shipping_service_type():
@@ -144,3 +452,158 @@ class Carrier:
     @staticmethod
     def default_gls_printer_resolution():
         return 'zebrazpl200'
+
+    @staticmethod
+    def default_gls_tracking_url():
+        return 'https://gls-group.eu/app/service/open/rest/DE/en/rstt001'
+
+    @staticmethod
+    def default_gls_connect_timeout():
+        return 10
+
+    @staticmethod
+    def default_gls_read_timeout():
+        return 30
+
+    @staticmethod
+    def default_gls_label_deadline():
+        return 120
+
+
+class GLSAccount(ModelSQL, ModelView):
+    "GLS Account"
+    __name__ = 'carrier.gls.account'
+    _rec_name = 'contract'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, ondelete='CASCADE'
+    )
+    contract = fields.Char('GLS Contract', required=True)
+    customer_id = fields.Char('GLS Customer ID', required=True)
+    customer_number = fields.Char('GLS Customer Number', required=True)
+    weight = fields.Integer(
+        'Weight', required=True,
+        help="Share of the shipments given to the account relative to the "
+        "other accounts of the carrier"
+    )
+    active = fields.Boolean('Active', select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(GLSAccount, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'weight_positive', 'CHECK(weight > 0)',
+                'The weight of a GLS account must be positive'
+            )
+        ]
+
+    @staticmethod
+    def default_weight():
+        return 1
+
+    @staticmethod
+    def default_active():
+        return True
+
+    @classmethod
+    def get_loads(cls, accounts):
+        """
+        Returns a dictionary which maps the id of each account to the number
+        of its shipments of the day
+        """
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        Date = pool.get('ir.date')
+        shipment = Shipment.__table__()
+        cursor = Transaction().cursor
+
+        loads = dict((account.id, 0) for account in accounts)
+        for sub_ids in grouped_slice(loads.keys()):
+            cursor.execute(*shipment.select(
+                shipment.gls_account, Count(Literal('*')),
+                where=reduce_ids(shipment.gls_account, sub_ids)
+                & (Coalesce(shipment.effective_date, shipment.planned_date)
+                    == Date.today()),
+                group_by=[shipment.gls_account]
+            ))
+            loads.update(cursor.fetchall())
+        return loads
+
+
+class GLSTariffTableMixin(object):
+    """
+    Clears the cached tariff tables and quotes of the carriers whenever the
+    records they are built from change
+    """
+
+    @staticmethod
+    def _clear_tariff_caches():
+        Carrier = Pool().get('carrier')
+        Carrier._gls_tariff_table_cache.clear()
+        Carrier._gls_quote_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(GLSTariffTableMixin, cls).create(vlist)
+        cls._clear_tariff_caches()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(GLSTariffTableMixin, cls).write(*args)
+        cls._clear_tariff_caches()
+
+    @classmethod
+    def delete(cls, records):
+        super(GLSTariffTableMixin, cls).delete(records)
+        cls._clear_tariff_caches()
+
+
+class GLSZone(GLSTariffTableMixin, ModelSQL, ModelView):
+    "GLS Zone"
+    __name__ = 'carrier.gls.zone'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, ondelete='CASCADE'
+    )
+    zone = fields.Char('Zone', required=True, select=True)
+    country = fields.Many2One('country.country', 'Country', required=True)
+    zip_prefix = fields.Char(
+        'ZIP Prefix', help="Leave empty to match the whole country"
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(GLSZone, cls).__setup__()
+        cls._order.insert(0, ('zone', 'ASC'))
+
+
+class GLSTariff(GLSTariffTableMixin, ModelSQL, ModelView):
+    "GLS Tariff"
+    __name__ = 'carrier.gls.tariff'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, ondelete='CASCADE'
+    )
+    service_type = fields.Selection(
+        GLS_SERVICES, 'GLS Service/Product Type', required=True
+    )
+    zone = fields.Char('Zone', required=True)
+    weight = fields.Float(
+        'Maximum Weight', required=True, help="In kg"
+    )
+    price = fields.Numeric('Price', digits=(16, 4), required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(GLSTariff, cls).__setup__()
+        cls._order = [
+            ('service_type', 'ASC'),
+            ('zone', 'ASC'),
+            ('weight', 'ASC'),
+        ]
+
+    @staticmethod
+    def default_service_type():
+        return 'euro_business_parcel'
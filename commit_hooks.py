@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+    commit_hooks.py
+
+    Calls run once the transaction is committed
+"""
+import logging
+
+from trytond.transaction import Transaction
+
+__all__ = ['after_commit', 'run_after_commit']
+
+logger = logging.getLogger(__name__)
+
+
+def after_commit(function, *args):
+    """
+    Calls function with args once the cursor of the transaction is
+    committed, or never if it is rolled back or closed first.
+
+    trytond has no hook on the commit, so the commit and the rollback of the
+    cursor are wrapped the first time a call is registered on it.
+    """
+    cursor = Transaction().cursor
+    # The cursor of some backends looks up unknown attributes on the
+    # database cursor
+    calls = cursor.__dict__.get('_after_commit')
+    if calls is None:
+        calls = cursor._after_commit = []
+        commit, rollback = cursor.commit, cursor.rollback
+
+        def _commit():
+            commit()
+            run_after_commit(cursor)
+
+        def _rollback():
+            del calls[:]
+            rollback()
+
+        cursor.commit, cursor.rollback = _commit, _rollback
+    calls.append((function, args))
+
+
+def run_after_commit(cursor):
+    """
+    Runs the calls registered on the cursor, in order, which its commit
+    does. The data is committed by then, so failing calls are only logged.
+    """
+    calls = cursor.__dict__.get('_after_commit', [])
+    while calls:
+        function, args = calls.pop(0)
+        try:
+            function(*args)
+        except Exception:
+            logger.exception('Call after commit failed')
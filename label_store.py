@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+    label_store.py
+
+"""
+import os
+import zlib
+import fcntl
+import filecmp
+import hashlib
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from gls_unibox_api.api import Response
+from gls_unibox_api.tags import StartTag, EndTag
+
+from trytond.config import config
+from trytond.cache import Cache
+
+from zpl import convert_zpl
+
+__all__ = [
+    'LabelSink', 'stream_label', 'spool_label', 'spool_parcel_labels',
+    'spool_request', 'map_concurrently', 'spool_labels', 'send_requests',
+    'combine_labels', 'read_label', 'read_spooled_label', 'LabelArchive',
+    'read_archived_label',
+]
+
+CHUNK_SIZE = 8192
+
+# Stored labels never change, so they are cached by digest without any
+# invalidation and the least recently used are evicted
+_labels_cache = Cache(
+    'shipping_gls.label',
+    size_limit=config.getint('shipping_gls', 'label_cache_size', default=256),
+    context=False
+)
+
+
+class LabelSink(object):
+    """
+    File like object which writes a label straight into the trytond filestore
+    while computing its digest, so that the label never has to be held in
+    memory as a whole.
+
+    The layout matches the one used by `ir.attachment`, which means the
+    resulting digest and collision can be set on an attachment instead of
+    its data.
+    """
+
+    def __init__(self, db_name, filestore=None):
+        """
+        :param filestore: Directory of the filestores of the databases, the
+                          one of the configuration by default
+        """
+        self.directory = os.path.join(
+            filestore or config.get('database', 'path'), db_name
+        )
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o770)
+        fd, self.path = tempfile.mkstemp(prefix='.gls-', dir=self.directory)
+        self.file = os.fdopen(fd, 'wb')
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.file.write(data)
+
+    def close(self):
+        """
+        Moves the spooled label to its final place in the filestore and
+        returns the tuple (digest, collision)
+        """
+        self.file.close()
+        digest = self.md5.hexdigest()
+        directory = os.path.join(self.directory, digest[0:2], digest[2:4])
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o770)
+
+        collision = 0
+        filename = os.path.join(directory, digest)
+        while os.path.isfile(filename) and \
+                not filecmp.cmp(filename, self.path, shallow=False):
+            collision += 1
+            filename = os.path.join(directory, '%s-%s' % (digest, collision))
+
+        if os.path.isfile(filename):
+            # Same label is already in the filestore
+            os.remove(self.path)
+        else:
+            os.rename(self.path, filename)
+        return digest, collision
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class LabelArchive(object):
+    """
+    Append-only archive files of labels in the filestore of a database.
+
+    Each label is compressed as a gzip member of its own, so that a label is
+    read back by seeking to its offset and decompressing only its member,
+    while an archive file as a whole remains a valid gzip file.
+    """
+    wbits = 16 + zlib.MAX_WBITS
+
+    def __init__(self, db_name):
+        self.directory = os.path.join(
+            config.get('database', 'path'), db_name, 'gls_archive'
+        )
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o770)
+
+    def append(self, name, labels):
+        """
+        Appends the labels to the archive file name and returns, for each
+        label in order, the tuple (offset, size) of its member
+        """
+        entries = []
+        with open(os.path.join(self.directory, name), 'ab') as archive:
+            # Runs appending to the same file at once would record
+            # overlapping offsets
+            fcntl.flock(archive, fcntl.LOCK_EX)
+            try:
+                archive.seek(0, os.SEEK_END)
+                for label in labels:
+                    compressor = zlib.compressobj(
+                        9, zlib.DEFLATED, self.wbits
+                    )
+                    data = compressor.compress(label) + compressor.flush()
+                    entries.append((archive.tell(), len(data)))
+                    archive.write(data)
+                archive.flush()
+                os.fsync(archive.fileno())
+            finally:
+                fcntl.flock(archive, fcntl.LOCK_UN)
+        return entries
+
+    def read(self, name, offset, size):
+        """
+        Returns the label stored at offset in the archive file name
+        """
+        with open(os.path.join(self.directory, name), 'rb') as archive:
+            archive.seek(offset)
+            return zlib.decompress(archive.read(size), self.wbits)
+
+
+def _copy_until(conn, sink, marker, pending=''):
+    """
+    Copy the data pending and then received on conn to sink until marker is
+    found and return the rest of the received data, starting with the
+    marker.
+    """
+    keep = len(marker) - 1
+    while True:
+        position = pending.find(marker)
+        if position != -1:
+            sink.write(pending[:position])
+            return pending[position:]
+        if len(pending) > keep:
+            sink.write(pending[:-keep])
+            pending = pending[-keep:]
+        data = conn.recv(CHUNK_SIZE)
+        if not data:
+            # No GLS tags in the response, the parser reports it
+            sink.write(pending)
+            return ''
+        pending += data
+
+
+def _read_tags(conn, pending):
+    """
+    Read from conn until the end of the GLS tags starting pending and return
+    the tuple (tags, rest of the received data)
+    """
+    while EndTag.code not in pending:
+        data = conn.recv(CHUNK_SIZE)
+        if not data:
+            return pending, ''
+        pending += data
+    position = pending.find(EndTag.code) + len(EndTag.code)
+    return pending[:position], pending[position:]
+
+
+def stream_label(client, tags, sink):
+    """
+    Send the request tags to the Unibox and write the ZPL content of the
+    response to sink as it arrives.
+
+    Returns the parsed response, which holds only the GLS tags.
+    """
+    conn = client.get_socket_conn()
+    try:
+        conn.sendall(StartTag.code + '|'.join(tags) + '|' + EndTag.code)
+        response = _copy_until(conn, sink, StartTag.code)
+        while True:
+            data = conn.recv(CHUNK_SIZE)
+            if not data:
+                break
+            response += data
+    finally:
+        conn.close()
+    return Response.parse(response)
+
+
+def spool_label(client, tags, db_name, filestore=None):
+    """
+    Request a label and spool it into the filestore of the database.
+
+    Returns the tuple (response, digest, collision)
+    """
+    sink = LabelSink(db_name, filestore)
+    try:
+        response = stream_label(client, tags, sink)
+    except Exception:
+        sink.discard()
+        raise
+    digest, collision = sink.close()
+    return response, digest, collision
+
+
+def spool_parcel_labels(client, tags, db_name, filestore=None):
+    """
+    Request the labels of all the parcels of a shipment at once and spool
+    them into the filestore of the database.
+
+    The Unibox answers with the label of each parcel followed by its GLS
+    tags, one after the other.
+
+    Returns a list with the tuple (response, digest, collision) of each
+    label received, in order.
+    """
+    labels = []
+    sink = None
+    conn = client.get_socket_conn()
+    try:
+        conn.sendall(StartTag.code + '|'.join(tags) + '|' + EndTag.code)
+        pending = ''
+        while True:
+            sink = LabelSink(db_name, filestore)
+            pending = _copy_until(conn, sink, StartTag.code, pending)
+            if not pending:
+                break
+            response, pending = _read_tags(conn, pending)
+            labels.append((Response.parse(response),) + sink.close())
+            sink = None
+    finally:
+        conn.close()
+        if sink is not None:
+            sink.discard()
+    return labels
+
+
+def spool_request(client, tags, db_name, parcels=1, filestore=None):
+    """
+    Spool the labels of a request for one or many parcels.
+
+    Returns a list with the tuple (response, digest, collision) of each
+    label received, in order.
+
+    :param filestore: Directory of the filestores of the databases, the one
+                      of the configuration by default
+    """
+    if parcels == 1:
+        return [spool_label(client, tags, db_name, filestore)]
+    return spool_parcel_labels(client, tags, db_name, filestore)
+
+
+def map_concurrently(function, items, workers):
+    """
+    Calls function on each item from a pool of at most workers threads.
+
+    :return: A list with, for each item in order, either the result or the
+             exception raised.
+    """
+    def call(item):
+        try:
+            return function(item)
+        except Exception as exception:
+            return exception
+
+    if not items:
+        return []
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def spool_labels(requests, db_name, workers):
+    """
+    Spool the labels of many requests concurrently.
+
+    :param requests: List of tuples (client, tags, number of parcels)
+    :param workers: Maximum number of concurrent Unibox connections
+    :return: A list with, for each request in order, either the list of
+             the tuples (response, digest, collision) of its labels or the
+             exception raised.
+    """
+    def spool(request):
+        client, tags, parcels = request
+        return spool_request(client, tags, db_name, parcels)
+
+    return map_concurrently(spool, requests, workers)
+
+
+def send_requests(requests, workers):
+    """
+    Send many requests which do not return a label concurrently.
+
+    :param requests: List of tuples (client, tags)
+    :param workers: Maximum number of concurrent Unibox connections
+    :return: A list with, for each request in order, either the parsed
+             response or the exception raised.
+    """
+    def send(request):
+        client, tags = request
+        return Response.parse(client.request(tags))
+
+    return map_concurrently(send, requests, workers)
+
+
+def _read_label(key, load, resolution, target_resolution):
+    """
+    Returns the label converted to target_resolution from the process cache,
+    or loads it with load and caches it
+    """
+    key += (target_resolution,)
+    label = _labels_cache.get(key)
+    if label is None:
+        label = convert_zpl(load(), resolution, target_resolution)
+        _labels_cache.set(key, label)
+    return label
+
+
+def read_label(attachment, resolution, target_resolution):
+    """
+    Returns the ZPL label stored in the attachment for the printer
+    resolution target_resolution, using the process cache if possible.
+
+    :param resolution: Printer resolution the label was generated for
+    """
+    return _read_label(
+        (attachment.digest, attachment.collision),
+        lambda: str(attachment.data), resolution, target_resolution
+    )
+
+
+def _get_filestore_path(db_name, digest, collision, filestore=None):
+    return os.path.join(
+        filestore or config.get('database', 'path'), db_name,
+        digest[0:2], digest[2:4],
+        '%s-%s' % (digest, collision) if collision else digest
+    )
+
+
+def remove_labels(db_name, labels):
+    """
+    Removes the files of the labels from the filestore of the database,
+    ignoring the ones which are already gone
+
+    :param labels: List of tuples (digest, collision) of the labels
+    """
+    for digest, collision in labels:
+        try:
+            os.unlink(_get_filestore_path(db_name, digest, collision))
+        except OSError:
+            pass
+
+
+def combine_labels(db_name, labels, filestore=None):
+    """
+    Concatenates the spooled labels, in order, into a single document of the
+    filestore of the database.
+
+    :param labels: List of tuples (digest, collision) of the labels
+    :param filestore: Directory of the filestores of the databases, the one
+                      of the configuration by default
+    :return: The tuple (digest, collision, index) of the document, where
+             index is the list of the tuples (offset, size) of the labels
+    """
+    index = []
+    offset = 0
+    sink = LabelSink(db_name, filestore)
+    try:
+        for digest, collision in labels:
+            with open(_get_filestore_path(
+                    db_name, digest, collision, filestore), 'rb') as label:
+                data = label.read()
+            sink.write(data)
+            index.append((offset, len(data)))
+            offset += len(data)
+    except Exception:
+        sink.discard()
+        raise
+    return sink.close() + (index,)
+
+
+def read_spooled_label(db_name, digest, collision, resolution,
+                       target_resolution, offset=None, size=None):
+    """
+    Returns the ZPL label spooled into the filestore with digest and
+    collision for the printer resolution target_resolution, using the
+    process cache if possible.
+
+    :param resolution: Printer resolution the label was generated for
+    :param offset: Position of the label in a combined document
+    :param size: Size of the label in a combined document
+    """
+    def load():
+        with open(_get_filestore_path(db_name, digest, collision),
+                  'rb') as label:
+            if offset is None:
+                return label.read()
+            label.seek(offset)
+            return label.read(size)
+
+    key = (digest, collision)
+    if offset is not None:
+        key += (offset,)
+    return _read_label(key, load, resolution, target_resolution)
+
+
+def read_archived_label(
+        db_name, name, offset, size, resolution, target_resolution):
+    """
+    Returns the ZPL label archived at offset in the archive file name for
+    the printer resolution target_resolution, using the process cache if
+    possible.
+
+    :param resolution: Printer resolution the label was generated for
+    """
+    return _read_label(
+        ('archive', db_name, name, offset),
+        lambda: LabelArchive(db_name).read(name, offset, size),
+        resolution, target_resolution
+    )
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+    printer.py
+
+    Label printers of the warehouses, fed straight from the labelling
+"""
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.cache import Cache
+
+from shipment import GLS_PRINTER_RESOLUTIONS
+from spooler import get_printer_queue
+from commit_hooks import after_commit
+
+__all__ = ['GLSPrinter']
+
+
+class GLSPrinter(ModelSQL, ModelView):
+    "GLS Label Printer"
+    __name__ = 'stock.gls.printer'
+
+    name = fields.Char('Name', required=True)
+    warehouse = fields.Many2One(
+        'stock.location', 'Warehouse', required=True, select=True,
+        domain=[('type', '=', 'warehouse')], ondelete='CASCADE'
+    )
+    host = fields.Char('Host', required=True)
+    port = fields.Integer(
+        'Port', required=True, help="Raw TCP port of the printer"
+    )
+    resolution = fields.Selection(
+        GLS_PRINTER_RESOLUTIONS, 'Printer Resolution', required=True
+    )
+    active = fields.Boolean('Active', select=True)
+
+    # Warehouses are given the printer with the lowest id
+    _warehouse_printers_cache = Cache(
+        'stock.gls.printer.warehouse', context=False
+    )
+
+    @staticmethod
+    def default_port():
+        return 9100
+
+    @staticmethod
+    def default_resolution():
+        return 'zebrazpl200'
+
+    @staticmethod
+    def default_active():
+        return True
+
+    @classmethod
+    def create(cls, vlist):
+        printers = super(GLSPrinter, cls).create(vlist)
+        cls._warehouse_printers_cache.clear()
+        return printers
+
+    @classmethod
+    def write(cls, *args):
+        super(GLSPrinter, cls).write(*args)
+        cls._warehouse_printers_cache.clear()
+
+    @classmethod
+    def delete(cls, printers):
+        super(GLSPrinter, cls).delete(printers)
+        cls._warehouse_printers_cache.clear()
+
+    @classmethod
+    def get_warehouse_printers(cls):
+        """
+        Returns a dictionary which maps the id of each warehouse with an
+        active printer to the tuple (host, port, resolution) of the printer
+        """
+        printers = cls._warehouse_printers_cache.get(None)
+        if printers is None:
+            printers = {}
+            for printer in cls.search([], order=[('id', 'DESC')]):
+                printers[printer.warehouse.id] = (
+                    printer.host, printer.port, printer.resolution
+                )
+            cls._warehouse_printers_cache.set(None, printers)
+        return printers
+
+    @staticmethod
+    def print_labels(host, port, labels):
+        """
+        Queues the ZPL labels to be sent to the printer in the background
+        once the transaction is committed, so that nothing is printed for
+        parcels which are rolled back
+        """
+        after_commit(_queue_labels, host, port, labels)
+
+
+def _queue_labels(host, port, labels):
+    get_printer_queue(host, port).put(labels)
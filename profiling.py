@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    profiling.py
+
+    Profiles of the label generation runs
+"""
+import os
+import pstats
+import logging
+import cProfile
+from datetime import datetime
+from contextlib import contextmanager
+
+from trytond.config import config
+
+__all__ = ['profiled', 'get_category', 'get_summary']
+
+#: Number of functions listed in the summary of a profile
+PROFILE_TOP = config.getint('shipping_gls', 'profile_top', default=20)
+
+#: Categories of the summary, in order
+CATEGORIES = ['orm', 'api', 'network', 'parsing', 'other']
+
+# Rules giving the category of a function, the first one matching wins:
+# (category, part of the file name, parts of the function name or None)
+CATEGORY_RULES = [
+    ('network', 'socket.py', None),
+    ('network', 'threading.py', None),
+    ('network', 'multiprocessing/pool.py', None),
+    # Built-in functions
+    ('network', '~', ('_socket', 'thread.lock')),
+    ('parsing', 'gls_unibox_api/api.py', ('parse',)),
+    ('parsing', 'label_store.py', ('_copy_until', '_read_tags')),
+    ('api', 'gls_unibox_api/', None),
+    ('orm', 'trytond/', None),
+    ('orm', '/sql/', None),
+]
+
+logger = logging.getLogger(__name__)
+
+
+def get_category(filename, function):
+    """
+    Returns the category of the time spent in the function
+    """
+    for category, file_part, function_parts in CATEGORY_RULES:
+        if file_part in filename and (
+                function_parts is None
+                or any(part in function for part in function_parts)):
+            return category
+    return 'other'
+
+
+def get_summary(stats, limit=PROFILE_TOP):
+    """
+    Returns as text the time spent in each category and the functions which
+    took the most time of their own
+
+    :param stats: The pstats.Stats of the profile
+    """
+    categories = dict((category, 0.0) for category in CATEGORIES)
+    functions = []
+    for (filename, line, function), (_, calls, own, _, _) in \
+            stats.stats.iteritems():
+        category = get_category(filename, function)
+        categories[category] += own
+        functions.append((own, calls, category, '%s:%s(%s)' % (
+            filename, line, function
+        )))
+    functions.sort(reverse=True)
+
+    total = sum(categories.values()) or 1
+    lines = ['%-8s %8.3fs %5.1f%%' % (
+        name, categories[name], categories[name] * 100 / total
+    ) for name in CATEGORIES]
+    lines.append('')
+    lines.extend(
+        '%8.3fs %8d %-8s %s' % function for function in functions[:limit]
+    )
+    return '\n'.join(lines)
+
+
+@contextmanager
+def profiled(db_name, name, enabled):
+    """
+    Runs the block under cProfile if enabled and stores the profile and its
+    summary in the filestore of the database. Nothing is done otherwise.
+
+    Only the calling thread is profiled: the time it waits for the requests
+    sent from other threads is counted as network time.
+
+    :param name: Prefix of the names of the files, which identifies the
+                 shipment or batch profiled
+    """
+    if not enabled:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _store_profile(db_name, name, profile)
+
+
+def _store_profile(db_name, name, profile):
+    directory = os.path.join(
+        config.get('database', 'path'), db_name, 'gls_profiles'
+    )
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o770)
+    path = os.path.join(directory, '%s-%s' % (
+        name, datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    ))
+    profile.dump_stats(path + '.prof')
+    summary = get_summary(pstats.Stats(profile))
+    with open(path + '.txt', 'w') as summary_file:
+        summary_file.write(summary)
+    logger.info('GLS labelling profile %s.prof\n%s', path, summary)
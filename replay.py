@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+    replay.py
+
+    Replays the labelling of historical shipments against a local stand-in
+    for the Unibox to measure the capacity of the label pipeline.
+
+    Usage::
+
+        python -m trytond.modules.shipping_gls.replay -c trytond.conf \\
+            -d <database> --concurrency 8 --limit 500 --latency 0.2
+"""
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import itertools
+import SocketServer
+
+from gls_unibox_api.api import Response
+from gls_unibox_api.tags import StartTag, EndTag
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from label_store import spool_request, map_concurrently
+
+__all__ = ['StandInHandler', 'StandInUnibox', 'replay', 'format_report']
+
+#: Stages of the pipeline, in order
+STAGES = ['prepare', 'request', 'store']
+
+
+class StandInHandler(SocketServer.BaseRequestHandler):
+    """
+    Answers each label request with a small label and a new tracking number
+    per parcel after the latency of the server, and acknowledges each void
+    request
+    """
+
+    def _read_request(self):
+        request = ''
+        while EndTag.code not in request:
+            data = self.request.recv(4096)
+            if not data:
+                break
+            request += data
+        return Response.parse(request).values
+
+    def _get_parcels(self, tags):
+        """
+        Returns the parcel indexes of the labels to answer, in order
+        """
+        if tags.get('T8904') == '0':
+            # Multi-parcel request
+            return range(1, int(tags.get('T8905', 1)) + 1)
+        return [tags.get('T8904', '')]
+
+    def _get_tracking_number(self):
+        return 'R%09d' % next(self.server.tracking_numbers)
+
+    def _get_void_tags(self, tags):
+        """
+        Returns the tags of the response to the void request
+        """
+        return ['T000:%s' % tags['T000']]
+
+    def _get_label_tags(self, tags, parcel, tracking_number):
+        """
+        Returns the tags of the response for the label of the parcel
+        """
+        return [
+            'T8913:%s' % tracking_number,
+            'T400:%s' % tags.get('T400', ''),
+            'T8904:%s' % parcel,
+        ]
+
+    def handle(self):
+        tags = self._read_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if 'T000' in tags:
+            # Void request
+            self.request.sendall(
+                StartTag.code + '|'.join(self._get_void_tags(tags)) + '|' +
+                EndTag.code
+            )
+            return
+        for parcel in self._get_parcels(tags):
+            tracking_number = self._get_tracking_number()
+            self.request.sendall(
+                '^XA^FO50,50^FD%s^FS^XZ' % tracking_number + StartTag.code +
+                '|'.join(
+                    self._get_label_tags(tags, parcel, tracking_number)
+                ) + '|' + EndTag.code
+            )
+
+
+class StandInUnibox(SocketServer.ThreadingTCPServer):
+    """
+    Local stand-in for the Unibox serving from a background thread
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, handler=StandInHandler):
+        """
+        :param latency: Seconds taken to answer each request
+        :param handler: Subclass of StandInHandler answering the requests
+        """
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), handler
+        )
+        self.latency = latency
+        self.tracking_numbers = itertools.count(1)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def percentile(values, rank):
+    """
+    Returns the nearest rank percentile of the sorted values
+    """
+    if not values:
+        return None
+    index = max(int(round(rank / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def _prepare(shipments):
+    """
+    Builds the requests of the shipments and returns them as a list of
+    tuples (shipment, packages, client, tags, seconds)
+    """
+    requests = []
+    for shipment in shipments:
+        start = time.time()
+        shipment_requests = shipment._get_gls_label_requests()
+        # Requests of a shipment are built together, they share the time
+        seconds = (time.time() - start) / (len(shipment_requests) or 1)
+        requests.extend(
+            (shipment,) + request + (seconds,)
+            for request in shipment_requests
+        )
+    return requests
+
+
+def _send(requests, db_name, filestore, concurrency):
+    """
+    Sends the requests concurrently and returns, for each of them, either
+    the tuple (labels, seconds) or the exception raised
+    """
+    def send(request):
+        _, packages, client, tags, _ = request
+        start = time.time()
+        labels = spool_request(
+            client, tags, db_name, len(packages), filestore
+        )
+        return labels, time.time() - start
+
+    return map_concurrently(send, requests, concurrency)
+
+
+def replay(shipments, concurrency=1, latency=0):
+    """
+    Generates again the labels of the shipments against a stand-in Unibox
+    and returns a report on the throughput of the pipeline.
+
+    The carriers are pointed to the stand-in and the labels are stored as
+    usual, so this must run in a transaction which is rolled back. The
+    labels are spooled into a temporary filestore which is removed
+    afterwards.
+
+    :param concurrency: Number of concurrent Unibox connections
+    :param latency: Seconds taken by the stand-in to answer each request
+    """
+    pool = Pool()
+    Shipment = pool.get('stock.shipment.out')
+    Carrier = pool.get('carrier')
+
+    server = StandInUnibox(latency)
+    server.start()
+    filestore = tempfile.mkdtemp(prefix='gls-replay-')
+    try:
+        shipments = [s for s in shipments if s.is_gls_shipping]
+        Carrier.write(list(set(s.carrier for s in shipments)), {
+            'gls_server': '127.0.0.1',
+            'gls_port': str(server.port),
+        })
+        shipments = Shipment.browse(map(int, shipments))
+
+        start = time.time()
+        Shipment._prefetch_gls_label_data(shipments)
+        requests = _prepare(shipments)
+        results = _send(
+            requests, Transaction().cursor.dbname, filestore, concurrency
+        )
+        store = time.time()
+        with Transaction().set_context(gls_filestore=filestore):
+            Shipment._store_gls_labels(_get_labels(requests, results))
+        store = time.time() - store
+        elapsed = time.time() - start
+    finally:
+        server.stop()
+        shutil.rmtree(filestore)
+    return _get_report(requests, results, store, elapsed)
+
+
+def _get_labels(requests, results):
+    """
+    Returns the labels of the requests which succeeded as a list of tuples
+    (shipment, package, response, digest, collision)
+    """
+    labels = []
+    for (shipment, packages, _, _, _), result in zip(requests, results):
+        if not isinstance(result, Exception):
+            labels.extend(
+                (shipment, package) + label for package, label
+                in shipment._match_gls_labels(packages, result[0])
+            )
+    return labels
+
+
+def _get_report(requests, results, store, elapsed):
+    """
+    Returns the report of the replay as a dictionary. The latency of a label
+    is the one of its request.
+    """
+    succeeded = [
+        (request, result) for request, result in zip(requests, results)
+        if not isinstance(result, Exception)
+    ]
+    labels = sum(len(request[1]) for request, _ in succeeded)
+    # Labels are stored in bulk, so each one is given an equal share
+    store_share = store / labels if labels else 0
+    stages = {
+        'prepare': sum(r[4] for r in requests),
+        'request': sum(result[1] for _, result in succeeded),
+        'store': store,
+    }
+    latencies = sorted(
+        request[4] + result[1] + store_share * len(request[1])
+        for request, result in succeeded
+        for _ in request[1]
+    )
+    return {
+        'shipments': len(set(request[0] for request in requests)),
+        'labels': labels,
+        'errors': sum(len(r[1]) for r in requests) - labels,
+        'elapsed': elapsed,
+        'labels_per_minute': labels * 60.0 / elapsed if elapsed else None,
+        'latency': dict(
+            ('p%s' % rank, percentile(latencies, rank))
+            for rank in (50, 90, 99, 100)
+        ),
+        'stages': stages,
+    }
+
+
+def format_report(report):
+    """
+    Returns the report as text
+    """
+    lines = [
+        'Shipments: %(shipments)s, labels: %(labels)s, errors: %(errors)s'
+        % report,
+        'Elapsed: %.2fs, throughput: %.1f labels/minute' % (
+            report['elapsed'], report['labels_per_minute'] or 0
+        ),
+        'Latency: ' + ', '.join(
+            '%s %.3fs' % (rank, report['latency'][rank] or 0)
+            for rank in ('p50', 'p90', 'p99', 'p100')
+        ),
+    ]
+    total = sum(report['stages'].values()) or 1
+    for stage in STAGES:
+        seconds = report['stages'][stage]
+        lines.append('%-8s %8.3fs %5.1f%%' % (
+            stage, seconds, seconds * 100 / total
+        ))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-c', '--config', dest='config', required=True)
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument(
+        '--limit', type=int, default=100,
+        help="Number of the most recent labelled shipments to replay"
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help="Seconds taken by the stand-in to answer each request"
+    )
+    options = parser.parse_args(argv)
+
+    config.update_etc(options.config)
+
+    Pool.start()
+    pool = Pool(options.database)
+    pool.init()
+
+    with Transaction().start(options.database, 0):
+        try:
+            Shipment = pool.get('stock.shipment.out')
+            shipments = Shipment.search([
+                ('tracking_number', '!=', None),
+            ], order=[('id', 'DESC')], limit=options.limit)
+            report = replay(shipments, options.concurrency, options.latency)
+        finally:
+            Transaction().cursor.rollback()
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
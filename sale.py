@@ -7,7 +7,7 @@ from trytond.pool import PoolMeta, Pool
 from trytond.model import fields
 from trytond.pyson import Eval, Bool
 
-from shipment import GLS_SERVICES
+from shipment import GLS_SERVICES, _set_gls_defaults
 
 __all__ = ['Sale']
 __metaclass__ = PoolMeta
@@ -49,7 +49,9 @@ class Sale:
         """
         Checks if shipping is to be done using GLS
         """
-        return self.carrier and self.carrier.carrier_cost_method == 'gls'
+        Carrier = Pool().get('carrier')
+        return bool(self.carrier) and \
+            self.carrier.id in Carrier.get_gls_carrier_ids()
 
     @staticmethod
     def default_gls_shipping_service_type():
@@ -72,6 +74,10 @@ class Sale:
             self.gls_shipping_service_type = \
                 self.carrier.gls_shipping_service_type
 
+    @classmethod
+    def create(cls, vlist):
+        return super(Sale, cls).create(_set_gls_defaults(cls, vlist))
+
     def _get_shipment_sale(self, Shipment, key):
         """
         Downstream implementation which adds gls-specific fields to the unsaved
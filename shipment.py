@@ -3,17 +3,42 @@
     carrier.py
 
 """
-from gls_unibox_api.api import Response, Shipment
+import zlib
+import hashlib
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from gls_unibox_api.api import Shipment, Consignor
+from gls_unibox_api.tags import CancelParcel
+from sql import Null, Literal, Cast
+from sql.operators import Concat
+from sql.conditionals import Case, Coalesce
+from sql.functions import Now, Function
 from random import randint
 
+from trytond import backend
 from trytond.pool import PoolMeta, Pool
-from trytond.model import fields, ModelView
+from trytond.model import fields, ModelView, ModelSQL
 from trytond.wizard import Wizard, StateView, Button
 from trytond.pyson import Eval, Bool
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.config import config
+from trytond.cache import Cache
+from trytond.tools import grouped_slice, reduce_ids
+
+from label_store import spool_request, spool_labels, send_requests, \
+    read_label, read_spooled_label, read_archived_label, LabelArchive, \
+    combine_labels, remove_labels
+from commit_hooks import after_commit
+from profiling import profiled
+from tracking import GLS_TRACKING_STATES, GLS_TRACKING_FINAL_STATES
+from unibox import labelling_deadline
 
 __all__ = [
     'ShipmentOut', 'Package', 'GenerateShippingLabel', 'ShippingGLS',
-    'Address'
+    'Address', 'GenerateGLSLabels', 'GLSLabelsSummary', 'ReprintGLSLabels',
+    'ReprintGLSLabelsStart', 'ReprintGLSLabelsResult', 'GLSLabel',
 ]
 __metaclass__ = PoolMeta
 
@@ -44,6 +69,30 @@ GLS_PRODUCT_CODES = {
     'pick_return': '89',
 }
 
+GLS_VOID_STATES = [
+    (None, ''),
+    ('voided', 'Voided'),
+    ('failed', 'Failed'),
+]
+
+GLS_PRINTER_RESOLUTIONS = [
+    ('zebrazpl200', '200dpi'),
+    ('zebrazpl300', '300dpi'),
+]
+
+#: Fields of sales and shipments defaulted from their GLS carrier
+GLS_DEFAULT_FIELDS = ['gls_shipping_depot_number', 'gls_shipping_service_type']
+
+#: Fields of the GLS label records filled from the tags of the response
+GLS_LABEL_TAGS = [
+    ('tracking_number', 'T8913'),
+    ('parcel_number', 'T400'),
+    ('depot_number', 'T101'),
+    ('hub', 'T110'),
+    ('sorting_flag', 'T310'),
+    ('bar_code', 'T300'),
+]
+
 STATES = {
     'readonly': Eval('state') == 'done',
     'required': Bool(Eval('is_gls_shipping')),
@@ -51,15 +100,333 @@ STATES = {
 
 DEPENDS = ['is_gls_shipping', 'state']
 
+# Maximum number of concurrent Unibox connections for bulk labelling
+LABEL_WORKERS = config.getint('shipping_gls', 'label_workers', default=4)
+
+# Number of parcels per tracking status query and per synchronisation run
+TRACKING_BATCH_SIZE = config.getint(
+    'shipping_gls', 'tracking_batch_size', default=50
+)
+TRACKING_SYNC_LIMIT = config.getint(
+    'shipping_gls', 'tracking_sync_limit', default=10000
+)
+
+# Age in days of the labels moved to the archive and number of labels moved
+# per archival run
+LABEL_ARCHIVE_DAYS = config.getint(
+    'shipping_gls', 'label_archive_days', default=365
+)
+LABEL_ARCHIVE_LIMIT = config.getint(
+    'shipping_gls', 'label_archive_limit', default=10000
+)
+
+# Shipments labelled per pre-generation run, Unibox connections it uses,
+# seconds without labels generated by the users before it runs and failures
+# after which a shipment is left to the users
+PREGENERATE_LIMIT = config.getint(
+    'shipping_gls', 'pregenerate_limit', default=20
+)
+PREGENERATE_WORKERS = config.getint(
+    'shipping_gls', 'pregenerate_workers', default=1
+)
+PREGENERATE_IDLE = config.getint(
+    'shipping_gls', 'pregenerate_idle', default=60
+)
+PREGENERATE_MAX_FAILURES = config.getint(
+    'shipping_gls', 'pregenerate_max_failures', default=3
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TryAdvisoryXactLock(Function):
+    __slots__ = ()
+    _function = 'PG_TRY_ADVISORY_XACT_LOCK'
+
+
+def _prefetch(records, paths):
+    """
+    Reads the dotted field paths on all the records
+    """
+    for record in records:
+        for path in paths:
+            value = record
+            for name in path.split('.'):
+                value = getattr(value, name)
+                if value is None:
+                    break
+
+
+def _set_gls_defaults(Model, vlist):
+    """
+    Returns the values of the records to create with the GLS depot number
+    and service type of their GLS carrier where they are not given, reading
+    all the carriers at once. The records created without a carrier get the
+    default one of the model first.
+    """
+    Carrier = Pool().get('carrier')
+
+    vlist = _set_default_carrier(Model, vlist)
+    carrier_ids = Carrier.get_gls_carrier_ids().intersection(
+        values.get('carrier') for values in vlist
+    )
+    if not carrier_ids:
+        return vlist
+    carriers = dict(
+        (carrier.id, carrier) for carrier in Carrier.browse(list(carrier_ids))
+    )
+
+    vlist = [values.copy() for values in vlist]
+    for values in vlist:
+        carrier = carriers.get(values.get('carrier'))
+        for name in GLS_DEFAULT_FIELDS:
+            if carrier and not values.get(name):
+                values[name] = getattr(carrier, name)
+    return vlist
+
+
+def _set_default_carrier(Model, vlist):
+    """
+    Returns the values of the records to create with the default carrier of
+    the model where no carrier is given
+    """
+    if all('carrier' in values for values in vlist):
+        return vlist
+    carrier = Model.default_get(['carrier'], with_rec_name=False).get(
+        'carrier'
+    )
+    if carrier is None:
+        return vlist
+    return [
+        dict(values, carrier=values.get('carrier', carrier))
+        for values in vlist
+    ]
+
+
+def _touch(Model, records):
+    """
+    Checks the write access to the records once their columns have been
+    updated in SQL and drops them from the caches of the transaction.
+
+    This is the write of ModelStorage: the one of ModelSQL would validate
+    each record again, which searches the models of its references.
+    """
+    super(ModelSQL, Model).write(list(records), {})
+
+
+def _has_returning(cursor):
+    """
+    Tells if the database returns the inserted rows, which SQLite does
+    since 3.35 although the backend of trytond only knows about PostgreSQL
+    """
+    if backend.name() == 'sqlite':
+        from trytond.backend.sqlite.database import sqlite
+        return sqlite.sqlite_version_info >= (3, 35, 0)
+    return cursor.has_returning()
+
+
+def _insert_returning(table, columns, values):
+    """
+    Inserts the rows of values into the table and returns their ids, in
+    order, with a single query where the database supports RETURNING
+    """
+    cursor = Transaction().cursor
+    if _has_returning(cursor):
+        cursor.execute(*table.insert(
+            columns, values, returning=[table.id]
+        ))
+        return [id_ for id_, in cursor.fetchall()]
+    ids = []
+    for row in values:
+        cursor.execute(*table.insert(columns, [row]))
+        ids.append(cursor.lastid())
+    return ids
+
+
+def _remove_unreferenced_labels(labels):
+    """
+    Removes the files of the labels from the filestore once the transaction
+    is committed, unless an attachment still refers to them, as deleting the
+    attachments leaves their files. The files are kept if the transaction is
+    rolled back, since its attachments are then restored.
+
+    :param labels: List of tuples (digest, collision) of the labels
+    """
+    labels = set((digest, collision or 0) for digest, collision in labels)
+    if labels:
+        after_commit(_remove_label_files, labels)
+
+
+def _remove_label_files(labels):
+    """
+    Removes the files of the labels which no attachment refers to from the
+    filestore. All the attachments are looked at, whatever the access of
+    the user.
+
+    :param labels: Set of tuples (digest, collision) of the labels
+    """
+    Attachment = Pool().get('ir.attachment')
+    attachment = Attachment.__table__()
+    cursor = Transaction().cursor
+
+    referenced = set()
+    for sub_labels in grouped_slice(labels):
+        cursor.execute(*attachment.select(
+            attachment.digest, attachment.collision,
+            where=attachment.digest.in_(
+                [digest for digest, _ in sub_labels]
+            )
+        ))
+        referenced.update(
+            (digest, collision or 0)
+            for digest, collision in cursor.fetchall()
+        )
+    remove_labels(cursor.dbname, labels - referenced)
+
 
 class Package:
     __name__ = 'stock.package'
 
-    def _get_shipment_object(self):
+    gls_tracking_state = fields.Selection(
+        GLS_TRACKING_STATES, 'GLS Tracking State', readonly=True, select=True
+    )
+    gls_tracking_status = fields.Char('GLS Tracking Status', readonly=True)
+    gls_tracking_event_date = fields.DateTime(
+        'GLS Last Tracking Event', readonly=True
+    )
+    gls_tracking_checked = fields.DateTime(
+        'GLS Tracking Checked', readonly=True, select=True
+    )
+    gls_void_state = fields.Selection(
+        GLS_VOID_STATES, 'GLS Void State', readonly=True
+    )
+    gls_void_message = fields.Char('GLS Void Message', readonly=True)
+    gls_labels = fields.One2Many(
+        'stock.package.gls.label', 'package', 'GLS Labels', readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(Package, cls).__setup__()
+        # Indexed for the incremental refresh of the GLS statistics
+        cls.create_date.select = True
+        cls.write_date.select = True
+
+    @classmethod
+    def _get_gls_tracking_packages(cls, limit):
+        """
+        Returns the packages of outgoing GLS shipments to poll, which are
+        not in a final tracking state. The ones never checked come first,
+        then the least recently checked.
+        """
+        Carrier = Pool().get('carrier')
+
+        domain = [
+            ('shipment.carrier', 'in', list(Carrier.get_gls_carrier_ids()),
+                'stock.shipment.out'),
+            ('tracking_number', '!=', None),
+            [
+                'OR',
+                ('gls_tracking_state', '=', None),
+                ('gls_tracking_state', 'not in', GLS_TRACKING_FINAL_STATES),
+            ],
+        ]
+        packages = cls.search(
+            domain + [('gls_tracking_checked', '=', None)], limit=limit
+        )
+        if len(packages) < limit:
+            packages += cls.search(
+                domain + [('gls_tracking_checked', '!=', None)],
+                order=[('gls_tracking_checked', 'ASC')],
+                limit=limit - len(packages)
+            )
+        return packages
+
+    @classmethod
+    def sync_gls_tracking(cls):
+        """
+        Polls GLS for the tracking status of the parcels which are not
+        delivered yet and stores the changes.
+
+        This method is called by the scheduler.
+        """
+        packages_by_carrier = defaultdict(list)
+        for package in cls._get_gls_tracking_packages(TRACKING_SYNC_LIMIT):
+            packages_by_carrier[package.shipment.carrier].append(package)
+
+        for carrier, packages in packages_by_carrier.iteritems():
+            cls._sync_gls_tracking(
+                carrier.get_gls_tracking_client(), packages
+            )
+
+    @staticmethod
+    def _get_gls_tracking_statuses(client, packages):
+        """
+        Returns the tracking statuses of the packages or None if the query
+        failed, in which case the packages are polled again on the next run.
+        """
+        try:
+            return client.get_statuses(
+                [package.tracking_number for package in packages]
+            )
+        except (IOError, ValueError):
+            logger.warning('GLS tracking query failed', exc_info=True)
+
+    @classmethod
+    def _get_gls_tracking_changes(cls, client, packages):
+        """
+        Queries the tracking status of the packages by batches and returns
+        the tuple (changes, checked) where changes maps the new tracking
+        values to the packages and checked lists the packages polled.
+        """
+        changes = defaultdict(list)
+        checked = []
+        for index in range(0, len(packages), TRACKING_BATCH_SIZE):
+            batch = packages[index:index + TRACKING_BATCH_SIZE]
+            statuses = cls._get_gls_tracking_statuses(client, batch)
+            if statuses is None:
+                continue
+            checked.extend(batch)
+            for package in batch:
+                values = statuses.get(package.tracking_number)
+                if values and values != (
+                        package.gls_tracking_state,
+                        package.gls_tracking_status,
+                        package.gls_tracking_event_date):
+                    changes[values].append(package)
+        return changes, checked
+
+    @classmethod
+    def _sync_gls_tracking(cls, client, packages):
+        """
+        Synchronises the tracking status of the packages using the client
+        and writes all the changes in bulk.
+        """
+        changes, checked = cls._get_gls_tracking_changes(client, packages)
+
+        to_write = []
+        for (state, status, event_date), records in changes.iteritems():
+            to_write.extend((records, {
+                'gls_tracking_state': state,
+                'gls_tracking_status': status,
+                'gls_tracking_event_date': event_date,
+            }))
+        if checked:
+            to_write.extend((checked, {
+                'gls_tracking_checked': datetime.utcnow(),
+            }))
+        if to_write:
+            cls.write(*to_write)
+
+    def _get_shipment_object(self, shipment=None):
         """
         This method returns a Shipment object for consumption by the GLS API
+
+        :param shipment: The shipment of the package, pass it when it has
+                         been prefetched to avoid reading it again
         """
-        shipment = self.shipment
+        if shipment is None:
+            shipment = self.shipment
 
         client = shipment.carrier.get_unibox_client()
         shipment_api = Shipment(client)
@@ -69,17 +436,17 @@ class Package:
         shipment_api.printer_name = shipment.carrier.gls_printer_resolution
 
         consignee_address = shipment.delivery_address
-        consignor_address = shipment._get_ship_from_address()
 
         consignee_address._update_gls_address_in(
             shipment_api.consignee)
         shipment_api.shipping_date = shipment.effective_date
 
-        shipment_api.consignor.customer_number = shipment.carrier.gls_customer_number  # noqa
-        consignor_address._update_gls_address_in(
-            shipment_api.consignor)
-        shipment_api.consignor.label = shipment.carrier.gls_consignor_label  # German for 'recipient' # noqa
-        shipment_api.consignor.consignor = shipment.carrier.party.name  # Shipment deliverer # noqa
+        contract, customer_id, customer_number = \
+            shipment._get_gls_credentials()
+        shipment_api.consignor.values.update(
+            shipment._get_gls_consignor_values()
+        )
+        shipment_api.consignor.customer_number = customer_number
 
         shipment_api.consignee.customer_number_label = shipment.carrier.gls_customer_label  # Labeling of customer number # noqa
         shipment_api.consignee.customer_number = shipment.customer.id  # optional customer number # noqa
@@ -91,12 +458,253 @@ class Package:
 
         shipment_api.parcel_number = shipment.gls_parcel_number
 
-        shipment_api.gls_contract = shipment.carrier.gls_contract
-        shipment_api.gls_customer_id = shipment.carrier.gls_customer_id
+        shipment_api.gls_contract = contract
+        shipment_api.gls_customer_id = customer_id
         shipment_api.location = shipment.carrier.gls_location
 
         return shipment_api
 
+    def get_gls_label(self, resolution=None):
+        """
+        Returns the stored ZPL label of the package without calling GLS
+
+        :param resolution: Printer resolution to convert the label to
+        """
+        return self.shipment.get_gls_labels(resolution, [self])[0]
+
+
+class GLSLabel(ModelSQL, ModelView):
+    "GLS Label"
+    __name__ = 'stock.package.gls.label'
+
+    package = fields.Many2One(
+        'stock.package', 'Package', required=True, readonly=True,
+        select=True, ondelete='CASCADE'
+    )
+    shipment = fields.Many2One(
+        'stock.shipment.out', 'Shipment', readonly=True, select=True,
+        ondelete='CASCADE'
+    )
+    parcel_index = fields.Integer('Parcel Index', readonly=True)
+    tracking_number = fields.Char(
+        'Tracking Number', readonly=True, select=True
+    )
+    parcel_number = fields.Char('Parcel Number', readonly=True, select=True)
+    depot_number = fields.Char('Depot Number', readonly=True)
+    hub = fields.Char('Hub', readonly=True)
+    sorting_flag = fields.Char('Sorting Flag', readonly=True)
+    bar_code = fields.Char('Bar Code', readonly=True)
+    resolution = fields.Selection(
+        GLS_PRINTER_RESOLUTIONS, 'Printer Resolution', readonly=True
+    )
+    attachment = fields.Many2One(
+        'ir.attachment', 'Label', readonly=True, ondelete='SET NULL'
+    )
+    attachment_offset = fields.Integer(
+        'Attachment Offset', readonly=True,
+        help="Position of the label in the combined labels of the shipment"
+    )
+    attachment_size = fields.Integer('Attachment Size', readonly=True)
+    response = fields.Text(
+        'Response', readonly=True, help="All the tags returned by GLS"
+    )
+    archive = fields.Char(
+        'Archive', readonly=True,
+        help="Archive file the label was moved to"
+    )
+    archive_offset = fields.Integer('Archive Offset', readonly=True)
+    archive_size = fields.Integer('Archive Size', readonly=True)
+    active = fields.Boolean('Active', readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(GLSLabel, cls).__setup__()
+        cls._order.insert(0, ('parcel_index', 'ASC'))
+
+    @staticmethod
+    def default_active():
+        return True
+
+    def get_label(self, resolution=None):
+        """
+        Returns the ZPL label from its attachment or from the archive, or
+        None if it has neither
+
+        :param resolution: Printer resolution to convert the label to
+        """
+        target = resolution or self.resolution
+        if self.attachment and self.attachment_offset is not None:
+            return read_spooled_label(
+                Transaction().cursor.dbname, self.attachment.digest,
+                self.attachment.collision, self.resolution, target,
+                self.attachment_offset, self.attachment_size
+            )
+        if self.attachment:
+            return read_label(self.attachment, self.resolution, target)
+        if self.archive:
+            return read_archived_label(
+                Transaction().cursor.dbname, self.archive,
+                self.archive_offset, self.archive_size,
+                self.resolution, target
+            )
+
+    @classmethod
+    def get_label_by_number(cls, number, resolution=None):
+        """
+        Returns the ZPL label, voided or not, with the tracking or parcel
+        number, or None if there is none
+        """
+        with Transaction().set_context(active_test=False):
+            records = cls.search([
+                'OR',
+                ('tracking_number', '=', number),
+                ('parcel_number', '=', number),
+            ], order=[('id', 'DESC')], limit=1)
+        if records:
+            return records[0].get_label(resolution)
+
+    @classmethod
+    def archive_labels(cls, days=None):
+        """
+        Moves the labels older than days into an archive file of the day
+        and deletes their attachments, and their files once the transaction
+        is committed. The records keep the position of their label in the
+        archive.
+
+        This method is called by the scheduler.
+
+        :param days: Defaults to LABEL_ARCHIVE_DAYS
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        ModelFieldAccess = pool.get('ir.model.field.access')
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        if days is None:
+            days = LABEL_ARCHIVE_DAYS
+        before = datetime.now() - timedelta(days=days)
+        cls._create_legacy_label_records(before)
+        with Transaction().set_context(active_test=False):
+            records = cls.search([
+                ('attachment', '!=', None),
+                ('create_date', '<', before),
+            ], order=[('id', 'ASC')], limit=LABEL_ARCHIVE_LIMIT)
+        if not records:
+            return
+
+        ModelFieldAccess.check(cls.__name__, [
+            'attachment', 'archive', 'archive_offset', 'archive_size',
+        ], 'write')
+        attachments = list(set(record.attachment for record in records))
+        name = 'labels-%s.gz' % datetime.now().strftime('%Y%m%d')
+        entries = LabelArchive(cursor.dbname).append(
+            name, cls._get_archive_data(records)
+        )
+        # Each record takes up to 5 parameters of the queries
+        for sub_records in grouped_slice(
+                zip(records, entries), cursor.IN_MAX // 6):
+            sub_records = list(sub_records)
+            ids = [record.id for record, _ in sub_records]
+            cursor.execute(*table.update([
+                table.attachment, table.archive,
+                table.archive_offset, table.archive_size,
+                table.write_uid, table.write_date,
+            ], [
+                Null, name,
+                Case(*[
+                    (table.id == record.id, offset)
+                    for record, (offset, _) in sub_records
+                ]),
+                Case(*[
+                    (table.id == record.id, size)
+                    for record, (_, size) in sub_records
+                ]),
+                Transaction().user, Now(),
+            ], where=reduce_ids(table.id, ids)))
+        _touch(cls, records)
+
+        # Combined labels of a shipment may not all have been archived yet
+        with Transaction().set_context(active_test=False):
+            kept = set(record.attachment for record in cls.search([
+                ('attachment', 'in', map(int, attachments)),
+            ]))
+        to_delete = [a for a in attachments if a not in kept]
+        files = [(a.digest, a.collision) for a in to_delete]
+        Attachment.delete(to_delete)
+        _remove_unreferenced_labels(files)
+
+    @classmethod
+    def _create_legacy_label_records(cls, before):
+        """
+        Creates the records of the labels of the packages of GLS shipments
+        labelled before the records existed, from their attachments created
+        before the given time, so that they are archived like the others.
+
+        The attachments are the ones named after the tracking number of a
+        package of their shipment. The records are given the creation date
+        of their attachment.
+        """
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        Package = pool.get('stock.package')
+        Carrier = pool.get('carrier')
+        Attachment = pool.get('ir.attachment')
+        ModelAccess = pool.get('ir.model.access')
+        table = cls.__table__()
+        label = cls.__table__()
+        shipment = Shipment.__table__()
+        package = Package.__table__()
+        carrier = Carrier.__table__()
+        attachment = Attachment.__table__()
+
+        carrier_ids = list(Carrier.get_gls_carrier_ids())
+        if not carrier_ids:
+            return
+        ModelAccess.check(cls.__name__, 'create')
+        query = shipment.join(
+            carrier, condition=shipment.carrier == carrier.id
+        ).join(
+            package, condition=package.shipment == Concat(
+                Shipment.__name__ + ',', Cast(shipment.id, 'VARCHAR')
+            )
+        ).join(
+            attachment, condition=(attachment.resource == package.shipment)
+            & attachment.name.like(Concat(package.tracking_number, '_%'))
+        ).join(
+            label, 'LEFT', condition=label.package == package.id
+        ).select(
+            Literal(Transaction().user), attachment.create_date, Literal(True),
+            package.id, shipment.id, package.tracking_number,
+            carrier.gls_printer_resolution, attachment.id,
+            where=shipment.carrier.in_(carrier_ids)
+            & (package.tracking_number != Null)
+            & (attachment.create_date < before)
+            & (label.id == Null),
+            order_by=[attachment.id.asc], limit=LABEL_ARCHIVE_LIMIT
+        )
+        Transaction().cursor.execute(*table.insert([
+            table.create_uid, table.create_date, table.active, table.package,
+            table.shipment, table.tracking_number, table.resolution,
+            table.attachment,
+        ], query))
+
+    @staticmethod
+    def _get_archive_data(records):
+        """
+        Yields the label of each record from its attachment, reading each
+        combined document once
+        """
+        data = {}
+        for record in records:
+            if record.attachment.id not in data:
+                data = {record.attachment.id: str(record.attachment.data)}
+            label = data[record.attachment.id]
+            if record.attachment_offset is not None:
+                offset = record.attachment_offset
+                label = label[offset:offset + record.attachment_size]
+            yield label
+
 
 class ShipmentOut:
     __name__ = 'stock.shipment.out'
@@ -121,6 +729,31 @@ class ShipmentOut:
         readonly=True
     )
 
+    gls_account = fields.Many2One(
+        'carrier.gls.account', 'GLS Account', readonly=True,
+        domain=[('carrier', '=', Eval('carrier'))], depends=['carrier'],
+        help="Account the labels were generated with"
+    )
+
+    _gls_consignor_cache = Cache(
+        'stock.shipment.out.gls_consignor',
+        size_limit=config.getint(
+            'shipping_gls', 'consignor_cache_size', default=1024
+        ),
+        context=False
+    )
+
+    gls_label_failures = fields.Integer(
+        "GLS Label Failures", readonly=True,
+        help="Number of times the labels could not be generated"
+    )
+
+    gls_label_key = fields.Char(
+        "GLS Label Key", readonly=True,
+        help="Digest of the carrier, service, depot and package weights the "
+        "labels were generated with"
+    )
+
     @classmethod
     def view_attributes(cls):
         return super(ShipmentOut, cls).view_attributes() + [
@@ -131,6 +764,9 @@ class ShipmentOut:
     @classmethod
     def __setup__(cls):
         super(ShipmentOut, cls).__setup__()
+        # Indexed for the incremental refresh of the GLS statistics
+        cls.create_date.select = True
+        cls.write_date.select = True
 
         cls._sql_constraints += [
             (
@@ -138,6 +774,36 @@ class ShipmentOut:
                 'The parcel number must be unique'
             )
         ]
+        cls._buttons.update({
+            'reprint_gls_labels': {
+                'invisible': ~Bool(Eval('tracking_number'))
+                | ~Bool(Eval('is_gls_shipping')),
+            },
+            'void_gls_labels': {
+                'invisible': ~Bool(Eval('tracking_number'))
+                | ~Bool(Eval('is_gls_shipping')),
+            },
+        })
+        cls._error_messages.update({
+            'gls_label_not_found': 'No GLS label found for package %s',
+            'gls_void_request_failed':
+                'Void request for package %s failed: %s',
+            'gls_void_not_confirmed':
+                'GLS did not confirm the cancellation: %s',
+            'gls_label_request_failed':
+                'Label request for package %s failed: %s',
+            'gls_no_tracking_number':
+                'GLS did not return a tracking number for package %s',
+            'gls_labels_in_progress':
+                'The GLS labels of shipment "%s" are already being '
+                'generated',
+            'gls_wrong_label_count':
+                'GLS returned %(labels)s labels for the %(packages)s '
+                'packages of shipment "%(shipment)s"',
+            'gls_outdated_labels':
+                'The GLS labels of shipment "%s" were generated with other '
+                'values and could not be voided',
+        })
 
     @staticmethod
     def default_gls_shipping_service_type():
@@ -147,7 +813,21 @@ class ShipmentOut:
         """
         Checks if shipping is to be done using GLS
         """
-        return self.carrier and self.carrier.carrier_cost_method == 'gls'
+        Carrier = Pool().get('carrier')
+        return bool(self.carrier) and \
+            self.carrier.id in Carrier.get_gls_carrier_ids()
+
+    def allow_label_generation(self):
+        """
+        Lets the label wizard return the labels generated ahead for the
+        shipment, as long as they were generated with its current values
+        """
+        if (self.tracking_number and self.is_gls_shipping
+                and self.gls_label_key == self._get_gls_label_key()):
+            if self.state not in ('packed', 'done'):
+                self.raise_user_error('invalid_state')
+            return True
+        return super(ShipmentOut, self).allow_label_generation()
 
     @fields.depends(
         'is_gls_shipping', 'carrier', 'gls_shipping_depot_number',
@@ -166,15 +846,116 @@ class ShipmentOut:
             self.gls_shipping_service_type = \
                 self.carrier.gls_shipping_service_type
 
+    @classmethod
+    def create(cls, vlist):
+        return super(ShipmentOut, cls).create(_set_gls_defaults(cls, vlist))
+
+    @classmethod
+    def write(cls, *args):
+        Statistic = Pool().get('stock.shipment.out.gls.statistic')
+
+        dates = []
+        actions = iter(args)
+        for shipments, values in zip(actions, actions):
+            dates.extend(cls._get_gls_left_dates(shipments, values))
+        super(ShipmentOut, cls).write(*args)
+        Statistic.mark_stale(dates)
+
+    @classmethod
+    def delete(cls, shipments):
+        Statistic = Pool().get('stock.shipment.out.gls.statistic')
+
+        dates = [
+            s.effective_date or s.planned_date for s in shipments
+            if s.is_gls_shipping
+        ]
+        super(ShipmentOut, cls).delete(shipments)
+        Statistic.mark_stale(filter(None, dates))
+
+    @staticmethod
+    def _get_gls_left_dates(shipments, values):
+        """
+        Returns the dates of the statistics which the GLS shipments leave
+        when values are written on them
+        """
+        if 'effective_date' not in values and 'planned_date' not in values:
+            return []
+        dates = []
+        for shipment in shipments:
+            date = shipment.effective_date or shipment.planned_date
+            new_date = values.get('effective_date', shipment.effective_date) \
+                or values.get('planned_date', shipment.planned_date)
+            if shipment.is_gls_shipping and date and date != new_date:
+                dates.append(date)
+        return dates
+
     def _get_weight_uom(self):
         """
         Return uom for GLS
+
+        The kilogram is looked up by its XML id, whose database id is cached
+        per database by ir.model.data, rather than searched on each call.
         """
-        UOM = Pool().get('product.uom')
+        pool = Pool()
+        UOM = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
         if self.is_gls_shipping:
-            return UOM.search([('symbol', '=', 'kg')])[0]
+            return UOM(ModelData.get_id('product', 'uom_kilogram'))
         return super(ShipmentOut, self)._get_weight_uom()  # pragma: no cover
 
+    def _get_gls_consignor_values(self):
+        """
+        Returns the tags of the consignor section of the requests, which
+        only depends on the warehouse address and the carrier.
+
+        The section is built once per process and revision of the records it
+        is built from.
+        """
+        address = self._get_ship_from_address()
+        carrier = self.carrier
+        key = tuple(
+            (record.id, record.write_date or record.create_date)
+            for record in (address, address.party, carrier, carrier.party)
+        )
+        values = self._gls_consignor_cache.get(key)
+        if values is None:
+            consignor = address._update_gls_address_in(Consignor())
+            consignor.label = carrier.gls_consignor_label  # German for 'recipient' # noqa
+            consignor.consignor = carrier.party.name  # Shipment deliverer
+            values = consignor.values
+            self._gls_consignor_cache.set(key, values)
+        return values
+
+    def _get_gls_credentials(self):
+        """
+        Returns the tuple (contract, customer id, customer number) of the GLS
+        account of the shipment, or of its carrier if it has none
+        """
+        if self.gls_account:
+            account = self.gls_account
+            return (
+                account.contract, account.customer_id, account.customer_number
+            )
+        carrier = self.carrier
+        return (
+            carrier.gls_contract, carrier.gls_customer_id,
+            carrier.gls_customer_number
+        )
+
+    @classmethod
+    def _assign_gls_accounts(cls, shipments):
+        """
+        Spreads the shipments over the GLS accounts of their carriers
+        """
+        shipments_by_carrier = defaultdict(list)
+        for shipment in shipments:
+            shipments_by_carrier[shipment.carrier].append(shipment)
+
+        for carrier, carrier_shipments in shipments_by_carrier.iteritems():
+            accounts = carrier.pick_gls_accounts(len(carrier_shipments))
+            for shipment, account in zip(carrier_shipments, accounts):
+                shipment.gls_account = account
+
     def _gen_parcel_check_number(self, parcel_number):
         """
         This method is used to calculate the check digit that is required at
@@ -195,11 +976,9 @@ class ShipmentOut:
         # Increment by 1
         sum_ += 1
 
-        # Find next multiple of 10
-        next_multiple = ((sum_ // 10) + 1) * 10
-
-        # Subtract sum from this multiple
-        return str(next_multiple - sum_)
+        # Subtract sum from the next multiple of 10, the check digit is 0
+        # when the sum is already a multiple of 10
+        return str((10 - sum_ % 10) % 10)
 
     def _gen_parcel_number(self):
         """
@@ -232,49 +1011,945 @@ class ShipmentOut:
         This method generates labels for each package/parcel in the given
         shipment.
         """
-        if self.state not in ('packed', 'done'):
-            self.raise_user_error('invalid_state')
+        with profiled(
+            Transaction().cursor.dbname, 'shipment-%s' % self.id,
+            self._is_gls_profiled([self])
+        ):
+            if self._lock_gls_labels([self]):
+                self.raise_user_error('gls_labels_in_progress', self.rec_name)
 
-        if not self.is_gls_shipping:
-            self.raise_user_error('wrong_carrier', 'GLS')
+            if self.state not in ('packed', 'done'):
+                self.raise_user_error('invalid_state')
 
-        self.gls_parcel_number = self._gen_parcel_number()
-        self.save()
+            if not self.is_gls_shipping:
+                self.raise_user_error('wrong_carrier', 'GLS')
 
-        if not self.tracking_number:
+            if self.tracking_number and self._keep_gls_labels():
+                return
+
+            self.gls_parcel_number = self._gen_parcel_number()
+            self._assign_gls_accounts([self])
+            self.save()
             tracking_number = self._make_gls_label()
             self.tracking_number = tracking_number.strip()
-        self.save()
+            self.gls_label_key = self._get_gls_label_key()
+            self.save()
+
+    def _get_gls_label_key(self):
+        """
+        Returns a digest of the values the labels of the shipment are
+        generated with
+        """
+        values = [
+            self.carrier.id, self.gls_shipping_service_type,
+            self.gls_shipping_depot_number,
+        ] + ['%s:%s' % (p.id, p.weight) for p in self.packages]
+        return hashlib.md5(
+            '|'.join(map(unicode, values)).encode('utf-8')
+        ).hexdigest()
+
+    def _keep_gls_labels(self):
+        """
+        Returns whether the labels of the shipment are kept as they are.
+        Labels generated ahead are queued to the printer then, while the
+        ones of shipments labelled before the label key existed, or whose
+        tracking number was set by hand, are left alone.
+
+        The labels generated ahead are voided instead if the carrier,
+        service, depot or package weights of the shipment changed since, for
+        instance in the label wizard.
+        """
+        if self.gls_label_key is None:
+            return True
+        if self.gls_label_key == self._get_gls_label_key():
+            self._print_stored_gls_labels()
+            return True
+        self.void_gls_labels([self])
+        if self.__class__(self.id).tracking_number:
+            self.raise_user_error('gls_outdated_labels', self.rec_name)
+        return False
+
+    @staticmethod
+    def _is_gls_profiled(shipments):
+        """
+        Returns whether the labelling of the shipments is profiled, which is
+        enabled by the carriers or the context
+        """
+        return bool(Transaction().context.get('gls_profile') or any(
+            s.carrier and s.carrier.gls_profile for s in shipments
+        ))
+
+    @classmethod
+    def _lock_gls_labels(cls, shipments):
+        """
+        Locks the label generation of the shipments until the end of the
+        transaction, without waiting, and returns the shipments whose labels
+        are already being generated by another transaction.
+
+        PostgreSQL advisory locks are used so that the shipments themselves
+        can still be read and written. The snapshot of the transaction may
+        have been taken before the lock was released by a transaction which
+        labelled the shipment, so the shipments whose tracking number
+        changed since are returned too. Other backends do not run
+        concurrent writing transactions, so nothing is locked.
+        """
+        if backend.name() != 'postgresql':
+            return []
+
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        lock_class = zlib.crc32(cls._table) & 0x7fffffff
+
+        locked = {}
+        for sub_ids in grouped_slice(map(int, shipments)):
+            cursor.execute(*table.select(
+                table.id, table.tracking_number,
+                TryAdvisoryXactLock(lock_class, table.id),
+                where=reduce_ids(table.id, sub_ids)
+            ))
+            locked.update(
+                (id_, number) for id_, number, success in cursor.fetchall()
+                if success
+            )
+        changed = cls._get_gls_tracking_numbers_changed(locked)
+        return [s for s in shipments if s.id not in locked or s.id in changed]
+
+    @classmethod
+    def _get_gls_tracking_numbers_changed(cls, tracking_numbers):
+        """
+        Returns the ids of the shipments whose tracking number differs from
+        the given one in a new snapshot of the database
+
+        :param tracking_numbers: Dictionary which maps the ids of shipments
+                                 to their tracking number
+        """
+        table = cls.__table__()
+
+        changed = set()
+        with Transaction().new_cursor(readonly=True) as transaction:
+            cursor = transaction.cursor
+            for sub_ids in grouped_slice(list(tracking_numbers)):
+                cursor.execute(*table.select(
+                    table.id, table.tracking_number,
+                    where=reduce_ids(table.id, sub_ids)
+                ))
+                changed.update(
+                    id_ for id_, number in cursor.fetchall()
+                    if number != tracking_numbers[id_]
+                )
+        return changed
+
+    @classmethod
+    def _get_gls_prefetch_paths(cls):
+        """
+        Returns the tuple (shipment paths, package paths) of the dotted field
+        paths read to generate labels
+        """
+        return [
+            'state', 'is_gls_shipping', 'tracking_number', 'effective_date',
+            'gls_parcel_number', 'gls_shipping_depot_number',
+            'gls_shipping_service_type', 'customer.code',
+            'carrier.party.name', 'gls_account.contract',
+            'delivery_address.party.name', 'delivery_address.country.code',
+            'warehouse.address.party.name',
+            'warehouse.address.country.code',
+        ], [
+            'code', 'weight', 'tracking_number',
+        ]
+
+    @classmethod
+    def _prefetch_gls_label_data(cls, shipments):
+        """
+        Loads all the data needed to generate the labels of the shipments
+        and their packages.
+
+        Trytond reads a field for all the records instantiated together, so
+        walking the paths over all the records costs one query per model
+        and group of fields, whatever the number of shipments and packages.
+        Later accesses on the same records are served from their cache.
+        """
+        shipment_paths, package_paths = cls._get_gls_prefetch_paths()
+        _prefetch(shipments, shipment_paths)
+        _prefetch(
+            [p for shipment in shipments for p in shipment.packages],
+            package_paths
+        )
+
+    def _get_gls_label_requests(self):
+        """
+        Returns a list of tuples (packages, client, tags) with the prepared
+        Unibox requests of the shipment: one per package, or a single one
+        for all the packages if the carrier sends multi-parcel requests.
+        """
+        packages = list(self.packages)
+        if self.carrier.gls_multi_parcel and len(packages) > 1:
+            shipment = packages[0]._get_shipment_object(self)
+            shipment.parcel = 0
+            shipment.parcel_weight = sum(p.weight or 0 for p in packages)
+            return [(packages, shipment.client, shipment.get_tags())]
+
+        requests = []
+        for index, package in enumerate(packages, start=1):
+            shipment = package._get_shipment_object(self)
+            shipment.parcel = index
+            requests.append(([package], shipment.client, shipment.get_tags()))
+        return requests
+
+    def _match_gls_labels(self, packages, labels):
+        """
+        Returns the list of the tuples (package, label) of the spooled labels
+        of a request for the packages, matched by parcel index when GLS
+        returns it and otherwise in order.
+
+        :param labels: List of tuples (response, digest, collision)
+        """
+        if len(labels) != len(packages):
+            self.raise_user_error('gls_wrong_label_count', {
+                'shipment': self.rec_name,
+                'labels': len(labels),
+                'packages': len(packages),
+            })
+        if all(label[0].values.get('T8904', '').isdigit() for label in labels):
+            labels = sorted(
+                labels, key=lambda label: int(label[0].values['T8904'])
+            )
+        return zip(packages, labels)
+
+    @classmethod
+    @ModelView.button_action('shipping_gls.wizard_reprint_gls_labels')
+    def reprint_gls_labels(cls, shipments):
+        pass
+
+    def _get_gls_label_name(self, package, tracking_number):
+        """
+        Returns the name of the attachment holding the label of the package
+        """
+        return "%s_%s_%s.zpl" % (
+            tracking_number, self.gls_parcel_number, package.code
+        )
+
+    def _get_gls_document_name(self):
+        """
+        Returns the name of the attachment holding the combined labels of the
+        shipment
+        """
+        return "%s_labels.zpl" % self.gls_parcel_number
+
+    def _get_gls_legacy_label(self, package):
+        """
+        Returns the tuple (attachment, resolution) of the label of a package
+        labelled before label records were stored
+        """
+        Attachment = Pool().get('ir.attachment')
+
+        attachments = Attachment.search([
+            ('resource', '=', '%s,%s' % (self.__name__, self.id)),
+            ('name', '=', self._get_gls_label_name(
+                package, package.tracking_number
+            )),
+        ])
+        if not attachments:
+            self.raise_user_error('gls_label_not_found', package.code)
+        return attachments[0], self.carrier.gls_printer_resolution
+
+    def get_gls_labels(self, resolution=None, packages=None):
+        """
+        Returns the stored ZPL labels of the packages, in order, without
+        calling GLS. The labels are read from a process cache when possible.
+
+        :param resolution: Printer resolution to convert the labels to
+        :param packages: Packages of the shipment, defaults to all of them
+        """
+        GLSLabel = Pool().get('stock.package.gls.label')
+
+        if packages is None:
+            packages = self.packages
+        records = dict(
+            (record.package.id, record) for record in GLSLabel.search([
+                ('package', 'in', [p.id for p in packages]),
+            ])
+        )
+
+        labels = []
+        for package in packages:
+            record = records.get(package.id)
+            label = record.get_label(resolution) if record else None
+            if label is None:
+                attachment, source = self._get_gls_legacy_label(package)
+                label = read_label(attachment, source, resolution or source)
+            labels.append(label)
+        return labels
+
+    def _get_gls_void_requests(self):
+        """
+        Returns a list of tuples (package, client, tags) with the Unibox
+        request voiding each labelled package of the shipment.
+        """
+        client = self.carrier.get_unibox_client()
+        contract, customer_id, _ = self._get_gls_credentials()
+        return [(package, client, [
+            CancelParcel(package.tracking_number).get_encoded_value(),
+            'T8914:%s' % contract,
+            'T8915:%s' % customer_id,
+        ]) for package in self.packages if package.tracking_number]
+
+    @classmethod
+    @ModelView.button
+    def void_gls_labels(cls, shipments):
+        """
+        Voids the GLS parcels of the shipments.
+
+        The void requests are sent to the Unibox concurrently. Then the
+        labels of the voided packages are archived, their tracking numbers
+        are cleared and the outcome is recorded on each package, in bulk.
+        The tracking and parcel numbers of a GLS shipment are cleared once
+        all its packages are voided.
+        """
+        requests = []
+        for shipment in shipments:
+            if shipment.is_gls_shipping:
+                requests.extend(
+                    (shipment,) + request
+                    for request in shipment._get_gls_void_requests()
+                )
+        results = send_requests(
+            [(client, tags) for _, _, client, tags in requests],
+            LABEL_WORKERS
+        )
+
+        voided = defaultdict(list)
+        failed = defaultdict(list)
+        for (shipment, package, _, _), result in zip(requests, results):
+            error = shipment._get_gls_void_error(package, result)
+            if error:
+                failed[shipment].append((package, error))
+            else:
+                voided[shipment].append(package)
+
+        cls._archive_gls_labels(voided)
+        cls._store_gls_void_results(voided, failed)
+        cls.write([
+            s for s in shipments if s.is_gls_shipping and s not in failed
+        ], {
+            'tracking_number': None,
+            'gls_parcel_number': None,
+            'gls_label_key': None,
+        })
+
+    def _get_gls_void_error(self, package, result):
+        """
+        Returns the reason the void request of the package failed, or None
+        if GLS confirmed the cancellation by echoing the parcel number.
+        """
+        if isinstance(result, Exception):
+            return result
+        if result.values.get('T000', '').strip() != \
+                package.tracking_number.strip():
+            return self.raise_user_error('gls_void_not_confirmed', '|'.join(
+                '%s:%s' % item for item in sorted(result.values.items())
+                if item[0] != 'zpl_content'
+            ), raise_exception=False)
+
+    @classmethod
+    def _archive_gls_labels(cls, packages_by_shipment):
+        """
+        Archives the labels of the packages by deactivating their records
+        and renaming their attachments, so that they are not served for
+        reprints anymore.
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        GLSLabel = pool.get('stock.package.gls.label')
+        attachment = Attachment.__table__()
+        label = GLSLabel.__table__()
+        cursor = Transaction().cursor
+
+        package_ids = [
+            p.id for packages in packages_by_shipment.itervalues()
+            for p in packages
+        ]
+        for sub_ids in grouped_slice(package_ids):
+            cursor.execute(*label.update(
+                [label.active], [False],
+                where=reduce_ids(label.package, sub_ids)
+            ))
+
+        names = []
+        for shipment, packages in packages_by_shipment.iteritems():
+            names.extend(
+                shipment._get_gls_label_name(package, package.tracking_number)
+                for package in packages
+            )
+            names.append(shipment._get_gls_document_name())
+        attachments = Attachment.search([
+            ('resource', 'in', [
+                '%s,%s' % (cls.__name__, shipment.id)
+                for shipment in packages_by_shipment
+            ]),
+            ('name', 'in', names),
+        ])
+        for sub_ids in grouped_slice(map(int, attachments)):
+            cursor.execute(*attachment.update(
+                [attachment.name, attachment.description],
+                [Concat('void_', attachment.name), 'Voided GLS label'],
+                where=reduce_ids(attachment.id, sub_ids)
+            ))
+
+    @classmethod
+    def _store_gls_void_results(cls, voided, failed):
+        """
+        Records the outcome of the void requests on the packages
+        """
+        Package = Pool().get('stock.package')
+
+        to_write = []
+        packages = sum(voided.values(), [])
+        if packages:
+            to_write.extend((packages, {
+                'tracking_number': None,
+                'gls_void_state': 'voided',
+                'gls_void_message': None,
+            }))
+        for package, error in sum(failed.values(), []):
+            to_write.extend(([package], {
+                'gls_void_state': 'failed',
+                'gls_void_message': cls.raise_user_error(
+                    'gls_void_request_failed', (package.code, error),
+                    raise_exception=False
+                ),
+            }))
+        if to_write:
+            Package.write(*to_write)
+
+    def _get_gls_label_record(self, package, response):
+        """
+        Returns the values of the label record of the package, which keeps
+        the tags of the response
+        """
+        values = dict(
+            (name, response.values.get(tag)) for name, tag in GLS_LABEL_TAGS
+        )
+        parcel_index = response.values.get('T8904')
+        values.update({
+            'package': package.id,
+            'shipment': self.id,
+            'parcel_index': int(parcel_index) if parcel_index
+            else self.packages.index(package) + 1,
+            'resolution': self.carrier.gls_printer_resolution,
+            'response': '|'.join(
+                '%s:%s' % item for item in sorted(response.values.iteritems())
+                if item[0] != 'zpl_content'
+            ),
+        })
+        return values
+
+    @classmethod
+    def _insert_gls_label_attachments(cls, attachments):
+        """
+        Attaches the spooled labels to their shipments and returns the ids of
+        the attachments, in order
+
+        :param attachments: List of tuples (shipment, name, digest,
+                            collision)
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        ModelAccess = pool.get('ir.model.access')
+        attachment = Attachment.__table__()
+        transaction = Transaction()
+
+        ModelAccess.check(Attachment.__name__, 'create')
+        ids = _insert_returning(attachment, [
+            attachment.create_uid, attachment.create_date, attachment.type,
+            attachment.resource, attachment.name,
+            attachment.digest, attachment.collision,
+        ], [
+            [
+                transaction.user, Now(), 'data',
+                '%s,%s' % (shipment.__name__, shipment.id), name,
+                digest, collision,
+            ]
+            for shipment, name, digest, collision in attachments
+        ])
+        Attachment.check_access(ids, mode='create')
+        return ids
+
+    @classmethod
+    def _combine_gls_labels(cls, labels):
+        """
+        Concatenates the labels of each shipment whose carrier stores
+        combined labels into a single document attached to the shipment.
+
+        :param labels: List of tuples (shipment, package, response, digest,
+                       collision)
+        :return: A dictionary which maps the id of each package to the tuple
+                 (attachment id, offset, size) of its label
+        """
+        by_shipment = {}
+        for label in labels:
+            if label[0].carrier.gls_combined_labels:
+                by_shipment.setdefault(label[0], []).append(label)
+
+        documents = {}
+        # Each document takes 7 parameters of the queries
+        for shipments in grouped_slice(
+                by_shipment, Transaction().cursor.IN_MAX // 8):
+            documents.update(cls._attach_gls_documents([
+                (shipment, by_shipment[shipment]) for shipment in shipments
+            ]))
+        return documents
+
+    @classmethod
+    def _attach_gls_documents(cls, labels_by_shipment):
+        """
+        Attaches the combined labels of each shipment and returns the
+        position of the label of each package, as _combine_gls_labels
+
+        :param labels_by_shipment: List of tuples (shipment, labels)
+        """
+        transaction = Transaction()
+        db_name = transaction.cursor.dbname
+        # The replay spools its labels into a scratch filestore
+        filestore = transaction.context.get('gls_filestore')
+
+        attachments, indexes = [], []
+        for shipment, labels in labels_by_shipment:
+            digest, collision, index = combine_labels(
+                db_name, [label[3:] for label in labels], filestore
+            )
+            attachments.append((
+                shipment, shipment._get_gls_document_name(), digest, collision
+            ))
+            indexes.append(zip([label[1].id for label in labels], index))
+
+        documents = {}
+        for attachment_id, index in zip(
+                cls._insert_gls_label_attachments(attachments), indexes):
+            for package_id, (offset, size) in index:
+                documents[package_id] = (attachment_id, offset, size)
+        return documents
+
+    @classmethod
+    def _attach_gls_labels(cls, labels, documents):
+        """
+        Attaches the labels which are not part of a combined document and
+        returns, for each label in order, the tuple (attachment id, offset,
+        size) of its attachment
+
+        :param documents: Combined labels by package id, as returned by
+                          _combine_gls_labels
+        """
+        single = [
+            label for label in labels if label[1].id not in documents
+        ]
+        ids = iter(cls._insert_gls_label_attachments([
+            (shipment, shipment._get_gls_label_name(
+                package, response.values['T8913']
+            ), digest, collision)
+            for shipment, package, response, digest, collision in single
+        ]) if single else [])
+        return [
+            documents.get(label[1].id) or (next(ids), None, None)
+            for label in labels
+        ]
+
+    @classmethod
+    def _insert_gls_label_records(cls, labels, attachments):
+        """
+        Creates the label records of the spooled labels
+
+        :param attachments: List of the tuples (attachment id, offset, size)
+                            of the labels
+        """
+        pool = Pool()
+        GLSLabel = pool.get('stock.package.gls.label')
+        ModelAccess = pool.get('ir.model.access')
+        label = GLSLabel.__table__()
+        transaction = Transaction()
+
+        ModelAccess.check(GLSLabel.__name__, 'create')
+        names = [name for name, _ in GLS_LABEL_TAGS] + [
+            'package', 'shipment', 'parcel_index', 'resolution', 'response',
+        ]
+        values = []
+        for (shipment, package, response, _, _), attachment in zip(
+                labels, attachments):
+            record = shipment._get_gls_label_record(package, response)
+            values.append([transaction.user, Now(), True] + list(
+                attachment
+            ) + [record[name] for name in names])
+        transaction.cursor.execute(*label.insert([
+            label.create_uid, label.create_date, label.active,
+            label.attachment, label.attachment_offset, label.attachment_size,
+        ] + [getattr(label, name) for name in names], values))
+
+    @classmethod
+    def _store_gls_labels(cls, labels):
+        """
+        Saves the tracking numbers on the packages, attaches the spooled
+        labels to their shipments and records the responses of GLS.
+
+        The ORM issues several queries per record to create and write them,
+        so all is done in SQL with a few queries per slice of labels after
+        the access checks of the ORM. The labels of the carriers which
+        combine them are attached as a single document per shipment.
+
+        :param labels: List of tuples (shipment, package, response, digest,
+                       collision)
+        :return: The list of the tracking numbers of the labels
+        """
+        pool = Pool()
+        Package = pool.get('stock.package')
+        ModelFieldAccess = pool.get('ir.model.field.access')
+        package_table = Package.__table__()
+        transaction = Transaction()
+        cursor = transaction.cursor
+
+        tracking_numbers = [label[2].values.get('T8913') for label in labels]
+        assert all(tracking_numbers)
+
+        ModelFieldAccess.check(Package.__name__, ['tracking_number'], 'write')
+
+        documents = cls._combine_gls_labels(labels)
+        # Each label takes up to 15 parameters of the queries
+        for sub_labels in grouped_slice(labels, cursor.IN_MAX // 16):
+            sub_labels = list(sub_labels)
+            packages = [package for _, package, _, _, _ in sub_labels]
+            cursor.execute(*package_table.update([
+                package_table.tracking_number,
+                package_table.write_uid, package_table.write_date,
+            ], [
+                Case(*[
+                    (package_table.id == package.id, response.values['T8913'])
+                    for _, package, response, _, _ in sub_labels
+                ]),
+                transaction.user, Now(),
+            ], where=reduce_ids(package_table.id, map(int, packages))))
+            cls._insert_gls_label_records(
+                sub_labels, cls._attach_gls_labels(sub_labels, documents)
+            )
+            _touch(Package, packages)
+        return tracking_numbers
+
+    @classmethod
+    def _discard_gls_spooled_labels(cls, labels):
+        """
+        Removes the spooled labels which were copied into combined documents
+        from the filestore once the transaction is committed, as no
+        attachment refers to them
+
+        :param labels: List of tuples (shipment, package, response, digest,
+                       collision)
+        """
+        _remove_unreferenced_labels([
+            (digest, collision)
+            for shipment, _, _, digest, collision in labels
+            if shipment.carrier.gls_combined_labels
+        ])
+
+    @classmethod
+    def _print_gls_labels(cls, labels):
+        """
+        Queues the spooled labels to be sent to the printers of the
+        warehouses of their shipments, if they have one and unless the
+        context sets gls_print_labels to False
+
+        :param labels: List of tuples (shipment, package, response, digest,
+                       collision)
+        """
+        Printer = Pool().get('stock.gls.printer')
+
+        if not Transaction().context.get('gls_print_labels', True):
+            return
+
+        printers = Printer.get_warehouse_printers()
+        db_name = Transaction().cursor.dbname
+        to_print = {}
+        for shipment, _, _, digest, collision in labels:
+            printer = printers.get(shipment.warehouse.id)
+            if printer is None:
+                continue
+            host, port, resolution = printer
+            to_print.setdefault((host, port), []).append(read_spooled_label(
+                db_name, digest, collision,
+                shipment.carrier.gls_printer_resolution, resolution
+            ))
+        for (host, port), zpl_labels in to_print.iteritems():
+            Printer.print_labels(host, port, zpl_labels)
+
+    def _print_stored_gls_labels(self):
+        """
+        Queues the stored labels of the shipment to be sent to the printer
+        of its warehouse, if it has one and a label is stored for each
+        package
+        """
+        pool = Pool()
+        Printer = pool.get('stock.gls.printer')
+        GLSLabel = pool.get('stock.package.gls.label')
+
+        printer = Printer.get_warehouse_printers().get(self.warehouse.id)
+        stored = GLSLabel.search([
+            ('package', 'in', [p.id for p in self.packages]),
+        ], count=True)
+        if printer is None or stored < len(self.packages):
+            return
+        host, port, resolution = printer
+        Printer.print_labels(host, port, self.get_gls_labels(resolution))
 
     def _make_gls_label(self):
         """
         This method gets the prepared Shipment object and calls the GLS API
         for label generation.
+
+        The ZPL content of each label is spooled into the filestore as it is
+        received and the attachment only references it, so that at most one
+        label is being handled at a time.
+
+        All the packages share the labelling deadline of the carrier.
         """
-        Attachment = Pool().get('ir.attachment')
+        self._prefetch_gls_label_data([self])
+
+        db_name = Transaction().cursor.dbname
+        requests = self._get_gls_label_requests()
+        labels = []
+        with labelling_deadline(client for _, client, _ in requests):
+            for packages, client, tags in requests:
+                labels.extend(
+                    (self, package) + label
+                    for package, label in self._match_gls_labels(
+                        packages, spool_request(
+                            client, tags, db_name, len(packages)
+                        )
+                    )
+                )
+        tracking_numbers = self._store_gls_labels(labels)
+        self._print_gls_labels(labels)
+        self._discard_gls_spooled_labels(labels)
+        return tracking_numbers[-1]
+
+    def _prepare_gls_labels(self):
+        """
+        Checks that labels can be generated for the shipment, assigns it a
+        new parcel number and returns the prepared label requests.
+        """
+        if self.state not in ('packed', 'done'):
+            self.raise_user_error('invalid_state')
 
-        for index, package in enumerate(self.packages, start=1):
-            shipment = package._get_shipment_object()
-            shipment.parcel = index
-            label = shipment.create_label()
-            response = Response.parse(label)
+        if not self.is_gls_shipping:
+            self.raise_user_error('wrong_carrier', 'GLS')
+
+        if self.tracking_number:
+            self.raise_user_error('tracking_number_already_present')
+
+        self.gls_parcel_number = self._gen_parcel_number()
+        return self._get_gls_label_requests()
+
+    def _get_gls_result_error(self, packages, result):
+        """
+        Returns the error message for the spooled labels of the packages if
+        the request failed, otherwise None.
+        """
+        if isinstance(result, Exception):
+            return self.raise_user_error(
+                'gls_label_request_failed', (
+                    ', '.join(p.code for p in packages), result
+                ), raise_exception=False
+            )
+        try:
+            labels = self._match_gls_labels(packages, result)
+        except UserError as error:
+            return error.message
+        missing = [
+            package.code for package, (response, _, _) in labels
+            if not response.values.get('T8913')
+        ]
+        if missing:
+            return self.raise_user_error(
+                'gls_no_tracking_number', missing[0], raise_exception=False
+            )
 
-            # Get tracking number
-            tracking_number = response.values.get('T8913')
-            assert tracking_number
+    @classmethod
+    def _prepare_gls_labels_bulk(cls, shipments, errors):
+        """
+        Prepares the label requests of all the shipments and returns them as
+        a list of tuples (shipment, packages, client, tags). The shipments
+        which cannot be labelled are reported in errors.
+        """
+        cls._assign_gls_accounts([
+            s for s in shipments if s.is_gls_shipping and not s.tracking_number
+        ])
+
+        requests = []
+        prepared = []
+        for shipment in shipments:
+            try:
+                requests.extend(
+                    (shipment,) + request
+                    for request in shipment._prepare_gls_labels()
+                )
+            except UserError as error:
+                errors[shipment.id] = error.message
+            else:
+                prepared.append(shipment)
+        cls.save(prepared)
+        return requests
 
-            package.tracking_number = tracking_number
-            package.save()
+    @classmethod
+    def make_gls_labels_bulk(cls, shipments):
+        """
+        Generates the labels of many shipments at once. The ORM work is done
+        upfront, then the requests for all the packages are sent to the
+        Unibox concurrently and the results are stored. The requests sent
+        with a client share the labelling deadline of its carrier, so that
+        the remaining ones fail fast once it is spent.
+
+        A shipment is labelled only if all its packages were. Returns a
+        dictionary which maps the id of each failed shipment to the reason.
+        """
+        with profiled(
+            Transaction().cursor.dbname, 'batch',
+            cls._is_gls_profiled(shipments)
+        ):
+            errors = {}
+            for shipment in cls._lock_gls_labels(shipments):
+                errors[shipment.id] = cls.raise_user_error(
+                    'gls_labels_in_progress', shipment.rec_name,
+                    raise_exception=False
+                )
+            shipments = [s for s in shipments if s.id not in errors]
+
+            cls._prefetch_gls_label_data(shipments)
+            requests = cls._prepare_gls_labels_bulk(shipments, errors)
+            with labelling_deadline(client for _, _, client, _ in requests):
+                results = spool_labels([
+                    (client, tags, len(packages))
+                    for _, packages, client, tags in requests
+                ], Transaction().cursor.dbname, Transaction().context.get(
+                    'gls_label_workers', LABEL_WORKERS
+                ))
+
+            failed = []
+            for (shipment, packages, _, _), result in zip(requests, results):
+                error = shipment._get_gls_result_error(packages, result)
+                if error and shipment.id not in errors:
+                    errors[shipment.id] = error
+                    failed.append(shipment.id)
+
+            cls._count_gls_label_failures(failed)
+            cls._store_gls_labels_bulk(requests, results, errors)
+            return errors
 
-            # Create attachment
-            Attachment.create([{
-                'name': "%s_%s_%s.zpl" % (
-                    tracking_number, self.gls_parcel_number, package.code),
-                'data': response.values.get('zpl_content'),
-                'resource': '%s,%s' % (self.__name__, self.id),
-            }])
+    @classmethod
+    def pregenerate_gls_labels(cls):
+        """
+        Generates ahead the labels of a batch of packed GLS shipments, so
+        that the label wizard returns them right away.
 
-        return tracking_number
+        Nothing is done while users are generating labels, so that their
+        requests keep the capacity of the Unibox, and a single connection is
+        used by default. Shipments which are labelled or being labelled are
+        skipped, so that the next run resumes where this one stopped. The
+        labels are printed once they are asked for.
+
+        This method is called by the scheduler.
+        """
+        user = Transaction().user
+        with Transaction().set_user(0), Transaction().set_context(
+                gls_label_workers=PREGENERATE_WORKERS,
+                gls_print_labels=False):
+            if cls._is_gls_labelling_busy([0, user]):
+                return
+            shipments = cls._get_gls_pregenerate_shipments()
+            locked = cls._lock_gls_labels(shipments)
+            shipments = [s for s in shipments if s not in locked]
+            failures = dict((s.id, s.gls_label_failures) for s in shipments)
+
+            errors = cls.make_gls_labels_bulk(shipments)
+            # Shipments which cannot be prepared would be tried again and
+            # again otherwise
+            cls._count_gls_label_failures([
+                s.id for s in cls.browse(list(errors))
+                if s.gls_label_failures == failures[s.id]
+            ])
+
+    @staticmethod
+    def _is_gls_labelling_busy(background_users):
+        """
+        Returns whether labels were generated by users other than the
+        background ones during the last PREGENERATE_IDLE seconds
+        """
+        GLSLabel = Pool().get('stock.package.gls.label')
+
+        with Transaction().set_context(active_test=False):
+            return bool(GLSLabel.search([
+                ('create_date', '>=',
+                    datetime.now() - timedelta(seconds=PREGENERATE_IDLE)),
+                ('create_uid', 'not in', background_users),
+            ], limit=1))
+
+    @classmethod
+    def _get_gls_pregenerate_shipments(cls):
+        """
+        Returns the next packed GLS shipments to label ahead, oldest first
+        """
+        Carrier = Pool().get('carrier')
+
+        return cls.search([
+            ('state', '=', 'packed'),
+            ('carrier', 'in', list(Carrier.get_gls_carrier_ids())),
+            ('tracking_number', '=', None),
+            [
+                'OR',
+                ('gls_label_failures', '=', None),
+                ('gls_label_failures', '<', PREGENERATE_MAX_FAILURES),
+            ],
+        ], order=[('id', 'ASC')], limit=PREGENERATE_LIMIT)
+
+    @classmethod
+    def _count_gls_label_failures(cls, ids):
+        """
+        Counts a failed label generation on the shipments for the statistics
+        """
+        ModelFieldAccess = Pool().get('ir.model.field.access')
+        table = cls.__table__()
+        transaction = Transaction()
+
+        ModelFieldAccess.check(cls.__name__, ['gls_label_failures'], 'write')
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            transaction.cursor.execute(*table.update([
+                table.gls_label_failures,
+                table.write_uid, table.write_date,
+            ], [
+                Coalesce(table.gls_label_failures, 0) + 1,
+                transaction.user, Now(),
+            ], where=reduce_ids(table.id, sub_ids)))
+        _touch(cls, cls.browse(ids))
+
+    @classmethod
+    def _store_gls_labels_bulk(cls, requests, results, errors):
+        """
+        Stores the spooled labels of the shipments which did not fail
+        """
+        labels = []
+        for (shipment, packages, _, _), result in zip(requests, results):
+            if shipment.id not in errors:
+                labels.extend(
+                    (shipment, package) + label for package, label
+                    in shipment._match_gls_labels(packages, result)
+                )
+        tracking_numbers = cls._store_gls_labels(labels)
+        cls._print_gls_labels(labels)
+        cls._discard_gls_spooled_labels(labels)
+
+        labelled = []
+        for label, tracking_number in zip(labels, tracking_numbers):
+            shipment = label[0]
+            shipment.tracking_number = tracking_number.strip()
+            if shipment not in labelled:
+                shipment.gls_label_key = shipment._get_gls_label_key()
+                labelled.append(shipment)
+        cls.save(labelled)
 
 
 class GenerateShippingLabel(Wizard):
@@ -325,16 +2000,153 @@ class ShippingGLS(ModelView):
     'Generate Labels'
     __name__ = 'shipping.label.gls'
 
+    use_shipment_defaults = fields.Boolean(
+        "Use Shipment Defaults",
+        help="Use the service type and depot number of each shipment"
+    )
+
     service_type = fields.Selection(
-        GLS_SERVICES, "GLS Service/Product Type",
-        required=True
+        GLS_SERVICES, "GLS Service/Product Type", states={
+            'required': ~Bool(Eval('use_shipment_defaults')),
+            'invisible': Bool(Eval('use_shipment_defaults')),
+        }, depends=['use_shipment_defaults']
     )
 
     depot_number = fields.Char(
-        "GLS Depot Number", size=2, required=True
+        "GLS Depot Number", size=2, states={
+            'required': ~Bool(Eval('use_shipment_defaults')),
+            'invisible': Bool(Eval('use_shipment_defaults')),
+        }, depends=['use_shipment_defaults']
     )
 
 
+class GenerateGLSLabels(Wizard):
+    'Generate GLS Labels'
+    __name__ = 'shipping.label.gls.mass'
+
+    start = StateView(
+        'shipping.label.gls',
+        'shipping_gls.shipping_gls_mass_config_wizard_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Generate', 'summary', 'tryton-go-next', default=True),
+        ]
+    )
+    summary = StateView(
+        'shipping.label.gls.summary',
+        'shipping_gls.shipping_gls_summary_wizard_view_form',
+        [
+            Button('Ok', 'end', 'tryton-ok', default=True),
+        ]
+    )
+
+    def default_start(self, data):
+        return {
+            'use_shipment_defaults': True,
+        }
+
+    def default_summary(self, data):
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipments = Shipment.browse(
+            Transaction().context.get('active_ids', [])
+        )
+        if not self.start.use_shipment_defaults:
+            for shipment in shipments:
+                shipment.gls_shipping_service_type = self.start.service_type
+                shipment.gls_shipping_depot_number = self.start.depot_number
+
+        errors = Shipment.make_gls_labels_bulk(shipments)
+
+        return {
+            'tracking_numbers': '\n'.join(
+                '%s: %s' % (shipment.rec_name, shipment.tracking_number)
+                for shipment in shipments if shipment.id not in errors
+            ),
+            'failures': '\n'.join(
+                '%s: %s' % (shipment.rec_name, errors[shipment.id])
+                for shipment in shipments if shipment.id in errors
+            ),
+        }
+
+
+class GLSLabelsSummary(ModelView):
+    'GLS Labels Summary'
+    __name__ = 'shipping.label.gls.summary'
+
+    tracking_numbers = fields.Text("Tracking Numbers", readonly=True)
+    failures = fields.Text("Failures", readonly=True)
+
+
+class ReprintGLSLabels(Wizard):
+    'Reprint GLS Labels'
+    __name__ = 'shipping.label.gls.reprint'
+
+    start = StateView(
+        'shipping.label.gls.reprint.start',
+        'shipping_gls.reprint_gls_labels_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Reprint', 'result', 'tryton-print', default=True),
+        ]
+    )
+    result = StateView(
+        'shipping.label.gls.reprint.result',
+        'shipping_gls.reprint_gls_labels_result_view_form',
+        [
+            Button('Ok', 'end', 'tryton-ok', default=True),
+        ]
+    )
+
+    def _get_records(self):
+        """
+        Returns the active shipments or packages
+        """
+        context = Transaction().context
+        Model = Pool().get(context.get('active_model', 'stock.shipment.out'))
+        return Model.browse(context.get('active_ids', []))
+
+    def default_start(self, data):
+        record = self._get_records()[0]
+        shipment = record if record.__name__ == 'stock.shipment.out' \
+            else record.shipment
+        return {
+            'resolution': shipment.carrier.gls_printer_resolution,
+        }
+
+    def default_result(self, data):
+        resolution = self.start.resolution
+
+        labels = []
+        for record in self._get_records():
+            if record.__name__ == 'stock.package':
+                labels.append(record.get_gls_label(resolution))
+            else:
+                labels.extend(record.get_gls_labels(resolution))
+
+        return {
+            'label': fields.Binary.cast(''.join(labels)),
+            'label_name': 'labels.zpl',
+        }
+
+
+class ReprintGLSLabelsStart(ModelView):
+    'Reprint GLS Labels'
+    __name__ = 'shipping.label.gls.reprint.start'
+
+    resolution = fields.Selection(
+        GLS_PRINTER_RESOLUTIONS, 'Printer Resolution', required=True
+    )
+
+
+class ReprintGLSLabelsResult(ModelView):
+    'Reprint GLS Labels'
+    __name__ = 'shipping.label.gls.reprint.result'
+
+    label = fields.Binary('Labels', filename='label_name', readonly=True)
+    label_name = fields.Char('Label Name', readonly=True)
+
+
 class Address:
     __name__ = 'party.address'
 
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    spooler.py
+
+    Spooler pushing labels to printers listening on a raw TCP port
+"""
+import time
+import socket
+import logging
+import threading
+from Queue import Queue, Empty
+
+from trytond.config import config
+
+__all__ = ['PrinterQueue', 'get_printer_queue']
+
+PRINTER_TIMEOUT = config.getfloat(
+    'shipping_gls', 'printer_timeout', default=10
+)
+PRINTER_RETRIES = config.getint('shipping_gls', 'printer_retries', default=3)
+PRINTER_RETRY_DELAY = config.getfloat(
+    'shipping_gls', 'printer_retry_delay', default=1
+)
+PRINTER_BATCH_SIZE = config.getint(
+    'shipping_gls', 'printer_batch_size', default=20
+)
+
+logger = logging.getLogger(__name__)
+
+# Queues of the printers used by the process, by address
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+class PrinterQueue(object):
+    """
+    Labels waiting to be sent to a printer.
+
+    A thread of its own sends them in the order they were queued. The labels
+    waiting together are sent as a batch over a single connection, and a
+    batch which cannot be sent is retried after growing delays before it is
+    dropped.
+    """
+
+    def __init__(self, host, port, timeout=PRINTER_TIMEOUT,
+                 retries=PRINTER_RETRIES, retry_delay=PRINTER_RETRY_DELAY,
+                 batch_size=PRINTER_BATCH_SIZE):
+        """
+        :param timeout: Seconds to wait for the connection and each send
+        :param retries: Number of times a batch is sent again after a failure
+        :param retry_delay: Seconds to wait before the first retry, doubled
+                            for each of the next ones
+        :param batch_size: Maximum number of labels sent over a connection
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.queue = Queue()
+        self.thread = threading.Thread(
+            target=self.run, name='gls-printer-%s:%s' % (host, port)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, labels):
+        """
+        Queues the labels to be printed, in order
+        """
+        for label in labels:
+            self.queue.put(label)
+
+    def join(self):
+        """
+        Waits until all the queued labels were sent or dropped
+        """
+        self.queue.join()
+
+    def _get_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def send(self, data):
+        conn = socket.create_connection((self.host, self.port), self.timeout)
+        try:
+            conn.sendall(data)
+        finally:
+            conn.close()
+
+    def _send_batch(self, batch):
+        """
+        Sends the batch, retrying on failure, and returns whether it was sent
+        """
+        data = ''.join(batch)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                self.send(data)
+                return True
+            except socket.error:
+                logger.warning(
+                    'Sending %s labels to printer %s:%s failed',
+                    len(batch), self.host, self.port, exc_info=True
+                )
+        logger.error(
+            'Dropped %s labels for printer %s:%s',
+            len(batch), self.host, self.port
+        )
+        return False
+
+    def run(self):
+        while True:
+            batch = self._get_batch()
+            try:
+                self._send_batch(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+def get_printer_queue(host, port):
+    """
+    Returns the queue of the printer, which is started on first use in the
+    process
+    """
+    with _queues_lock:
+        if (host, port) not in _queues:
+            _queues[(host, port)] = PrinterQueue(host, port)
+        return _queues[(host, port)]
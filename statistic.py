@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+    statistic.py
+
+    Daily GLS shipping statistics, aggregated in SQL
+"""
+from datetime import datetime, timedelta
+from sql import Literal, Null, Cast, Union
+from sql.aggregate import Count, Sum, Max
+from sql.conditionals import Case, Coalesce, NullIf
+from sql.functions import Now, Extract
+from sql.operators import Concat
+
+from trytond.pool import Pool
+from trytond.model import fields, ModelSQL, ModelView, ModelSingleton
+from trytond.transaction import Transaction
+from trytond.config import config
+from trytond.tools import grouped_slice
+
+from shipment import GLS_SERVICES
+
+__all__ = ['GLSShipmentStatistic', 'GLSShipmentStatisticRefresh']
+
+# Number of seconds before the last refresh from which changes are looked
+# for again, to catch the transactions which were running at that time
+REFRESH_OVERLAP = config.getint(
+    'shipping_gls', 'statistics_refresh_overlap', default=3600
+)
+
+
+class GLSShipmentStatistic(ModelSQL, ModelView):
+    "GLS Shipment Statistic"
+    __name__ = 'stock.shipment.out.gls.statistic'
+
+    date = fields.Date('Date', readonly=True, select=True)
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', readonly=True, select=True, ondelete='CASCADE'
+    )
+    account = fields.Many2One(
+        'carrier.gls.account', 'GLS Account', readonly=True,
+        ondelete='SET NULL'
+    )
+    depot_number = fields.Char('Depot Number', readonly=True)
+    service_type = fields.Selection(
+        GLS_SERVICES, 'Service Type', readonly=True
+    )
+    shipments = fields.Integer('Shipments', readonly=True)
+    labelled = fields.Integer('Labelled Shipments', readonly=True)
+    packages = fields.Integer('Packages', readonly=True)
+    labels = fields.Integer('Labels', readonly=True)
+    voided = fields.Integer('Voided Labels', readonly=True)
+    label_failures = fields.Integer('Label Failures', readonly=True)
+    void_failures = fields.Integer('Void Failures', readonly=True)
+    label_latency = fields.Float(
+        'Label Latency', digits=(16, 2), readonly=True,
+        help="Average number of hours between the creation of the shipments "
+        "and of their labels"
+    )
+    label_failure_rate = fields.Function(
+        fields.Float('Label Failure Rate', digits=(16, 4)), 'get_rate'
+    )
+    void_failure_rate = fields.Function(
+        fields.Float('Void Failure Rate', digits=(16, 4)), 'get_rate'
+    )
+    stale = fields.Boolean(
+        'Stale', readonly=True,
+        help="Shipments were deleted or moved from the date since the "
+        "statistics were computed"
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(GLSShipmentStatistic, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+
+    def get_rate(self, name):
+        """
+        Returns the share of the label or void requests which failed
+        """
+        if name == 'label_failure_rate':
+            failures, successes = self.label_failures, self.labelled
+        else:
+            failures, successes = self.void_failures, self.voided
+        if failures or successes:
+            return float(failures) / (failures + successes)
+
+    @staticmethod
+    def _get_shipment_date(shipment):
+        return Coalesce(shipment.effective_date, shipment.planned_date)
+
+    @classmethod
+    def _get_shipments_query(cls, dates):
+        """
+        Returns a query with one row per GLS shipment of the dates, which
+        counts its packages and labels
+        """
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        Package = pool.get('stock.package')
+        GLSLabel = pool.get('stock.package.gls.label')
+        Carrier = pool.get('carrier')
+        shipment = Shipment.__table__()
+        package = Package.__table__()
+        label = GLSLabel.__table__()
+        carrier = Carrier.__table__()
+
+        date = cls._get_shipment_date(shipment)
+        latency = Extract('EPOCH', label.create_date) \
+            - Extract('EPOCH', shipment.create_date)
+        return shipment.join(
+            carrier, condition=shipment.carrier == carrier.id
+        ).join(
+            package, 'LEFT', condition=package.shipment == Concat(
+                Shipment.__name__ + ',', Cast(shipment.id, 'VARCHAR')
+            )
+        ).join(
+            label, 'LEFT', condition=label.package == package.id
+        ).select(
+            date.as_('date'),
+            shipment.carrier.as_('carrier'),
+            shipment.gls_account.as_('account'),
+            shipment.gls_shipping_depot_number.as_('depot_number'),
+            shipment.gls_shipping_service_type.as_('service_type'),
+            Max(Case(
+                (shipment.tracking_number != Null, 1), else_=0
+            )).as_('labelled'),
+            Count(package.id, distinct=True).as_('packages'),
+            Count(label.id, distinct=True).as_('labels'),
+            Count(Case(
+                (label.active == False, label.id),  # noqa
+            ), distinct=True).as_('voided'),
+            Max(Coalesce(
+                shipment.gls_label_failures, 0
+            )).as_('label_failures'),
+            Count(Case(
+                (package.gls_void_state == 'failed', package.id),
+            ), distinct=True).as_('void_failures'),
+            Sum(latency).as_('latency'),
+            Count(label.id).as_('latency_count'),
+            where=(carrier.carrier_cost_method == 'gls') & date.in_(dates),
+            group_by=[
+                shipment.id, date, shipment.carrier, shipment.gls_account,
+                shipment.gls_shipping_depot_number,
+                shipment.gls_shipping_service_type,
+            ]
+        )
+
+    @classmethod
+    def _get_statistics_query(cls, dates):
+        """
+        Returns the query aggregating the statistics of the dates with the
+        columns of the table
+        """
+        # Joins repeat the shipments, so they are counted in a sub query
+        shipments = cls._get_shipments_query(dates)
+        latency = Sum(shipments.latency) / NullIf(
+            Cast(Sum(shipments.latency_count), 'FLOAT'), 0
+        ) / 3600.0
+        return shipments.select(
+            Literal(Transaction().user).as_('create_uid'),
+            Now().as_('create_date'),
+            shipments.date, shipments.carrier, shipments.account,
+            shipments.depot_number, shipments.service_type,
+            Count(Literal('*')).as_('shipments'),
+            Sum(shipments.labelled).as_('labelled'),
+            Sum(shipments.packages).as_('packages'),
+            Sum(shipments.labels).as_('labels'),
+            Sum(shipments.voided).as_('voided'),
+            Sum(shipments.label_failures).as_('label_failures'),
+            Sum(shipments.void_failures).as_('void_failures'),
+            latency.as_('label_latency'),
+            group_by=[
+                shipments.date, shipments.carrier, shipments.account,
+                shipments.depot_number, shipments.service_type,
+            ]
+        )
+
+    @classmethod
+    def _get_changed_dates(cls, since):
+        """
+        Returns the dates of the shipments which were created or changed, or
+        whose packages were, since the given time. All the dates are returned
+        if since is None.
+
+        Each creation and write date is looked up in its own select so that
+        only the rows changed since are read through the index of the column.
+
+        The carrier is not filtered on, so that the days of the shipments
+        which stopped using GLS are updated too.
+        """
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        Package = pool.get('stock.package')
+        shipment = Shipment.__table__()
+        package = Package.__table__()
+        cursor = Transaction().cursor
+
+        date = cls._get_shipment_date(shipment)
+        if since is None:
+            cursor.execute(*shipment.select(
+                date, where=date != Null, group_by=[date]
+            ))
+            return [row[0] for row in cursor.fetchall()]
+
+        packages = shipment.join(
+            package, condition=package.shipment == Concat(
+                Shipment.__name__ + ',', Cast(shipment.id, 'VARCHAR')
+            )
+        )
+        cursor.execute(*Union(*[
+            table.select(date, where=(date != Null) & (column >= since))
+            for table, column in [
+                (shipment, shipment.create_date),
+                (shipment, shipment.write_date),
+                (packages, package.create_date),
+                (packages, package.write_date),
+            ]
+        ]))
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def _get_stale_dates(cls):
+        """
+        Returns the dates whose statistics were marked as stale
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*table.select(
+            table.date, where=table.stale == True,  # noqa
+            group_by=[table.date]
+        ))
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def mark_stale(cls, dates):
+        """
+        Marks the statistics of the dates as stale, so that the next refresh
+        computes them again. Changes of the shipments are found by their
+        write date, but not the dates they were deleted or moved from.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        for sub_dates in grouped_slice(set(dates)):
+            cursor.execute(*table.update(
+                [table.stale], [True], where=table.date.in_(list(sub_dates))
+            ))
+
+    @classmethod
+    def _delete_non_gls_carriers(cls):
+        """
+        Deletes the statistics of the carriers which stopped using GLS
+        """
+        Carrier = Pool().get('carrier')
+        table = cls.__table__()
+        carrier = Carrier.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*table.delete(where=~table.carrier.in_(carrier.select(
+            carrier.id, where=carrier.carrier_cost_method == 'gls'
+        ))))
+
+    @staticmethod
+    def _get_refresh_start():
+        """
+        Returns the time from which changes must be looked for, or None if
+        the statistics were never computed
+        """
+        Refresh = Pool().get('stock.shipment.out.gls.statistic.refresh')
+        last_refresh = Refresh(1).last_refresh
+        if last_refresh:
+            return last_refresh - timedelta(seconds=REFRESH_OVERLAP)
+
+    @classmethod
+    def refresh(cls, rebuild=False):
+        """
+        Computes the statistics of the days of the GLS shipments changed since
+        the last refresh and of the days marked as stale. The statistics of
+        each day are recomputed as a whole with a single aggregation over the
+        shipments, packages and labels.
+
+        This method is called by the scheduler.
+
+        :param rebuild: Recompute the statistics of all the days
+        """
+        Refresh = Pool().get('stock.shipment.out.gls.statistic.refresh')
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        start = datetime.now()
+        if rebuild:
+            cursor.execute(*table.delete())
+        since = None if rebuild else cls._get_refresh_start()
+        cls._delete_non_gls_carriers()
+
+        columns = [
+            table.create_uid, table.create_date, table.date, table.carrier,
+            table.account, table.depot_number, table.service_type,
+            table.shipments, table.labelled, table.packages, table.labels,
+            table.voided, table.label_failures, table.void_failures,
+            table.label_latency,
+        ]
+        dates = set(cls._get_changed_dates(since) + cls._get_stale_dates())
+        for sub_dates in grouped_slice(dates):
+            sub_dates = list(sub_dates)
+            cursor.execute(*table.delete(where=table.date.in_(sub_dates)))
+            cursor.execute(*table.insert(
+                columns, cls._get_statistics_query(sub_dates)
+            ))
+
+        refresh = Refresh(1)
+        refresh.last_refresh = start
+        refresh.save()
+
+
+class GLSShipmentStatisticRefresh(ModelSingleton, ModelSQL):
+    "GLS Shipment Statistic Refresh"
+    __name__ = 'stock.shipment.out.gls.statistic.refresh'
+
+    last_refresh = fields.DateTime('Last Refresh', readonly=True)
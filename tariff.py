@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    tariff.py
+
+    Rate engine working on the GLS tariff tables of a carrier
+"""
+from bisect import bisect_left
+
+__all__ = ['TariffTable']
+
+
+class TariffTable(object):
+    """
+    Compact, read only view of the zones and tariffs of a carrier which
+    quotes without touching the database.
+
+    Zones are kept per country as (zip prefix, zone) pairs, longest prefix
+    first, and the tariffs as the sorted maximum weights of the brackets of
+    each (service type, zone) with the matching prices.
+    """
+
+    def __init__(self, zones, tariffs):
+        """
+        :param zones: Iterable of tuples (country code, zip prefix, zone)
+        :param tariffs: Iterable of tuples (service type, zone, maximum
+                        weight, price)
+        """
+        self.zones = {}
+        for country, zip_prefix, zone in zones:
+            self.zones.setdefault(country, []).append((zip_prefix or '', zone))
+        for prefixes in self.zones.itervalues():
+            prefixes.sort(key=lambda prefix_zone: -len(prefix_zone[0]))
+        # Only this many leading characters of a zip code select its zone
+        self.prefix_lengths = dict(
+            (country, len(prefixes[0][0]))
+            for country, prefixes in self.zones.iteritems()
+        )
+
+        brackets = {}
+        for service_type, zone, weight, price in sorted(tariffs):
+            brackets.setdefault((service_type, zone), []).append(
+                (weight, price)
+            )
+        self.tariffs = dict(
+            (key, (tuple(w for w, _ in values), tuple(p for _, p in values)))
+            for key, values in brackets.iteritems()
+        )
+        # Every bracket of a zone is a union of these ones
+        self.weights = tuple(sorted(set(
+            weight for weights, _ in self.tariffs.itervalues()
+            for weight in weights
+        )))
+
+    def __nonzero__(self):
+        return bool(self.tariffs)
+
+    def _clean_zip(self, zip_code):
+        return (zip_code or '').replace(' ', '')
+
+    def get_quote_key(self, service_type, country, zip_code, weight):
+        """
+        Returns a key which is the same for all the quotes that have the same
+        price: the zip code is cut to the characters which select its zone
+        and the weight replaced by its bracket.
+        """
+        zip_code = self._clean_zip(zip_code)
+        return (
+            service_type, country,
+            zip_code[:self.prefix_lengths.get(country, 0)],
+            bisect_left(self.weights, weight),
+        )
+
+    def get_zone(self, country, zip_code):
+        """
+        Returns the zone of the destination or None if it is not served
+        """
+        zip_code = self._clean_zip(zip_code)
+        for zip_prefix, zone in self.zones.get(country, []):
+            if zip_code.startswith(zip_prefix):
+                return zone
+
+    def get_price(self, service_type, zone, weight):
+        """
+        Returns the price of the lightest bracket the weight fits in or None
+        if there is no tariff for it
+        """
+        try:
+            weights, prices = self.tariffs[(service_type, zone)]
+        except KeyError:
+            return
+        index = bisect_left(weights, weight)
+        if index < len(prices):
+            return prices[index]
+
+    def quote(self, service_type, country, zip_code, weight):
+        """
+        Returns the price to ship weight to the destination or None if
+        there is no tariff for it
+        """
+        zone = self.get_zone(country, zip_code)
+        if zone is not None:
+            return self.get_price(service_type, zone, weight)
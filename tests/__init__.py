@@ -9,6 +9,10 @@ import trytond.tests.test_tryton
 
 from tests.test_views_depends import TestViewsDepends
 from tests.test_shipment import TestGLSShipping
+from tests.test_label_store import TestLabelStore
+from tests.test_tariff import TestTariffTable
+from tests.test_unibox import TestUniboxClient
+from tests.test_spooler import TestPrinterQueue
 
 
 def suite():
@@ -22,6 +26,18 @@ def suite():
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestGLSShipping),
     ])
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestLabelStore),
+    ])
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestTariffTable),
+    ])
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestUniboxClient),
+    ])
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestPrinterQueue),
+    ])
     return test_suite
 
 if __name__ == '__main__':
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_label_store.py
+
+"""
+import os
+import time
+import gzip
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from gls_unibox_api.tags import StartTag, EndTag
+
+from trytond.config import config
+from trytond.modules.shipping_gls.label_store import spool_label, \
+    spool_parcel_labels, LabelArchive, map_concurrently
+from trytond.modules.shipping_gls.zpl import convert_zpl
+
+ZPL = '^XA' + '^FO50,50^GFA,1,1,1,FF^FS' * 1000 + '^XZ'
+
+
+class FakeConnection(object):
+    """
+    Socket stand-in returning the response in small chunks
+    """
+
+    def __init__(self, response, chunk_size):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.sent = ''
+        self.closed = False
+
+    def sendall(self, data):
+        self.sent += data
+
+    def recv(self, size):
+        size = min(size, self.chunk_size)
+        data, self.response = self.response[:size], self.response[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get_socket_conn(self):
+        return self.connection
+
+
+class TestLabelStore(unittest.TestCase):
+    """
+    Test spooling of labels into the filestore
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.old_path = config.get('database', 'path')
+        config.set('database', 'path', self.path)
+
+    def tearDown(self):
+        config.set('database', 'path', self.old_path)
+        shutil.rmtree(self.path)
+
+    def _spool(self, chunk_size):
+        response = ZPL + StartTag.code + 'T8913:ZTRACK|T400:461234567890|' \
+            + EndTag.code
+        connection = FakeConnection(response, chunk_size)
+        result = spool_label(FakeClient(connection), ['T8904:1'], 'test')
+        self.assertTrue(connection.closed)
+        self.assertEqual(
+            connection.sent, StartTag.code + 'T8904:1|' + EndTag.code
+        )
+        return result
+
+    def test_0010_spool_label(self):
+        """
+        Test that the ZPL content ends up in the filestore and only the tags
+        are parsed, whatever the chunking of the response
+        """
+        digest = hashlib.md5(ZPL).hexdigest()
+        filename = os.path.join(
+            self.path, 'test', digest[0:2], digest[2:4], digest
+        )
+
+        for chunk_size in (1, 7, 13, 8192):
+            response, label_digest, collision = self._spool(chunk_size)
+
+            self.assertEqual(response.values['T8913'], 'ZTRACK')
+            self.assertEqual(response.values['T400'], '461234567890')
+            self.assertEqual(response.values['zpl_content'], '')
+            self.assertEqual(label_digest, digest)
+            self.assertEqual(collision, 0)
+            with open(filename, 'rb') as label_file:
+                self.assertEqual(label_file.read(), ZPL)
+
+        # No temporary files are left behind
+        self.assertEqual(os.listdir(os.path.join(self.path, 'test')), [
+            digest[0:2]
+        ])
+
+    def test_0015_spool_parcel_labels(self):
+        """
+        Test that the labels of many parcels are split from one response,
+        whatever its chunking
+        """
+        response = ''.join(
+            ZPL + str(index) + StartTag.code + 'T8913:TN%s|T8904:%s|' % (
+                index, index
+            ) + EndTag.code
+            for index in (1, 2, 3)
+        )
+        for chunk_size in (1, 7, 13, 8192):
+            connection = FakeConnection(response, chunk_size)
+            labels = spool_parcel_labels(
+                FakeClient(connection), ['T8904:0', 'T8905:3'], 'test'
+            )
+            self.assertTrue(connection.closed)
+            self.assertEqual(
+                [r.values['T8913'] for r, _, _ in labels],
+                ['TN1', 'TN2', 'TN3']
+            )
+            for index, (_, digest, collision) in enumerate(labels, start=1):
+                self.assertEqual(
+                    digest, hashlib.md5(ZPL + str(index)).hexdigest()
+                )
+                self.assertEqual(collision, 0)
+
+        # No temporary files are left behind
+        for directory, _, filenames in os.walk(
+                os.path.join(self.path, 'test')):
+            for filename in filenames:
+                self.assertFalse(filename.startswith('.gls-'))
+
+    def test_0020_convert_zpl(self):
+        """
+        Test the conversion of labels between printer resolutions
+        """
+        zpl = '^XA^PW800^FO50,101^A0N,30,20^FDA,1^FS' \
+            '^BY2,3,100^BCN,100,Y^FD123^FS^GB400,3,3^FS^XZ'
+
+        self.assertEqual(
+            convert_zpl(zpl, 'zebrazpl200', 'zebrazpl300'),
+            '^XA^PW1200^FO75,152^A0N,45,30^FDA,1^FS'
+            '^BY3,3,150^BCN,150,Y^FD123^FS^GB600,5,5^FS^XZ'
+        )
+        self.assertEqual(
+            convert_zpl(
+                '^XA^PW1200^FO75,150^A0N,45,30^FDA,1^FS^XZ',
+                'zebrazpl300', 'zebrazpl200'
+            ),
+            '^XA^PW800^FO50,100^A0N,30,20^FDA,1^FS^XZ'
+        )
+        self.assertEqual(convert_zpl(zpl, 'zebrazpl200', 'zebrazpl200'), zpl)
+
+    def test_0030_label_archive(self):
+        """
+        Test that archived labels are read back one by one and that the
+        archive is a valid gzip file
+        """
+        archive = LabelArchive('test')
+        entries = archive.append('labels.gz', ['^XA1^XZ', ZPL])
+        entries += archive.append('labels.gz', ['^XA3^XZ'])
+
+        self.assertEqual(entries[0][0], 0)
+        self.assertEqual(
+            [archive.read('labels.gz', *entry) for entry in entries],
+            ['^XA1^XZ', ZPL, '^XA3^XZ']
+        )
+        archive_file = gzip.open(
+            os.path.join(self.path, 'test', 'gls_archive', 'labels.gz')
+        )
+        try:
+            self.assertEqual(archive_file.read(), '^XA1^XZ' + ZPL + '^XA3^XZ')
+        finally:
+            archive_file.close()
+
+    def test_0035_concurrent_label_archive(self):
+        """
+        Test that runs appending to the same archive at once record the
+        offsets of their own labels
+        """
+        archive = LabelArchive('test')
+
+        def append(run):
+            def labels():
+                for index in range(10):
+                    # Gives the other runs the time to append too
+                    time.sleep(0.001)
+                    yield '^XA%s-%s^XZ' % (run, index)
+            return archive.append('labels.gz', labels())
+
+        results = map_concurrently(append, range(4), 4)
+        for run, entries in enumerate(results):
+            self.assertEqual(
+                [archive.read('labels.gz', *entry) for entry in entries],
+                ['^XA%s-%s^XZ' % (run, index) for index in range(10)]
+            )
@@ -8,14 +8,123 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
 import os
+import time
+import json
+import hashlib
+import random
+import socket
 import unittest
+import threading
+import urlparse
+from contextlib import contextmanager
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 from trytond.config import config
+from trytond.cache import Cache
+from trytond.modules.shipping_gls.replay import replay, format_report, \
+    StandInHandler, StandInUnibox
+from trytond.modules.shipping_gls.spooler import get_printer_queue
+from trytond.modules.shipping_gls.profiling import get_category
+from trytond.modules.shipping_gls.commit_hooks import after_commit, \
+    run_after_commit
+from trytond.modules.shipping_gls import statistic as statistic_module
+
+from tests.test_spooler import StandInPrinter
 
 config.set('database', 'path', '.')
 
+# Upper bounds of the SQL queries issued by the operations, whatever the
+# number of packages or sales involved
+MAKE_GLS_LABELS_QUERIES = 80
+GET_SHIPMENT_SALE_QUERIES = 5
+GENERATE_LABEL_WIZARD_QUERIES = 110
+
+
+class TrackingServiceHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the GLS tracking service, answering with the statuses of
+    the `statuses` dictionary of the server
+    """
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        tracking_numbers = query['match'][0].split(',')
+        self.server.queries.append(tracking_numbers)
+
+        body = json.dumps({'tuStatus': [{
+            'tuNo': tracking_number,
+            'progressBar': {
+                'statusInfo': self.server.statuses[tracking_number],
+            },
+            'history': [{
+                'date': '2016-05-02', 'time': '10:20:00',
+                'evtDscr': self.server.statuses[tracking_number].title(),
+            }],
+        } for tracking_number in tracking_numbers
+            if tracking_number in self.server.statuses]})
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class UniboxHandler(StandInHandler):
+    """
+    Stand-in for the GLS Unibox answering with random tracking numbers and
+    the routing of a hub, which sends the labels of multi-parcel requests in
+    reverse order
+    """
+
+    def _get_parcels(self, tags):
+        return StandInHandler._get_parcels(self, tags)[::-1]
+
+    def _get_tracking_number(self):
+        return '%010d' % random.randint(0, 10 ** 10 - 1)
+
+    def _get_label_tags(self, tags, parcel, tracking_number):
+        return StandInHandler._get_label_tags(
+            self, tags, parcel, tracking_number
+        ) + ['T110:HUB1', 'T310:S']
+
+
+class RefusingUniboxHandler(UniboxHandler):
+    """
+    Stand-in for the GLS Unibox which refuses to cancel the parcels
+    """
+
+    def _get_void_tags(self, tags):
+        return ['T8970:Parcel already in transit']
+
+
+@contextmanager
+def count_queries():
+    """
+    Collects the SQL statements executed on the cursor of the current
+    transaction within the block, starting without any record cached by the
+    cursor
+    """
+    cursor = Transaction().cursor
+    cursor.cache.clear()
+    execute = cursor.execute
+    queries = []
+
+    def counting_execute(query, *args):
+        queries.append(query)
+        return execute(query, *args)
+
+    cursor.execute = counting_execute
+    try:
+        yield queries
+    finally:
+        del cursor.execute
+
 
 class TestGLSShipping(unittest.TestCase):
     """
@@ -24,6 +133,8 @@ class TestGLSShipping(unittest.TestCase):
 
     def setUp(self):
         trytond.tests.test_tryton.install_module('shipping_gls')
+        # Records cached by the previous tests have been rolled back
+        Cache.drop(DB_NAME)
         self.Address = POOL.get('party.address')
         self.Sale = POOL.get('sale.sale')
         self.SaleLine = POOL.get('sale.line')
@@ -50,17 +161,6 @@ class TestGLSShipping(unittest.TestCase):
         self.Template = POOL.get('product.template')
         self.GenerateLabel = POOL.get('shipping.label', type="wizard")
 
-        assert 'GLS_SERVER' in os.environ, \
-            "GLS_SERVER missing. Hint:Use export GLS_SERVER=<string>"
-        assert 'GLS_PORT' in os.environ, \
-            "GLS_PORT missing. Hint:Use export GLS_PORT=<string>"
-        assert 'GLS_CONTRACT' in os.environ, \
-            "GLS_CONTRACT missing. Hint:Use export GLS_CONTRACT=<string>"
-
-        self.gls_server = os.environ['GLS_SERVER']
-        self.gls_port = os.environ['GLS_PORT']
-        self.gls_contract = os.environ['GLS_CONTRACT']
-
     def _create_coa_minimal(self, company):
         """Create a minimal chart of accounts
         """
@@ -297,9 +397,10 @@ class TestGLSShipping(unittest.TestCase):
             'currency': self.company.currency.id,
             'carrier_product': carrier_product.id,
             'carrier_cost_method': 'gls',
-            'gls_server': self.gls_server,
-            'gls_port': self.gls_port,
-            'gls_contract': self.gls_contract,
+            # Unreachable until the tests start a stand-in for the Unibox
+            'gls_server': '127.0.0.1',
+            'gls_port': '1',
+            'gls_contract': '1234',
             'gls_customer_id': '2760179437',
             'gls_location': 'DE 460',
             'gls_shipping_depot_number': '46',
@@ -411,6 +512,7 @@ class TestGLSShipping(unittest.TestCase):
 
             # Call method to create sale order
             self.setup_defaults()
+            self.start_unibox()
             self.create_sale(self.sale_party, is_gls_shipping=True)
 
             shipment, = self.StockShipmentOut.search([])
@@ -478,3 +580,1445 @@ class TestGLSShipping(unittest.TestCase):
                     )
                 ]), 2
             )
+
+    def pack_shipments(self):
+        """
+        Pack all the shipments with a package per outgoing move
+        """
+        package_type, = self.PackageType.create([{
+            'name': 'Box',
+        }])
+        shipments = self.StockShipmentOut.search([])
+        for shipment in shipments:
+            shipment.on_change_carrier()
+            shipment.save()
+        self.StockShipmentOut.assign(shipments)
+        self.StockShipmentOut.pack(shipments)
+
+        for shipment in shipments:
+            self.Package.create([{
+                'code': '%s-%s' % (shipment.id, move.id),
+                'type': package_type.id,
+                'shipment': (shipment.__name__, shipment.id),
+                'moves': [('add', [move.id])],
+            } for move in shipment.outgoing_moves])
+        return shipments
+
+    def test_0020_generate_gls_labels_mass(self):
+        """
+        Test that GLS labels are generated for many shipments at once
+        """
+        GenerateGLSLabels = POOL.get('shipping.label.gls.mass', type='wizard')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+
+            shipment1, shipment2 = self.pack_shipments()
+
+            # Second shipment has already been labelled
+            self.StockShipmentOut.write([shipment2], {
+                'tracking_number': 'DONE',
+            })
+
+            with Transaction().set_context(
+                company=self.company.id,
+                active_ids=[shipment1.id, shipment2.id]
+            ):
+                session_id, _, _ = GenerateGLSLabels.create()
+                generate_labels = GenerateGLSLabels(session_id)
+
+                result = generate_labels.default_start({})
+                self.assertTrue(result['use_shipment_defaults'])
+                generate_labels.start.use_shipment_defaults = True
+
+                result = generate_labels.default_summary({})
+
+            shipment1 = self.StockShipmentOut(shipment1.id)
+            self.assertTrue(shipment1.tracking_number)
+            self.assertTrue(shipment1.gls_parcel_number)
+            for package in shipment1.packages:
+                self.assertTrue(package.tracking_number)
+            self.assertEqual(
+                result['tracking_numbers'].splitlines(), [
+                    '%s: %s' % (shipment1.rec_name, shipment1.tracking_number)
+                ]
+            )
+            failure, = result['failures'].splitlines()
+            self.assertTrue(failure.startswith('%s: ' % shipment2.rec_name))
+
+            self.assertEqual(
+                self.IrAttachment.search_count([
+                    (
+                        'resource', '=',
+                        '%s,%s' % (shipment1.__name__, shipment1.id)
+                    )
+                ]), 2
+            )
+
+    def test_0030_reprint_gls_labels(self):
+        """
+        Test that stored GLS labels are reprinted without calling GLS
+        """
+        ReprintGLSLabels = POOL.get(
+            'shipping.label.gls.reprint', type='wizard'
+        )
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            self.create_sale(self.sale_party)
+
+            shipment, = self.pack_shipments()
+            with Transaction().set_context(company=self.company.id):
+                shipment.make_gls_labels()
+
+            package1, package2 = shipment.packages
+            label1, label2 = shipment.get_gls_labels()
+            self.assertTrue(label1.startswith('^XA'))
+            self.assertEqual(package2.get_gls_label(), label2)
+
+            # Labels are converted for printers of the other resolution
+            self.assertIn('^FO50,50', label1)
+            self.assertIn(
+                '^FO75,75', package1.get_gls_label('zebrazpl300')
+            )
+
+            with Transaction().set_context(
+                active_model='stock.package', active_ids=[package2.id]
+            ):
+                session_id, _, _ = ReprintGLSLabels.create()
+                reprint = ReprintGLSLabels(session_id)
+
+                result = reprint.default_start({})
+                self.assertEqual(result['resolution'], 'zebrazpl200')
+                reprint.start.resolution = 'zebrazpl200'
+
+                result = reprint.default_result({})
+                self.assertEqual(str(result['label']), label2)
+
+    def test_0040_sync_gls_tracking(self):
+        """
+        Test the synchronisation of the tracking status of GLS parcels
+        """
+        server = HTTPServer(('127.0.0.1', 0), TrackingServiceHandler)
+        server.queries = []
+        server.statuses = {}
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            self.create_sale(self.sale_party)
+            self.carrier.gls_tracking_url = 'http://127.0.0.1:%s/rstt001' % (
+                server.server_port
+            )
+            self.carrier.save()
+
+            shipment, = self.pack_shipments()
+            with Transaction().set_context(company=self.company.id):
+                shipment.make_gls_labels()
+            package1, package2 = shipment.packages
+
+            server.statuses.update({
+                package1.tracking_number: 'DELIVERED',
+                package2.tracking_number: 'INTRANSIT',
+            })
+            self.Package.sync_gls_tracking()
+
+            self.assertEqual(server.queries, [[
+                package1.tracking_number, package2.tracking_number
+            ]])
+            package1, package2 = self.Package.browse([package1, package2])
+            self.assertEqual(package1.gls_tracking_state, 'delivered')
+            self.assertEqual(package1.gls_tracking_status, 'Delivered')
+            self.assertEqual(package2.gls_tracking_state, 'in_transit')
+            self.assertEqual(
+                package2.gls_tracking_event_date, datetime(2016, 5, 2, 10, 20)
+            )
+            self.assertTrue(package2.gls_tracking_checked)
+
+            # Delivered parcels are not polled anymore
+            server.statuses[package2.tracking_number] = 'INDELIVERY'
+            self.Package.sync_gls_tracking()
+
+            self.assertEqual(
+                server.queries[-1], [package2.tracking_number]
+            )
+            package2 = self.Package(package2.id)
+            self.assertEqual(package2.gls_tracking_state, 'out_for_delivery')
+
+            # Parcels of other carriers are not polled
+            self.Carrier.write([self.carrier], {
+                'carrier_cost_method': 'product',
+            })
+            self.assertFalse(self.Package._get_gls_tracking_packages(10))
+
+    def test_0050_void_gls_labels(self):
+        """
+        Test that the GLS labels of shipments are voided in bulk
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            server = self.start_unibox()
+            self.create_sale(self.sale_party)
+
+            shipment, = self.pack_shipments()
+            with Transaction().set_context(company=self.company.id):
+                shipment.make_gls_labels()
+            tracking_numbers = [p.tracking_number for p in shipment.packages]
+
+            # Unibox is not reachable
+            self.Carrier.write([self.carrier], {'gls_port': '1'})
+            self.StockShipmentOut.void_gls_labels([shipment])
+
+            shipment = self.StockShipmentOut(shipment.id)
+            self.assertTrue(shipment.tracking_number)
+            for package in shipment.packages:
+                self.assertTrue(package.tracking_number)
+                self.assertEqual(package.gls_void_state, 'failed')
+                self.assertTrue(package.gls_void_message)
+
+            # Unibox refuses the cancellation
+            refusing = StandInUnibox(handler=RefusingUniboxHandler)
+            refusing.start()
+            self.addCleanup(refusing.stop)
+            self.Carrier.write([self.carrier], {
+                'gls_port': str(refusing.port),
+            })
+            self.StockShipmentOut.void_gls_labels([shipment])
+
+            shipment = self.StockShipmentOut(shipment.id)
+            self.assertTrue(shipment.tracking_number)
+            for package in shipment.packages:
+                self.assertTrue(package.tracking_number)
+                self.assertEqual(package.gls_void_state, 'failed')
+                self.assertIn('already in transit', package.gls_void_message)
+            self.assertFalse(self.IrAttachment.search([
+                ('resource', '=', '%s,%s' % (shipment.__name__, shipment.id)),
+                ('name', 'like', 'void_%'),
+            ]))
+
+            self.Carrier.write([self.carrier], {'gls_port': str(server.port)})
+            self.StockShipmentOut.void_gls_labels([shipment])
+
+            shipment = self.StockShipmentOut(shipment.id)
+            self.assertFalse(shipment.tracking_number)
+            self.assertFalse(shipment.gls_parcel_number)
+            for package in shipment.packages:
+                self.assertFalse(package.tracking_number)
+                self.assertEqual(package.gls_void_state, 'voided')
+                self.assertFalse(package.gls_void_message)
+
+            attachments = self.IrAttachment.search([
+                ('resource', '=', '%s,%s' % (shipment.__name__, shipment.id)),
+            ], order=[('name', 'ASC')])
+            self.assertEqual(len(attachments), 2)
+            for attachment, tracking_number in zip(
+                    attachments, sorted(tracking_numbers)):
+                self.assertTrue(
+                    attachment.name.startswith('void_%s_' % tracking_number)
+                )
+
+            # Shipments of other carriers are left as they are
+            self.Carrier.write([self.carrier], {
+                'carrier_cost_method': 'product',
+            })
+            self.StockShipmentOut.write([shipment], {
+                'tracking_number': 'OTHER',
+            })
+            self.StockShipmentOut.void_gls_labels([shipment])
+            shipment = self.StockShipmentOut(shipment.id)
+            self.assertEqual(shipment.tracking_number, 'OTHER')
+
+    def start_unibox(self):
+        """
+        Starts a local stand-in for the Unibox and points the carrier to it
+        """
+        server = StandInUnibox(handler=UniboxHandler)
+        server.start()
+        self.addCleanup(server.stop)
+
+        self.Carrier.write([self.carrier], {
+            'gls_server': '127.0.0.1',
+            'gls_port': str(server.port),
+        })
+        return server
+
+    def add_packages(self, shipment, count):
+        """
+        Adds count empty packages to the shipment
+        """
+        package_type, = self.PackageType.search([], limit=1)
+        self.Package.create([{
+            'code': '%s-extra-%s' % (shipment.id, index),
+            'type': package_type.id,
+            'shipment': (shipment.__name__, shipment.id),
+        } for index in range(count)])
+
+    def test_0060_query_budget_make_gls_labels(self):
+        """
+        Test that the queries issued to generate the labels of a shipment do
+        not depend on its number of packages
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            for _ in range(3):
+                self.create_sale(self.sale_party)
+            warm_up, small, large = self.pack_shipments()
+            self.add_packages(large, 8)
+
+            counts = []
+            with Transaction().set_context(company=self.company.id):
+                warm_up.make_gls_labels()
+                for shipment in self.StockShipmentOut.browse([small, large]):
+                    with count_queries() as queries:
+                        shipment.make_gls_labels()
+                    counts.append(len(queries))
+
+            small, large = self.StockShipmentOut.browse([small, large])
+            self.assertEqual(len(small.packages), 2)
+            self.assertEqual(len(large.packages), 10)
+            for package in large.packages:
+                self.assertTrue(package.tracking_number)
+            self.assertEqual(
+                self.IrAttachment.search_count([
+                    ('resource', '=', '%s,%s' % (large.__name__, large.id)),
+                ]), 10
+            )
+
+            small_count, large_count = counts
+            self.assertLessEqual(small_count, MAKE_GLS_LABELS_QUERIES)
+            self.assertLessEqual(large_count, small_count)
+
+    def test_0070_query_budget_get_shipment_sale(self):
+        """
+        Test that preparing the shipments of many sales issues as many
+        queries as for a single sale
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            for _ in range(4):
+                self.create_sale(self.sale_party)
+            sales = self.Sale.search([])
+            key = (
+                ('planned_date', datetime.today().date()),
+                ('warehouse', sales[0].warehouse.id),
+            )
+
+            counts = []
+            for sale_ids in ([sales[0].id], [s.id for s in sales]):
+                with count_queries() as queries:
+                    for sale in self.Sale.browse(sale_ids):
+                        sale._get_shipment_sale(self.StockShipmentOut, key)
+                counts.append(len(queries))
+
+            single_count, many_count = counts
+            self.assertLessEqual(single_count, GET_SHIPMENT_SALE_QUERIES)
+            self.assertLessEqual(many_count, single_count)
+
+    def test_0080_query_budget_generate_label_wizard(self):
+        """
+        Test that the queries issued by the transitions of the label wizard
+        do not depend on the number of packages of the shipment
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            for _ in range(3):
+                self.create_sale(self.sale_party)
+            warm_up, small, large = self.pack_shipments()
+            self.add_packages(large, 8)
+
+            counts = []
+            for shipment in (warm_up, small, large):
+                with count_queries() as queries:
+                    self.run_generate_label_wizard(shipment)
+                counts.append(len(queries))
+
+            _, small_count, large_count = counts
+            self.assertLessEqual(small_count, GENERATE_LABEL_WIZARD_QUERIES)
+            self.assertLessEqual(large_count, small_count)
+            for package in self.StockShipmentOut(large.id).packages:
+                self.assertTrue(package.tracking_number)
+
+    def test_0090_gls_sale_price(self):
+        """
+        Test that sales are quoted from the GLS tariffs of the carrier
+        """
+        GLSZone = POOL.get('carrier.gls.zone')
+        GLSTariff = POOL.get('carrier.gls.tariff')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            sale_de, = self.Sale.search([('party', '=', self.sale_party.id)])
+            sale_tw, = self.Sale.search([('party', '=', self.sale_party2.id)])
+
+            def get_sale_price(sale):
+                with Transaction().set_context(sale=sale.id):
+                    return self.Carrier(self.carrier.id).get_sale_price()
+
+            # No tariffs
+            self.assertEqual(
+                get_sale_price(sale_de), (Decimal('0'), self.currency.id)
+            )
+
+            country_de, = self.Country.search([('code', '=', 'DE')])
+            national, ruhr = GLSZone.create([{
+                'carrier': self.carrier.id,
+                'zone': 'national',
+                'country': country_de.id,
+            }, {
+                'carrier': self.carrier.id,
+                'zone': 'ruhr',
+                'country': country_de.id,
+                'zip_prefix': '44',
+            }])
+            tariff, _, _ = GLSTariff.create([{
+                'carrier': self.carrier.id,
+                'zone': 'ruhr',
+                'weight': 1,
+                'price': Decimal('4'),
+            }, {
+                'carrier': self.carrier.id,
+                'zone': 'national',
+                'weight': 1,
+                'price': Decimal('5'),
+            }, {
+                'carrier': self.carrier.id,
+                'zone': 'national',
+                'weight': 5,
+                'price': Decimal('8'),
+            }])
+            self.assertEqual(
+                get_sale_price(sale_de), (Decimal('4'), self.currency.id)
+            )
+
+            # Changes of the tariffs are taken into account
+            GLSTariff.write([tariff], {'price': Decimal('4.5')})
+            self.assertEqual(get_sale_price(sale_de)[0], Decimal('4.5'))
+            GLSZone.delete([ruhr])
+            self.assertEqual(get_sale_price(sale_de)[0], Decimal('5'))
+
+            # Tariffs in another currency are converted to the currency of
+            # the company
+            self.Currency.write([self.currency], {
+                'rates': [('create', [{'rate': Decimal('1')}])],
+            })
+            dollar, = self.Currency.create([{
+                'name': 'US Dollar',
+                'code': 'USD',
+                'symbol': 'USD',
+                'rates': [('create', [{'rate': Decimal('2')}])],
+            }])
+            self.Carrier.write([self.carrier], {'currency': dollar.id})
+            with Transaction().set_context(company=self.company.id):
+                self.assertEqual(
+                    get_sale_price(sale_de), (Decimal('2.5'), self.currency.id)
+                )
+
+            # Destination is not served
+            self.assertRaises(UserError, get_sale_price, sale_tw)
+
+    def test_0100_gls_quotes(self):
+        """
+        Test that many shipments are quoted at once and the quotes memoised
+        """
+        GLSZone = POOL.get('carrier.gls.zone')
+        GLSTariff = POOL.get('carrier.gls.tariff')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            country_de, = self.Country.search([('code', '=', 'DE')])
+            GLSZone.create([{
+                'carrier': self.carrier.id,
+                'zone': 'national',
+                'country': country_de.id,
+            }, {
+                'carrier': self.carrier.id,
+                'zone': 'ruhr',
+                'country': country_de.id,
+                'zip_prefix': '44',
+            }])
+            GLSTariff.create([{
+                'carrier': self.carrier.id,
+                'zone': zone,
+                'weight': weight,
+                'price': price,
+            } for zone, weight, price in [
+                ('national', 1, Decimal('5')),
+                ('national', 5, Decimal('8')),
+                ('ruhr', 1, Decimal('4')),
+            ]])
+
+            quotes = [
+                ('DE', '44147', 0.5, 'euro_business_parcel'),
+                ('DE', '10115', 0.5, 'euro_business_parcel'),
+                ('DE', '10115', 3, 'euro_business_parcel'),
+                ('DE', '44147', 3, 'euro_business_parcel'),
+                ('TW', '100', 0.5, 'euro_business_parcel'),
+                ('DE', '10115', 0.5, 'express_parcel'),
+            ]
+            carrier = self.Carrier(self.carrier.id)
+            self.assertEqual(carrier.get_gls_quotes(quotes), [
+                Decimal('4'), Decimal('5'), Decimal('8'), None, None, None,
+            ])
+
+            # Quotes are served from the memo until they expire
+            key = (carrier.id,) + carrier.get_gls_tariff_table().get_quote_key(
+                'euro_business_parcel', 'DE', '44199', 0.8
+            )
+            price, expire = self.Carrier._gls_quote_cache.get(key)
+            self.assertEqual(price, Decimal('4'))
+            self.Carrier._gls_quote_cache.set(key, (Decimal('1'), expire))
+            self.assertEqual(carrier.get_gls_quotes([
+                ('DE', '44199', 0.8, 'euro_business_parcel'),
+            ]), [Decimal('1')])
+            self.Carrier._gls_quote_cache.set(key, (Decimal('1'), 0))
+            self.assertEqual(carrier.get_gls_quotes([
+                ('DE', '44199', 0.8, 'euro_business_parcel'),
+            ]), [Decimal('4')])
+
+    def test_0110_gls_labels_in_progress(self):
+        """
+        Test that shipments whose labels are being generated by another
+        transaction are rejected before calling GLS
+        """
+        ShipmentOut = self.StockShipmentOut
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            busy, free = self.pack_shipments()
+
+            # Simulate the lock of another transaction on the first shipment
+            ShipmentOut._lock_gls_labels = classmethod(
+                lambda cls, shipments: [s for s in shipments if s == busy]
+            )
+            try:
+                with Transaction().set_context(company=self.company.id):
+                    self.assertRaises(UserError, busy.make_gls_labels)
+                    errors = ShipmentOut.make_gls_labels_bulk(
+                        ShipmentOut.browse([busy, free])
+                    )
+            finally:
+                del ShipmentOut._lock_gls_labels
+
+            self.assertEqual(errors.keys(), [busy.id])
+            self.assertIn('already being generated', errors[busy.id])
+            busy, free = ShipmentOut.browse([busy, free])
+            self.assertFalse(busy.gls_parcel_number)
+            self.assertFalse(busy.tracking_number)
+            self.assertTrue(free.tracking_number)
+
+    def test_0120_gls_label_records(self):
+        """
+        Test that the responses of GLS are recorded for each package
+        """
+        GLSLabel = POOL.get('stock.package.gls.label')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            self.create_sale(self.sale_party)
+            shipment, = self.pack_shipments()
+            with Transaction().set_context(company=self.company.id):
+                shipment.make_gls_labels()
+
+            shipment = self.StockShipmentOut(shipment.id)
+            for index, package in enumerate(shipment.packages, start=1):
+                label, = package.gls_labels
+                self.assertEqual(label.shipment, shipment)
+                self.assertEqual(label.parcel_index, index)
+                self.assertEqual(
+                    label.tracking_number, package.tracking_number
+                )
+                self.assertEqual(label.hub, 'HUB1')
+                self.assertEqual(label.sorting_flag, 'S')
+                self.assertEqual(label.resolution, 'zebrazpl200')
+                self.assertIn('T110:HUB1', label.response)
+                self.assertEqual(
+                    label.attachment.name, shipment._get_gls_label_name(
+                        package, package.tracking_number
+                    )
+                )
+                self.assertEqual(
+                    str(label.attachment.data),
+                    '^XA^FO50,50^FD%s^FS^XZ' % package.tracking_number
+                )
+
+            # Labels are reprinted from the records
+            self.assertEqual(shipment.get_gls_labels(), [
+                '^XA^FO50,50^FD%s^FS^XZ' % package.tracking_number
+                for package in shipment.packages
+            ])
+
+            # Voided labels are deactivated
+            self.StockShipmentOut.void_gls_labels([shipment])
+            self.assertFalse(GLSLabel.search([
+                ('shipment', '=', shipment.id),
+            ]))
+            with Transaction().set_context(active_test=False):
+                self.assertEqual(GLSLabel.search_count([
+                    ('shipment', '=', shipment.id),
+                ]), 2)
+
+    def test_0130_gls_statistics(self):
+        """
+        Test that the GLS statistics are aggregated and refreshed
+        """
+        Statistic = POOL.get('stock.shipment.out.gls.statistic')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            shipments = self.pack_shipments()
+            packages = sum(len(s.packages) for s in shipments)
+
+            # Unibox is not reachable
+            self.Carrier.write([self.carrier], {'gls_port': '1'})
+            with Transaction().set_context(company=self.company.id):
+                errors = self.StockShipmentOut.make_gls_labels_bulk(
+                    shipments
+                )
+            self.assertEqual(len(errors), 2)
+
+            self.start_unibox()
+            shipments = self.StockShipmentOut.browse(map(int, shipments))
+            with Transaction().set_context(company=self.company.id):
+                self.assertFalse(
+                    self.StockShipmentOut.make_gls_labels_bulk(shipments)
+                )
+
+            Statistic.refresh()
+            statistic, = Statistic.search([])
+            self.assertEqual(statistic.carrier, self.carrier)
+            self.assertEqual(statistic.service_type, 'euro_business_parcel')
+            self.assertEqual(statistic.shipments, 2)
+            self.assertEqual(statistic.labelled, 2)
+            self.assertEqual(statistic.packages, packages)
+            self.assertEqual(statistic.labels, packages)
+            self.assertEqual(statistic.voided, 0)
+            self.assertEqual(statistic.label_failures, 2)
+            self.assertEqual(statistic.label_failure_rate, 0.5)
+            self.assertIsNotNone(statistic.label_latency)
+
+            # Only the days of the changed shipments are refreshed
+            self.StockShipmentOut.void_gls_labels(shipments[:1])
+            Statistic.refresh()
+            statistic, = Statistic.search([])
+            self.assertEqual(statistic.labelled, 1)
+            self.assertEqual(statistic.voided, len(shipments[0].packages))
+            self.assertEqual(statistic.void_failures, 0)
+            self.assertEqual(
+                Statistic._get_changed_dates(
+                    datetime.now() + relativedelta(days=1)
+                ), []
+            )
+
+            # The last refresh is stored to the second, the next changes
+            # are made after it
+            time.sleep(1)
+            Statistic.refresh(rebuild=True)
+            rebuilt, = Statistic.search([])
+            self.assertEqual(rebuilt.labelled, 1)
+            self.assertEqual(rebuilt.voided, statistic.voided)
+
+            # Days the shipments are moved from are refreshed too, even
+            # without other changes since the last refresh
+            self.addCleanup(
+                setattr, statistic_module, 'REFRESH_OVERLAP',
+                statistic_module.REFRESH_OVERLAP
+            )
+            statistic_module.REFRESH_OVERLAP = 0
+            date = statistic.date
+            self.StockShipmentOut.write([shipments[1]], {
+                'planned_date': date + relativedelta(days=1),
+            })
+            Statistic.refresh()
+            moved, = Statistic.search([('date', '!=', date)])
+            self.assertEqual(moved.shipments, 1)
+            statistic, = Statistic.search([('date', '=', date)])
+            self.assertEqual(statistic.shipments, 1)
+            self.assertFalse(statistic.stale)
+
+            # Days the shipments are deleted from are refreshed too
+            draft, = self.StockShipmentOut.copy([shipments[0]], {
+                'planned_date': date,
+                'packages': None,
+            })
+            Statistic.refresh()
+            statistic, = Statistic.search([('date', '=', date)])
+            self.assertEqual(statistic.shipments, 2)
+            time.sleep(1)
+            self.StockShipmentOut.delete([draft])
+            Statistic.refresh()
+            statistic, = Statistic.search([('date', '=', date)])
+            self.assertEqual(statistic.shipments, 1)
+
+            # The last refresh is kept when it found no GLS shipment
+            self.Carrier.write([self.carrier], {
+                'carrier_cost_method': 'product',
+            })
+            Statistic.refresh()
+            self.assertFalse(Statistic.search([]))
+            self.assertGreater(
+                Statistic._get_refresh_start(),
+                datetime.now() - relativedelta(days=1)
+            )
+
+    def test_0140_gls_accounts(self):
+        """
+        Test that the shipments are spread over the GLS accounts by weight
+        """
+        GLSAccount = POOL.get('carrier.gls.account')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            account1, account2 = GLSAccount.create([{
+                'carrier': self.carrier.id,
+                'contract': 'C1',
+                'customer_id': '1001',
+                'customer_number': '2001',
+                'weight': 2,
+            }, {
+                'carrier': self.carrier.id,
+                'contract': 'C2',
+                'customer_id': '1002',
+                'customer_number': '2002',
+            }])
+            for party in (self.sale_party, self.sale_party2, self.sale_party):
+                self.create_sale(party)
+            shipments = self.pack_shipments()
+
+            with Transaction().set_context(company=self.company.id):
+                self.assertFalse(
+                    self.StockShipmentOut.make_gls_labels_bulk(shipments)
+                )
+
+            shipments = self.StockShipmentOut.browse(map(int, shipments))
+            self.assertEqual(
+                [s.gls_account for s in shipments],
+                [account1, account2, account1]
+            )
+            # Parcels are voided with the account they were labelled with
+            _, _, tags = shipments[1]._get_gls_void_requests()[0]
+            self.assertIn('T8914:C2', tags)
+            self.assertIn('T8915:1002', tags)
+
+            # Loads of the day are taken into account
+            self.assertEqual(
+                GLSAccount.get_loads([account1, account2]),
+                {account1.id: 2, account2.id: 1}
+            )
+            self.assertEqual(self.carrier.pick_gls_accounts(3), [
+                account1, account2, account1
+            ])
+
+    def test_0150_replay(self):
+        """
+        Test that historical shipments are replayed against the stand-in
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            shipments = self.pack_shipments()
+            packages = sum(len(s.packages) for s in shipments)
+            filestore = os.path.join(config.get('database', 'path'), DB_NAME)
+            files = list(os.walk(filestore))
+
+            with Transaction().set_context(company=self.company.id):
+                report = replay(shipments, concurrency=2, latency=0.01)
+
+            self.assertEqual(report['shipments'], 2)
+            self.assertEqual(report['labels'], packages)
+            self.assertEqual(report['errors'], 0)
+            self.assertTrue(report['labels_per_minute'])
+            self.assertGreaterEqual(report['latency']['p100'], 0.01)
+            self.assertGreaterEqual(report['stages']['request'], 0.01)
+            self.assertIn('labels/minute', format_report(report))
+            # Nothing was spooled into the filestore of the database
+            self.assertEqual(list(os.walk(filestore)), files)
+
+            # Labels were stored as usual
+            for shipment in self.StockShipmentOut.browse(map(int, shipments)):
+                for package in shipment.packages:
+                    self.assertTrue(package.tracking_number.startswith('R'))
+
+    def test_0160_archive_labels(self):
+        """
+        Test that old labels are moved from their attachments to an archive
+        """
+        GLSLabel = POOL.get('stock.package.gls.label')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            shipment, legacy = self.pack_shipments()
+            with Transaction().set_context(company=self.company.id):
+                shipment.make_gls_labels()
+            shipment = self.StockShipmentOut(shipment.id)
+            labels = shipment.get_gls_labels()
+
+            # Labels stored as attachments only, before label records
+            self.StockShipmentOut.write([legacy], {
+                'tracking_number': 'LEGACY',
+                'gls_parcel_number': '12345678901',
+            })
+            legacy_labels = []
+            for index, package in enumerate(legacy.packages):
+                number = 'LEGACY%04d' % index
+                self.Package.write([package], {'tracking_number': number})
+                legacy_labels.append('^XA^FD%s^FS^XZ' % number)
+                self.IrAttachment.create([{
+                    'name': legacy._get_gls_label_name(package, number),
+                    'data': legacy_labels[-1],
+                    'resource': '%s,%s' % (legacy.__name__, legacy.id),
+                }])
+            legacy = self.StockShipmentOut(legacy.id)
+            self.assertEqual(legacy.get_gls_labels(), legacy_labels)
+
+            # Labels are not old enough
+            GLSLabel.archive_labels()
+            self.assertFalse(GLSLabel.search([('archive', '!=', None)]))
+
+            files = [
+                os.path.join(
+                    config.get('database', 'path'), DB_NAME,
+                    a.digest[0:2], a.digest[2:4], a.digest
+                ) for a in self.IrAttachment.search([
+                    ('resource', '=', '%s,%s' % (
+                        shipment.__name__, shipment.id
+                    )),
+                ])
+            ]
+            self.assertEqual(len(files), len(labels))
+            self.assertTrue(all(map(os.path.exists, files)))
+
+            GLSLabel.archive_labels(days=-1)
+            records = GLSLabel.search([('shipment', '=', shipment.id)])
+            self.assertEqual(len(records), len(labels))
+            for record in records:
+                self.assertFalse(record.attachment)
+                self.assertTrue(record.archive)
+            # The files of the attachments are removed from the filestore
+            # once the transaction is committed
+            self.assertTrue(all(map(os.path.exists, files)))
+            run_after_commit(Transaction().cursor)
+            self.assertFalse(any(map(os.path.exists, files)))
+            self.assertFalse(self.IrAttachment.search([
+                ('resource', '=', '%s,%s' % (shipment.__name__, shipment.id)),
+            ]))
+            # and so are the legacy labels
+            records = GLSLabel.search([('shipment', '=', legacy.id)])
+            self.assertEqual(len(records), len(legacy_labels))
+            for record in records:
+                self.assertFalse(record.attachment)
+                self.assertTrue(record.archive)
+            self.assertFalse(self.IrAttachment.search([
+                ('resource', '=', '%s,%s' % (legacy.__name__, legacy.id)),
+            ]))
+
+            Cache.drop(DB_NAME)
+            shipment = self.StockShipmentOut(shipment.id)
+            self.assertEqual(shipment.get_gls_labels(), labels)
+            legacy = self.StockShipmentOut(legacy.id)
+            self.assertEqual(legacy.get_gls_labels(), legacy_labels)
+            package = shipment.packages[-1]
+            self.assertEqual(
+                GLSLabel.get_label_by_number(package.tracking_number),
+                labels[-1]
+            )
+            self.assertIsNone(GLSLabel.get_label_by_number('UNKNOWN'))
+
+    def test_0170_multi_parcel_labels(self):
+        """
+        Test that the labels of all the packages are requested at once
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            self.Carrier.write([self.carrier], {'gls_multi_parcel': True})
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            shipment1, shipment2 = self.pack_shipments()
+            self.add_packages(shipment1, 3)
+            self.add_packages(shipment2, 3)
+
+            shipment1 = self.StockShipmentOut(shipment1.id)
+            request, = shipment1._get_gls_label_requests()
+            self.assertEqual(request[0], list(shipment1.packages))
+            self.assertIn('T8904:0', request[2])
+
+            with Transaction().set_context(company=self.company.id):
+                shipment1.make_gls_labels()
+                self.assertFalse(
+                    self.StockShipmentOut.make_gls_labels_bulk([shipment2])
+                )
+            run_after_commit(Transaction().cursor)
+
+            for shipment in self.StockShipmentOut.browse(
+                    [shipment1.id, shipment2.id]):
+                self.assertEqual(len(shipment.packages), 5)
+                # Labels are matched to the packages by parcel index
+                for index, package in enumerate(shipment.packages, start=1):
+                    label, = package.gls_labels
+                    self.assertEqual(label.parcel_index, index)
+                    self.assertTrue(package.tracking_number)
+                self.assertEqual(shipment.get_gls_labels(), [
+                    '^XA^FO50,50^FD%s^FS^XZ' % package.tracking_number
+                    for package in shipment.packages
+                ])
+
+    def test_0180_gls_consignor_cache(self):
+        """
+        Test that the consignor section is built once and rebuilt when the
+        records it is built from change
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.create_sale(self.sale_party)
+            shipment, = self.pack_shipments()
+
+            values = shipment._get_gls_consignor_values()
+            self.assertIs(
+                self.StockShipmentOut(shipment.id)._get_gls_consignor_values(),
+                values
+            )
+            address = shipment._get_ship_from_address()
+            self.assertEqual(values['T820'], address.street)
+
+            self.Address.write([address], {'street': 'Other Street'})
+            self.Party.write([address.party], {'name': 'Other Warehouse'})
+            self.Carrier.write([self.carrier], {
+                'gls_consignor_label': 'Other Label',
+            })
+            values = self.StockShipmentOut(
+                shipment.id
+            )._get_gls_consignor_values()
+            self.assertEqual(values['T820'], 'Other Street')
+            self.assertEqual(values['T810'], 'Other Warehouse')
+            self.assertEqual(values['T850'], 'Other Label')
+
+            # The customer number depends on the account of the shipment
+            self.assertNotIn('T805', values)
+
+    def test_0190_print_gls_labels(self):
+        """
+        Test that the labels are pushed to the printer of the warehouse as
+        soon as they are generated
+        """
+        Printer = POOL.get('stock.gls.printer')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            printer = StandInPrinter()
+            self.addCleanup(printer.server_close)
+            self.addCleanup(printer.shutdown)
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            shipment1, shipment2 = self.pack_shipments()
+            self.assertFalse(Printer.get_warehouse_printers())
+
+            Printer.create([{
+                'name': 'Pack Station',
+                'warehouse': shipment1.warehouse.id,
+                'host': '127.0.0.1',
+                'port': printer.server_address[1],
+                'resolution': 'zebrazpl300',
+            }])
+            self.assertEqual(Printer.get_warehouse_printers(), {
+                shipment1.warehouse.id: (
+                    '127.0.0.1', printer.server_address[1], 'zebrazpl300'
+                ),
+            })
+
+            with Transaction().set_context(company=self.company.id):
+                shipment1.make_gls_labels()
+                self.assertFalse(
+                    self.StockShipmentOut.make_gls_labels_bulk([shipment2])
+                )
+            queue = get_printer_queue('127.0.0.1', printer.server_address[1])
+            # Nothing is printed before the transaction is committed
+            queue.join()
+            self.assertFalse(printer.received)
+            run_after_commit(Transaction().cursor)
+            queue.join()
+
+            labels = []
+            for shipment in self.StockShipmentOut.browse(
+                    [shipment1.id, shipment2.id]):
+                labels.extend(shipment.get_gls_labels('zebrazpl300'))
+            self.assertEqual(printer.wait(''.join(labels)), ''.join(labels))
+
+    def test_0200_profile_gls_labels(self):
+        """
+        Test that the label generation is profiled when enabled by the
+        carrier or the context
+        """
+        directory = os.path.join(
+            config.get('database', 'path'), DB_NAME, 'gls_profiles'
+        )
+
+        def get_profiles(prefix):
+            if not os.path.isdir(directory):
+                return []
+            return sorted(
+                name for name in os.listdir(directory)
+                if name.startswith(prefix)
+            )
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            shipment1, shipment2 = self.pack_shipments()
+
+            with Transaction().set_context(
+                    company=self.company.id, gls_profile=True):
+                shipment1.make_gls_labels()
+            prefix = 'shipment-%s-' % shipment1.id
+            profile, summary = get_profiles(prefix)
+            self.assertTrue(profile.endswith('.prof'))
+            with open(os.path.join(directory, summary)) as summary_file:
+                summary = summary_file.read()
+            for category in ('orm', 'api', 'network', 'parsing'):
+                self.assertIn(category, summary)
+
+            batches = len(get_profiles('batch-'))
+            with Transaction().set_context(company=self.company.id):
+                self.StockShipmentOut.make_gls_labels_bulk([shipment2])
+            self.assertEqual(len(get_profiles('batch-')), batches)
+
+            self.Carrier.write([self.carrier], {'gls_profile': True})
+            shipment2 = self.StockShipmentOut(shipment2.id)
+            with Transaction().set_context(company=self.company.id):
+                self.StockShipmentOut.make_gls_labels_bulk([shipment2])
+            self.assertEqual(len(get_profiles('batch-')), batches + 2)
+
+        self.assertEqual(get_category(
+            '~', "<method 'recv' of '_socket.socket' objects>"
+        ), 'network')
+        self.assertEqual(get_category(
+            '/lib/gls_unibox_api/api.py', 'parse'
+        ), 'parsing')
+        self.assertEqual(get_category(
+            '/lib/trytond/model/modelstorage.py', 'read'
+        ), 'orm')
+        self.assertEqual(get_category('/lib/decimal.py', '__new__'), 'other')
+
+    def test_0210_check_gls_connections(self):
+        """
+        Test that the Unibox connections of the GLS carriers are checked
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            server = self.start_unibox()
+            self.assertEqual(
+                self.Carrier.check_gls_connections(), {self.carrier: None}
+            )
+            server.stop()
+
+            errors = self.Carrier.check_gls_connections()
+            self.assertIsInstance(errors[self.carrier], socket.error)
+
+    def test_0220_gls_reference_lookups(self):
+        """
+        Test that the reference lookups are cached and follow the changes
+        of the records
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.create_sale(self.sale_party)
+            shipment, = self.pack_shipments()
+
+            self.assertEqual(shipment._get_weight_uom().symbol, 'kg')
+
+            self.assertEqual(
+                self.Carrier.get_gls_carrier_ids(), set([self.carrier.id])
+            )
+            self.assertIs(
+                self.Carrier.get_gls_carrier_ids(),
+                self.Carrier.get_gls_carrier_ids()
+            )
+            self.assertTrue(shipment.get_is_gls_shipping())
+
+            self.Carrier.write([self.carrier], {
+                'carrier_cost_method': 'product',
+            })
+            self.assertFalse(self.Carrier.get_gls_carrier_ids())
+            shipment = self.StockShipmentOut(shipment.id)
+            self.assertFalse(shipment.get_is_gls_shipping())
+
+    def test_0230_combined_gls_labels(self):
+        """
+        Test that the labels of a shipment are stored as a single document
+        which serves the label of each package
+        """
+        GLSLabel = POOL.get('stock.package.gls.label')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            self.Carrier.write([self.carrier], {'gls_combined_labels': True})
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            shipment1, shipment2 = self.pack_shipments()
+            self.add_packages(shipment1, 2)
+
+            shipment1 = self.StockShipmentOut(shipment1.id)
+            with Transaction().set_context(company=self.company.id):
+                shipment1.make_gls_labels()
+                self.assertFalse(
+                    self.StockShipmentOut.make_gls_labels_bulk([shipment2])
+                )
+            run_after_commit(Transaction().cursor)
+
+            for shipment in self.StockShipmentOut.browse(
+                    [shipment1.id, shipment2.id]):
+                attachment, = self.IrAttachment.search([
+                    ('resource', '=', '%s,%s' % (
+                        shipment.__name__, shipment.id
+                    )),
+                ])
+                self.assertEqual(
+                    attachment.name, shipment._get_gls_document_name()
+                )
+                labels = [
+                    '^XA^FO50,50^FD%s^FS^XZ' % package.tracking_number
+                    for package in shipment.packages
+                ]
+                self.assertEqual(str(attachment.data), ''.join(labels))
+                self.assertEqual(shipment.get_gls_labels(), labels)
+                # The spooled labels are not left in the filestore
+                for data in [''.join(labels)] + labels:
+                    digest = hashlib.md5(data).hexdigest()
+                    self.assertEqual(os.path.exists(os.path.join(
+                        config.get('database', 'path'), DB_NAME,
+                        digest[0:2], digest[2:4], digest
+                    )), data == str(attachment.data))
+                # Partial reprint
+                self.assertEqual(
+                    shipment.packages[-1].get_gls_label(), labels[-1]
+                )
+
+            GLSLabel.archive_labels(days=-1)
+            self.assertFalse(self.IrAttachment.search([
+                ('resource', '=', '%s,%s' % (
+                    shipment1.__name__, shipment1.id
+                )),
+            ]))
+            Cache.drop(DB_NAME)
+            shipment1 = self.StockShipmentOut(shipment1.id)
+            self.assertEqual(shipment1.get_gls_labels(), [
+                '^XA^FO50,50^FD%s^FS^XZ' % package.tracking_number
+                for package in shipment1.packages
+            ])
+
+    def test_0240_gls_defaults_on_create(self):
+        """
+        Test that sales and shipments created without the GLS values get
+        the ones of their carrier
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.Carrier.write([self.carrier], {
+                'gls_shipping_service_type': 'express_parcel',
+            })
+            party = self.sale_party
+            with Transaction().set_context(company=self.company.id):
+                sale, other = self.Sale.create([{
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'carrier': self.carrier.id,
+                }, {
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                    'carrier': self.carrier.id,
+                    'gls_shipping_depot_number': '12',
+                }])
+            self.assertEqual(sale.gls_shipping_depot_number, '46')
+            self.assertEqual(sale.gls_shipping_service_type, 'express_parcel')
+            self.assertEqual(other.gls_shipping_depot_number, '12')
+            self.assertEqual(
+                other.gls_shipping_service_type, 'express_parcel'
+            )
+
+            # Sales without a carrier get the default one first
+            with Transaction().set_context(company=self.company.id):
+                self.SaleConfig.write([self.SaleConfig(1)], {
+                    'sale_carrier': self.carrier.id,
+                })
+                sale, = self.Sale.create([{
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'shipment_address': party.addresses[0].id,
+                }])
+            self.assertEqual(sale.carrier, self.carrier)
+            self.assertEqual(sale.gls_shipping_depot_number, '46')
+            self.assertEqual(sale.gls_shipping_service_type, 'express_parcel')
+
+            warehouse, = self.StockLocation.search([
+                ('type', '=', 'warehouse'),
+            ], limit=1)
+            with Transaction().set_context(company=self.company.id):
+                shipment, = self.StockShipmentOut.create([{
+                    'customer': party.id,
+                    'delivery_address': party.addresses[0].id,
+                    'warehouse': warehouse.id,
+                    'carrier': self.carrier.id,
+                    'cost_currency': self.company.currency.id,
+                }])
+            self.assertEqual(shipment.gls_shipping_depot_number, '46')
+            self.assertEqual(
+                shipment.gls_shipping_service_type, 'express_parcel'
+            )
+
+    def test_0250_pregenerate_gls_labels(self):
+        """
+        Test that the labels of packed shipments are generated ahead while
+        the users do not generate labels, and are then returned as they are
+        """
+        GLSLabel = POOL.get('stock.package.gls.label')
+        ModelData = POOL.get('ir.model.data')
+        Printer = POOL.get('stock.gls.printer')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.start_unibox()
+            printer = StandInPrinter()
+            self.addCleanup(printer.server_close)
+            self.addCleanup(printer.shutdown)
+            queue = get_printer_queue('127.0.0.1', printer.server_address[1])
+            self.create_sale(self.sale_party)
+            self.create_sale(self.sale_party2)
+            shipment1, shipment2 = self.pack_shipments()
+            Printer.create([{
+                'name': 'Pack Station',
+                'warehouse': shipment1.warehouse.id,
+                'host': '127.0.0.1',
+                'port': printer.server_address[1],
+                'resolution': 'zebrazpl300',
+            }])
+
+            with Transaction().set_context(company=self.company.id):
+                self.StockShipmentOut.pregenerate_gls_labels()
+            shipment1, shipment2 = self.StockShipmentOut.browse(
+                [shipment1.id, shipment2.id]
+            )
+            self.assertTrue(shipment1.tracking_number)
+            self.assertTrue(shipment2.tracking_number)
+            labels = shipment1.get_gls_labels()
+            parcel_number = shipment1.gls_parcel_number
+            count = GLSLabel.search([], count=True)
+            # Nothing is printed before the labels are asked for
+            queue.join()
+            self.assertFalse(printer.received)
+
+            # Labelled shipments are not labelled again, and the label wizard
+            # returns their labels
+            with Transaction().set_context(company=self.company.id):
+                self.StockShipmentOut.pregenerate_gls_labels()
+            result = self.run_generate_label_wizard(shipment1)
+            self.assertEqual(GLSLabel.search([], count=True), count)
+            self.assertEqual(len(result['attachments']), 2)
+            run_after_commit(Transaction().cursor)
+            shipment1 = self.StockShipmentOut(shipment1.id)
+            self.assertEqual(shipment1.gls_parcel_number, parcel_number)
+            self.assertEqual(shipment1.get_gls_labels(), labels)
+            # but their labels are printed once asked for
+            queue.join()
+            printed = ''.join(shipment1.get_gls_labels('zebrazpl300'))
+            self.assertEqual(printer.wait(printed), printed)
+
+            # Labels which were not generated ahead are left alone
+            self.StockShipmentOut.write([shipment1], {
+                'gls_label_key': None,
+            })
+            shipment1 = self.StockShipmentOut(shipment1.id)
+            with Transaction().set_context(company=self.company.id):
+                shipment1.make_gls_labels()
+            run_after_commit(Transaction().cursor)
+            queue.join()
+            self.assertEqual(''.join(printer.received), printed)
+
+            # Labels generated ahead with other package weights are voided
+            # and generated again
+            tracking_number = shipment2.tracking_number
+            self.Package.write([shipment2.packages[0]], {
+                'override_weight': 12.5,
+            })
+            with Transaction().set_context(company=self.company.id):
+                shipment2.make_gls_labels()
+            shipment2 = self.StockShipmentOut(shipment2.id)
+            self.assertTrue(shipment2.tracking_number)
+            self.assertNotEqual(shipment2.tracking_number, tracking_number)
+            self.assertEqual(GLSLabel.search([
+                ('shipment', '=', shipment2.id),
+            ], count=True), len(shipment2.packages))
+
+            # Nothing is generated ahead while a user generates labels
+            self.create_sale(self.sale_party)
+            shipment3, = self.StockShipmentOut.search([
+                ('state', '=', 'waiting'),
+            ])
+            shipment3.on_change_carrier()
+            shipment3.save()
+            self.StockShipmentOut.assign([shipment3])
+            self.StockShipmentOut.pack([shipment3])
+            self.add_packages(shipment3, 1)
+            label_table = GLSLabel.__table__()
+            Transaction().cursor.execute(*label_table.update(
+                [label_table.create_uid],
+                [ModelData.get_id('shipping_gls', 'user_gls_cron')]
+            ))
+            with Transaction().set_context(company=self.company.id):
+                self.StockShipmentOut.pregenerate_gls_labels()
+            self.assertFalse(
+                self.StockShipmentOut(shipment3.id).tracking_number
+            )
+
+            # The next run once the users are idle labels it
+            Transaction().cursor.execute(*label_table.update(
+                [label_table.create_date],
+                [datetime.now() - relativedelta(minutes=5)]
+            ))
+            with Transaction().set_context(company=self.company.id):
+                self.StockShipmentOut.pregenerate_gls_labels()
+            self.assertTrue(
+                self.StockShipmentOut(shipment3.id).tracking_number
+            )
+
+    def test_0260_parcel_check_number(self):
+        """
+        Test the check digit of the parcel numbers, which is a single digit
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            shipment = self.StockShipmentOut()
+            self.assertEqual(
+                shipment._gen_parcel_check_number('00000000001'), '6'
+            )
+            # The weighted sum plus one is a multiple of 10
+            self.assertEqual(
+                shipment._gen_parcel_check_number('00000000003'), '0'
+            )
+            self.assertEqual(
+                shipment._gen_parcel_check_number('00000000025'), '2'
+            )
+            for number in range(1000):
+                number = '%011d' % number
+                digit = shipment._gen_parcel_check_number(number)
+                self.assertEqual(len(digit), 1, number)
+
+    def test_0270_after_commit(self):
+        """
+        Test that the calls registered after commit are run by the commit
+        only
+        """
+        calls = []
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            after_commit(calls.append, 'rolled back')
+            Transaction().cursor.rollback()
+            self.assertEqual(calls, [])
+
+            after_commit(calls.append, 'committed')
+            self.assertEqual(calls, [])
+            Transaction().cursor.commit()
+            self.assertEqual(calls, ['committed'])
+
+            Transaction().cursor.commit()
+            self.assertEqual(calls, ['committed'])
+
+    def test_0280_gls_model_access(self):
+        """
+        Test the access of the stock, sale and administration users to the
+        GLS models
+        """
+        ModelData = POOL.get('ir.model.data')
+        ModelAccess = POOL.get('ir.model.access')
+
+        # Read and write access of each group, in the order of the models
+        models = [
+            'carrier.gls.account', 'carrier.gls.zone', 'carrier.gls.tariff',
+            'stock.gls.printer', 'stock.package.gls.label',
+            'stock.shipment.out.gls.statistic',
+        ]
+        expected = [
+            ('stock', 'group_stock', [
+                (True, False), (True, False), (True, False),
+                (True, False), (True, True), (True, False),
+            ]),
+            ('stock', 'group_stock_admin', [
+                (False, False), (False, False), (False, False),
+                (True, True), (True, True), (False, False),
+            ]),
+            ('sale', 'group_sale', [
+                (True, False), (True, False), (True, False),
+                (True, False), (False, False), (False, False),
+            ]),
+            ('carrier', 'group_carrier_admin', [
+                (True, True), (True, True), (True, True),
+                (True, False), (False, False), (False, False),
+            ]),
+            ('res', 'group_admin', [
+                (False, False), (False, False), (False, False),
+                (True, False), (False, False), (False, False),
+            ]),
+        ]
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            for module, group, accesses in expected:
+                user, = self.User.create([{
+                    'name': group,
+                    'login': 'gls_%s' % group,
+                    'main_company': self.company.id,
+                    'company': self.company.id,
+                    'groups': [('add', [ModelData.get_id(module, group)])],
+                }])
+                with Transaction().set_user(user.id):
+                    access = ModelAccess.get_access(models)
+                self.assertEqual([
+                    (access[model]['read'], access[model]['write'])
+                    for model in models
+                ], accesses, group)
+
+    def run_generate_label_wizard(self, shipment):
+        """
+        Runs the label wizard through all its transitions for the shipment
+        """
+        with Transaction().set_context(
+            company=self.company.id, active_id=shipment.id
+        ):
+            session_id, _, _ = self.GenerateLabel.create()
+            generate_label = self.GenerateLabel(session_id)
+
+            result = generate_label.default_start({})
+            generate_label.start.shipment = result['shipment']
+            generate_label.start.carrier = result['carrier']
+            generate_label.start.override_weight = None
+            self.assertEqual(generate_label.transition_next(), 'gls_config')
+
+            result = generate_label.default_gls_config({})
+            generate_label.gls_config.service_type = result['service_type']
+            generate_label.gls_config.depot_number = result['depot_number']
+            return generate_label.default_generate({})
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_spooler.py
+
+"""
+import time
+import socket
+import threading
+import unittest
+import SocketServer
+
+from trytond.modules.shipping_gls.spooler import PrinterQueue
+
+
+class PrinterHandler(SocketServer.BaseRequestHandler):
+    """
+    Keeps the data received over each connection
+    """
+
+    def handle(self):
+        data = ''
+        while True:
+            chunk = self.request.recv(8192)
+            if not chunk:
+                break
+            data += chunk
+        self.server.received.append(data)
+
+
+class StandInPrinter(SocketServer.TCPServer):
+    """
+    Local stand-in for a printer listening on a raw TCP port, which handles
+    the connections one at a time so that the data is kept in the order it
+    was sent
+    """
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(
+            self, ('127.0.0.1', 0), PrinterHandler
+        )
+        self.received = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def wait(self, data, timeout=5):
+        """
+        Returns the data received once it is as long as data, or after the
+        timeout, since the connections are handled in the background
+        """
+        end = time.time() + timeout
+        while len(''.join(self.received)) < len(data) and time.time() < end:
+            time.sleep(0.01)
+        return ''.join(self.received)
+
+
+class FlakyPrinterQueue(PrinterQueue):
+    """
+    Printer queue whose first sends fail
+    """
+    failures = 2
+
+    def send(self, data):
+        if self.failures:
+            self.failures -= 1
+            raise socket.error('Printer is busy')
+        super(FlakyPrinterQueue, self).send(data)
+
+
+class TestPrinterQueue(unittest.TestCase):
+    """
+    Test the queues of the label printers
+    """
+
+    def setUp(self):
+        self.printer = StandInPrinter()
+
+    def tearDown(self):
+        self.printer.shutdown()
+        self.printer.server_close()
+
+    def test_0010_print_labels(self):
+        """
+        Test that the labels are sent in order
+        """
+        queue = PrinterQueue(
+            '127.0.0.1', self.printer.server_address[1], timeout=1,
+            batch_size=2
+        )
+        labels = ['^XA^FD%s^FS^XZ' % index for index in range(5)]
+        queue.put(labels)
+        queue.join()
+
+        self.assertEqual(self.printer.wait(''.join(labels)), ''.join(labels))
+        # Labels are sent in batches of at most two
+        self.assertGreaterEqual(len(self.printer.received), 3)
+
+    def test_0020_retry(self):
+        """
+        Test that a batch is sent again after failures and dropped once the
+        retries are spent
+        """
+        queue = FlakyPrinterQueue(
+            '127.0.0.1', self.printer.server_address[1], timeout=1,
+            retries=2, retry_delay=0
+        )
+        queue.put(['^XA^FD1^FS^XZ'])
+        queue.join()
+        self.assertEqual(self.printer.wait('^XA^FD1^FS^XZ'), '^XA^FD1^FS^XZ')
+
+        queue.failures = 3
+        queue.put(['^XA^FD2^FS^XZ'])
+        queue.join()
+        self.assertEqual(self.printer.received, ['^XA^FD1^FS^XZ'])
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_tariff.py
+
+"""
+import unittest
+from decimal import Decimal
+
+from trytond.modules.shipping_gls.tariff import TariffTable
+
+
+class TestTariffTable(unittest.TestCase):
+    """
+    Test quoting on GLS tariff tables
+    """
+
+    def setUp(self):
+        self.table = TariffTable([
+            ('DE', None, 'national'),
+            ('DE', '44', 'ruhr'),
+            ('DE', '441', 'dortmund'),
+            ('AT', '', 'europe'),
+        ], [
+            ('euro_business_parcel', 'national', 5.0, Decimal('8')),
+            ('euro_business_parcel', 'national', 1.0, Decimal('5')),
+            ('euro_business_parcel', 'ruhr', 1.0, Decimal('4')),
+            ('euro_business_parcel', 'dortmund', 1.0, Decimal('3')),
+            ('express_parcel', 'national', 1.0, Decimal('12')),
+        ])
+
+    def test_0010_get_zone(self):
+        """
+        Test that the longest matching zip prefix wins
+        """
+        self.assertEqual(self.table.get_zone('DE', '10115'), 'national')
+        self.assertEqual(self.table.get_zone('DE', '45141'), 'national')
+        self.assertEqual(self.table.get_zone('DE', '44789'), 'ruhr')
+        self.assertEqual(self.table.get_zone('DE', '44 147'), 'dortmund')
+        self.assertEqual(self.table.get_zone('DE', None), 'national')
+        self.assertEqual(self.table.get_zone('AT', '1010'), 'europe')
+        self.assertIsNone(self.table.get_zone('TW', '100'))
+
+    def test_0020_get_price(self):
+        """
+        Test that the weight is priced with the lightest bracket it fits in
+        """
+        get_price = self.table.get_price
+        self.assertEqual(
+            get_price('euro_business_parcel', 'national', 0.5), Decimal('5')
+        )
+        self.assertEqual(
+            get_price('euro_business_parcel', 'national', 1.0), Decimal('5')
+        )
+        self.assertEqual(
+            get_price('euro_business_parcel', 'national', 1.01), Decimal('8')
+        )
+        self.assertIsNone(get_price('euro_business_parcel', 'national', 6))
+        self.assertIsNone(get_price('euro_business_parcel', 'europe', 1))
+        self.assertEqual(
+            get_price('express_parcel', 'national', 1), Decimal('12')
+        )
+
+    def test_0030_quote(self):
+        """
+        Test quoting a destination
+        """
+        self.assertTrue(self.table)
+        self.assertFalse(TariffTable([], []))
+        self.assertEqual(
+            self.table.quote('euro_business_parcel', 'DE', '44147', 0.4),
+            Decimal('3')
+        )
+        self.assertIsNone(
+            self.table.quote('euro_business_parcel', 'TW', '100', 0.4)
+        )
+
+    def test_0040_get_quote_key(self):
+        """
+        Test that the quotes with the same price share their key
+        """
+        get_quote_key = self.table.get_quote_key
+        self.assertEqual(
+            get_quote_key('euro_business_parcel', 'DE', '44147', 0.4),
+            get_quote_key('euro_business_parcel', 'DE', '44199', 0.9)
+        )
+        self.assertNotEqual(
+            get_quote_key('euro_business_parcel', 'DE', '44147', 0.4),
+            get_quote_key('euro_business_parcel', 'DE', '44247', 0.4)
+        )
+        self.assertNotEqual(
+            get_quote_key('euro_business_parcel', 'DE', '44147', 0.4),
+            get_quote_key('euro_business_parcel', 'DE', '44147', 1.5)
+        )
+        self.assertEqual(
+            get_quote_key('euro_business_parcel', 'AT', '1010', 0.4),
+            get_quote_key('euro_business_parcel', 'AT', '8010', 0.4)
+        )
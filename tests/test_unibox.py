@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_unibox.py
+
+"""
+import time
+import socket
+import unittest
+
+from trytond.modules.shipping_gls.unibox import UniboxClient, \
+    DeadlineExceeded, labelling_deadline, resolve
+
+
+class TestUniboxClient(unittest.TestCase):
+    """
+    Test the timeouts and deadline of the Unibox client
+    """
+
+    def setUp(self):
+        # Accepts connections but never answers
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_0010_read_timeout(self):
+        """
+        Test that a silent Unibox does not block the request
+        """
+        client = UniboxClient(
+            '127.0.0.1', self.port, connect_timeout=1, read_timeout=0.2
+        )
+        start = time.time()
+        self.assertRaises(socket.timeout, client.request, ['T8904:1'])
+        self.assertLess(time.time() - start, 1)
+
+    def test_0020_labelling_deadline(self):
+        """
+        Test that the requests share the deadline and fail fast once it has
+        passed
+        """
+        client = UniboxClient(
+            '127.0.0.1', self.port, read_timeout=5, label_deadline=0.3
+        )
+        with labelling_deadline([client, client]):
+            start = time.time()
+            self.assertRaises(socket.timeout, client.request, ['T8904:1'])
+            self.assertLess(time.time() - start, 1)
+
+            start = time.time()
+            self.assertRaises(
+                DeadlineExceeded, client.request, ['T8904:2']
+            )
+            self.assertLess(time.time() - start, 0.1)
+        self.assertIsNone(client.deadline)
+
+    def test_0030_check(self):
+        """
+        Test that the address of the Unibox is resolved once and refreshed by
+        the reachability checks
+        """
+        addresses = resolve('localhost', self.port)
+        self.assertIs(resolve('localhost', self.port), addresses)
+
+        client = UniboxClient('localhost', self.port, connect_timeout=1)
+        self.assertLess(client.check(), 1)
+        self.assertIsNot(resolve('localhost', self.port), addresses)
+
+        self.server.close()
+        self.assertRaises(socket.error, client.check)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    tracking.py
+
+    Client for the GLS parcel tracking service
+"""
+import json
+import urllib
+import urllib2
+from datetime import datetime
+
+__all__ = [
+    'GLS_TRACKING_STATES', 'GLS_TRACKING_FINAL_STATES', 'TrackingClient'
+]
+
+GLS_TRACKING_STATES = [
+    (None, ''),
+    ('pending', 'Pending'),
+    ('in_transit', 'In Transit'),
+    ('out_for_delivery', 'Out for Delivery'),
+    ('delivered', 'Delivered'),
+    ('exception', 'Exception'),
+]
+
+#: Parcels in these states are not polled anymore
+GLS_TRACKING_FINAL_STATES = ['delivered']
+
+#: Maps the status info of the GLS tracking service to a tracking state
+GLS_STATUS_INFOS = {
+    'PREADVICE': 'pending',
+    'INTRANSIT': 'in_transit',
+    'INWAREHOUSE': 'in_transit',
+    'INDELIVERY': 'out_for_delivery',
+    'DELIVERED': 'delivered',
+    'DELIVEREDPS': 'delivered',
+    'NOTDELIVERED': 'exception',
+}
+
+
+class TrackingClient(object):
+    """
+    Queries the GLS tracking service for the status of many parcels at once.
+
+    The service is called with the tracking numbers as a comma separated
+    `match` parameter and answers with a JSON document of the form::
+
+        {"tuStatus": [{
+            "tuNo": "<tracking number>",
+            "progressBar": {"statusInfo": "INTRANSIT"},
+            "history": [{
+                "date": "2016-05-02", "time": "10:20:00",
+                "evtDscr": "The parcel has reached the parcel center."
+            }]
+        }]}
+
+    with the most recent event first in the history.
+    """
+
+    def __init__(self, url, timeout=30):
+        self.url = url
+        self.timeout = timeout
+
+    def _parse_status(self, tu_status):
+        """
+        Returns the tuple (state, status, event date) of a parcel
+        """
+        status_info = tu_status.get('progressBar', {}).get('statusInfo')
+        state = GLS_STATUS_INFOS.get(status_info, 'in_transit')
+        history = tu_status.get('history') or [{}]
+        event = history[0]
+        event_date = None
+        if event.get('date'):
+            event_date = datetime.strptime(
+                '%s %s' % (event['date'], event.get('time') or '00:00:00'),
+                '%Y-%m-%d %H:%M:%S'
+            )
+        return state, event.get('evtDscr') or status_info, event_date
+
+    def get_statuses(self, tracking_numbers):
+        """
+        Returns a dictionary which maps the tracking numbers known by GLS to
+        the tuple (state, status, event date) of the parcel.
+        """
+        url = '%s?%s' % (
+            self.url, urllib.urlencode({'match': ','.join(tracking_numbers)})
+        )
+        response = urllib2.urlopen(url, timeout=self.timeout)
+        try:
+            result = json.load(response)
+        finally:
+            response.close()
+
+        return dict(
+            (tu_status['tuNo'], self._parse_status(tu_status))
+            for tu_status in result.get('tuStatus', [])
+        )
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+    unibox.py
+
+    Unibox client bounding the time spent on its connections
+"""
+import time
+import socket
+from contextlib import contextmanager
+
+from gls_unibox_api.api import Client
+
+from trytond.config import config
+
+__all__ = [
+    'DeadlineExceeded', 'UniboxClient', 'labelling_deadline', 'resolve',
+]
+
+#: Seconds the resolved addresses of a Unibox are reused
+ADDRESS_TTL = config.getint('shipping_gls', 'unibox_address_ttl', default=300)
+
+# Addresses of the Unibox hosts resolved by the process, as tuples
+# (addresses, time of the resolution) by (server, port)
+_addresses = {}
+
+
+class DeadlineExceeded(socket.timeout):
+    """
+    Raised when a request is sent with a client whose labelling deadline has
+    passed
+    """
+
+
+def resolve(server, port, refresh=False):
+    """
+    Returns the socket addresses of the Unibox, which are resolved at most
+    once per ADDRESS_TTL seconds in the process unless refresh is set
+    """
+    now = time.time()
+    cached = _addresses.get((server, port))
+    if refresh or cached is None or now - cached[1] > ADDRESS_TTL:
+        cached = _addresses[(server, port)] = ([
+            info[4] for info in socket.getaddrinfo(
+                server, port, 0, socket.SOCK_STREAM
+            )
+        ], now)
+    return cached[0]
+
+
+class UniboxConnection(object):
+    """
+    Socket wrapper which bounds each operation by the read timeout and the
+    deadline of its client
+    """
+
+    def __init__(self, client, sock):
+        self.client = client
+        self.sock = sock
+
+    def sendall(self, data):
+        self.sock.settimeout(self.client.get_timeout(self.client.read_timeout))
+        self.sock.sendall(data)
+
+    def recv(self, size):
+        self.sock.settimeout(self.client.get_timeout(self.client.read_timeout))
+        return self.sock.recv(size)
+
+    def close(self):
+        self.sock.close()
+
+
+class UniboxClient(Client):
+    """
+    Unibox client with connect and read timeouts.
+
+    While a deadline is set, requests also fail once it has passed, so that
+    a budget can be shared between all the requests of a labelling run.
+    """
+
+    def __init__(self, server, port, test=False, connect_timeout=None,
+                 read_timeout=None, label_deadline=None):
+        """
+        :param connect_timeout: Seconds to wait for the connection
+        :param read_timeout: Seconds to wait for each chunk of the response
+        :param label_deadline: Seconds given to all the requests of a
+                               labelling run
+        """
+        super(UniboxClient, self).__init__(server, port, test)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.label_deadline = label_deadline
+        self.deadline = None
+
+    def get_timeout(self, timeout):
+        """
+        Returns the timeout of the next socket operation, bounded by the
+        time left before the deadline
+        """
+        if self.deadline is None:
+            return timeout
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('GLS labelling deadline exceeded')
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def get_socket_conn(self):
+        error = None
+        for address in resolve(self.server, self.port):
+            try:
+                sock = socket.create_connection(
+                    address[:2], self.get_timeout(self.connect_timeout)
+                )
+            except socket.error as exception:
+                error = exception
+                continue
+            return UniboxConnection(self, sock)
+        raise error
+
+    def check(self):
+        """
+        Resolves the address of the Unibox again and verifies that it accepts
+        a connection, which is closed at once. Returns the number of seconds
+        it took.
+        """
+        start = time.time()
+        resolve(self.server, self.port, refresh=True)
+        self.get_socket_conn().close()
+        return time.time() - start
+
+
+@contextmanager
+def labelling_deadline(clients):
+    """
+    Sets the deadline of the clients for the duration of the block, so that
+    the requests sent with each client share its labelling budget
+    """
+    clients = set(clients)
+    now = time.time()
+    for client in clients:
+        if client.label_deadline:
+            client.deadline = now + client.label_deadline
+    try:
+        yield
+    finally:
+        for client in clients:
+            client.deadline = None
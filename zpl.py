@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    zpl.py
+
+    Helpers to work on ZPL label documents
+"""
+import re
+
+__all__ = ['DOTS_PER_MM', 'convert_zpl']
+
+#: Print density of the supported printer resolutions
+DOTS_PER_MM = {
+    'zebrazpl200': 8,
+    'zebrazpl300': 12,
+}
+
+#: Index of the parameters, expressed in dots, of each ZPL command
+SCALED_PARAMETERS = {
+    'A': (1, 2),  # Scalable/bitmapped font: orientation, height, width
+    'B3': (2,),  # Code 39: orientation, check digit, height
+    'BC': (1,),  # Code 128: orientation, height
+    'BY': (0, 2),  # Bar code defaults: module width, ratio, height
+    'CF': (1, 2),  # Change default font: font, height, width
+    'FB': (0, 2, 4),  # Field block: width, lines, spacing, justify, indent
+    'FO': (0, 1),  # Field origin
+    'FT': (0, 1),  # Field typeset
+    'GB': (0, 1, 2),  # Graphic box: width, height, thickness
+    'LH': (0, 1),  # Label home
+    'LL': (0,),  # Label length
+    'LS': (0,),  # Label shift
+    'LT': (0,),  # Label top
+    'PW': (0,),  # Print width
+}
+
+COMMAND = re.compile(r'([\^~])(A[0-9A-Z@]|[A-Z@][A-Z0-9@])([^\^~]*)')
+
+
+def _scale_parameters(command, parameters, factor):
+    """
+    Scale the parameters in dots of the command by factor
+    """
+    indexes = SCALED_PARAMETERS.get(
+        'A' if command.startswith('A') else command
+    )
+    if not indexes:
+        return parameters
+    parameters = parameters.split(',')
+    for index in indexes:
+        if index < len(parameters) and parameters[index].strip().isdigit():
+            parameters[index] = str(
+                max(int(round(int(parameters[index]) * factor)), 1)
+            )
+    return ','.join(parameters)
+
+
+def convert_zpl(zpl, source, target):
+    """
+    Converts a ZPL document between printer resolutions by scaling the
+    positions and dimensions of its commands.
+
+    Embedded bitmaps (^GF) cannot be resampled and are kept as they are.
+
+    :param source: Printer resolution the document was generated for
+    :param target: Printer resolution of the printer to use
+    """
+    if source == target:
+        return zpl
+    factor = float(DOTS_PER_MM[target]) / DOTS_PER_MM[source]
+
+    def scale(match):
+        prefix, command, parameters = match.groups()
+        if prefix == '^':
+            parameters = _scale_parameters(command, parameters, factor)
+        return prefix + command + parameters
+
+    return COMMAND.sub(scale, zpl)